@@ -0,0 +1,76 @@
+# Offline Azure OpenAI Batch API mode.
+# Every row is written to a Batch-format JSONL file (requests.jsonl by default) with custom_id set
+# to the DataFrame index, the file is uploaded and a batch job created against it. The job runs
+# on the service's separate batch quota at batch pricing; once it completes, the output JSONL is
+# downloaded and the replies are returned per custom_id so they can be merged into the table.
+# Batch jobs need a 'Global-Batch' deployment; set AZURE_OPENAI_BATCH_MODEL to its name.
+
+import json
+import time
+
+BATCH_ENDPOINT = "/chat/completions"
+COMPLETION_WINDOW = "24h"
+FINISHED_STATES = ("completed", "failed", "expired", "cancelled")
+
+
+def write_batch_requests(path, rows, assembled_prompt, model, response_format=None):
+    # rows: iterable of (index, row_prep). Returns the number of requests written.
+    # response_format, if given, is sent with every request (see structured_output.py).
+    count = 0
+    with open(path, "w", encoding="utf-8") as file:
+        for index, row_prep in rows:
+            request = {
+                "custom_id": str(index),
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": {
+                    "model": model,
+                    "messages": [{"role": "system", "content": assembled_prompt},
+                                 {"role": "user", "content": f" {row_prep} ."}],
+                },
+            }
+            if response_format is not None:
+                request["body"]["response_format"] = response_format
+            file.write(json.dumps(request) + "\n")
+            count += 1
+    return count
+
+
+def submit_batch(client, path):
+    with open(path, "rb") as file:
+        uploaded = client.files.create(file=file, purpose="batch")
+    return client.batches.create(input_file_id=uploaded.id, endpoint=BATCH_ENDPOINT,
+                                 completion_window=COMPLETION_WINDOW)
+
+
+def wait_for_batch(client, batch_id, poll_seconds=60, progress=print):
+    # Blocks until the job reaches a final state; only used where nothing else needs the thread
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        if counts is not None:
+            progress(f"Batch {batch_id}: {batch.status} ({counts.completed}/{counts.total} done, {counts.failed} failed)")
+        else:
+            progress(f"Batch {batch_id}: {batch.status}")
+        if batch.status in FINISHED_STATES:
+            return batch
+        time.sleep(poll_seconds)
+
+
+def read_batch_results(client, batch):
+    # Yields (custom_id, content, error) for every line of the output and error files.
+    # content is the assistant message text; error is a description when the request failed.
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for line in client.files.content(file_id).text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            body = response.get("body") or {}
+            if record.get("error") or response.get("status_code") != 200:
+                error = record.get("error") or body.get("error") or f"HTTP {response.get('status_code')}"
+                yield record["custom_id"], None, str(error)
+            else:
+                yield record["custom_id"], body["choices"][0]["message"]["content"], None
@@ -0,0 +1,144 @@
+# Throughput/latency benchmark for the submission engine, run against the local mock endpoint
+# (mock_azure_server.py) so that regressions in the hot path show up without a live deployment.
+# Synthetic tables with test_data.txt's columns are generated at each requested size and sent
+# through submit_engine.run_submission; rows/sec, per-request latency percentiles, retries,
+# errors, peak RSS and what bound the run (quota, network or local overhead) are reported.
+#
+# Example:
+#   python benchmark.py --sizes 1000 10000 100000 --concurrency 32 --latency-ms 20 --rate-429 0.01
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import submit_engine as engine
+from telemetry import telemetry
+from mock_azure_server import MockSettings, start_mock_server
+
+try:
+    import resource  # not available on Windows
+except ImportError:
+    resource = None
+
+
+def synthetic_table(template, rows, seed=0):
+    # Rows are drawn from the template with a numbered name so that none of them are duplicates
+    # (duplicates would be coalesced or cached and flatter the numbers)
+    df = template.sample(n=rows, replace=True, random_state=seed).reset_index(drop=True)
+    first_column = df.columns[0]
+    df[first_column] = df[first_column].astype(str) + " #" + df.index.astype(str)
+    return df
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return float("nan")
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024  # bytes on macOS, KiB on Linux
+
+
+def run_case(template, assembled_prompt, rows, server, args):
+    df = synthetic_table(template, rows)
+    input_fields, _, _ = engine.prompt_input_fields(df.columns, assembled_prompt)
+    engine.add_output_columns(df, engine.parse_output_fields(assembled_prompt))
+
+    # Time every request the engine makes (including its retries)
+    latencies = []
+    latencies_lock = threading.Lock()
+    send = engine.run_conversation_w_input0
+
+    def timed_send(*send_args, **send_kwargs):
+        started = time.perf_counter()
+        try:
+            return send(*send_args, **send_kwargs)
+        finally:
+            with latencies_lock:
+                latencies.append(time.perf_counter() - started)
+
+    with server.stats_lock:
+        server.stats.clear()
+    engine.run_conversation_w_input0 = timed_send
+    try:
+        started = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            summary = engine.run_submission(df, input_fields, assembled_prompt, max_in_flight=args.concurrency,
+                                            rows_per_request=args.rows_per_request, use_cache=False)
+        elapsed = time.perf_counter() - started
+    finally:
+        engine.run_conversation_w_input0 = send
+
+    latencies.sort()
+    with server.stats_lock:
+        responses = dict(server.stats)
+    return {
+        "rows": rows,
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": round(rows / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "retries": sum(count for status, count in responses.items() if status != 200),
+        "errors": len(summary["errors"]) // 2,  # error details are recorded as (exception, row) pairs
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "bound": telemetry.bottleneck()[0],  # quota, network or local (see telemetry.py)
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the submission engine against a local mock endpoint.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--data", default="test_data.txt", help="table whose columns and values are sampled")
+    parser.add_argument("--prompt", default="test_promptv2.txt")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--rows-per-request", type=int, default=1)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-500", type=float, default=0.0)
+    parser.add_argument("--rate-malformed", type=float, default=0.0)
+    parser.add_argument("--json", help="also write the results to this file for comparison between builds")
+    args = parser.parse_args(argv)
+
+    settings = MockSettings(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, rate_429=args.rate_429,
+                            rate_500=args.rate_500, rate_malformed=args.rate_malformed, seed=0)
+    server = start_mock_server(settings)
+
+    # Point the engine at the mock and keep its cache away from the real one
+    engine.AZURE_OPENAI_ENDPOINT = f"http://127.0.0.1:{server.server_address[1]}/"
+    engine.client = None
+    engine.endpoint_pool = None
+    engine.AZURE_OPENAI_CACHE_PATH = os.path.join(tempfile.mkdtemp(prefix="benchmark-"), "cache.sqlite3")
+    engine.response_cache = None
+
+    template = engine.read_table(args.data)
+    assembled_prompt = engine.read_prompt(args.prompt)
+
+    results = []
+    print(f"{'rows':>8} {'seconds':>9} {'rows/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'retries':>8} {'errors':>7} {'peak RSS MB':>12} {'bound':>8}")
+    for rows in args.sizes:
+        result = run_case(template, assembled_prompt, rows, server, args)
+        results.append(result)
+        print(f"{result['rows']:>8} {result['seconds']:>9} {result['rows_per_sec']:>9} {result['p50_ms']:>8} "
+              f"{result['p95_ms']:>8} {result['p99_ms']:>8} {result['retries']:>8} {result['errors']:>7} "
+              f"{result['peak_rss_mb']:>12} {result['bound']:>8}", flush=True)
+    server.shutdown()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump({"settings": vars(args), "results": results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# Previews and column profiles for query_formatter.py. Only the first PREVIEW_ROWS rows of a table are read
+# to show it while a prompt is written; the full file is read once, in the background, when the author first
+# focuses a column's explanation box, and each column is profiled from that copy. The profile gives the
+# column's type, share of empty cells, number of distinct values, a few examples and the average tokens it
+# adds to each row sent, so authors can see what each field costs before deciding to describe (and send) it.
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from cost_estimator import count_tokens
+
+PREVIEW_ROWS = 200
+EXAMPLE_VALUES = 3
+TOKEN_SAMPLE_VALUES = 2000  # values tokenized for the average; the rest of the column is not
+
+
+def is_excel(path):
+    return path.lower().endswith(('.xls', '.xlsx'))
+
+
+def read_preview(path, encoding=None, rows=PREVIEW_ROWS):
+    if is_excel(path):
+        return pd.read_excel(path, nrows=rows)
+    return pd.read_csv(path, sep='\t', encoding=encoding, encoding_errors="replace", nrows=rows)
+
+
+def read_table(path, encoding=None):
+    if is_excel(path):
+        return pd.read_excel(path)
+    # Bytes the detected encoding cannot decode (past the part text_encoding.detect_encoding samples) are
+    # replaced: the profile only needs the columns' shape
+    return pd.read_csv(path, sep='\t', encoding=encoding, encoding_errors="replace")
+
+
+def profile_column(values):
+    present = values.dropna()
+    text = values.astype(str).fillna("nan")  # as the submitter serializes it, missing values included
+    sample = text.sample(n=TOKEN_SAMPLE_VALUES, random_state=0) if len(text) > TOKEN_SAMPLE_VALUES else text
+    tokens = sum(count_tokens(value) for value in sample) / len(sample) if len(sample) else 0.0
+    return {
+        "column": values.name,
+        "dtype": str(values.dtype),
+        "rows": len(values),
+        "null_rate": 1 - len(present) / len(values) if len(values) else 0.0,
+        "distinct": int(present.nunique()),
+        "examples": present.astype(str).drop_duplicates().head(EXAMPLE_VALUES).tolist(),
+        "tokens_per_row": tokens,
+    }
+
+
+def describe_profile(profile):
+    examples = "; ".join(example if len(example) <= 40 else example[:37] + "..." for example in profile["examples"])
+    return (f"{profile['column']}: {profile['dtype']}, {profile['rows']:,} rows, {profile['null_rate']:.1%} empty, "
+            f"{profile['distinct']:,} distinct, e.g. {examples or '(none)'}; "
+            f"~{profile['tokens_per_row']:.1f} tokens per row (~{profile['tokens_per_row'] * profile['rows']:,.0f} "
+            "for the whole file)")
+
+
+class ColumnProfiler:
+    # Profiles the columns of one file on a background thread, each at most once. The file is read on
+    # that thread the first time a column is asked for and kept, so each further column costs only its profile.
+    def __init__(self, path, encoding=None):
+        self.path = path
+        self.encoding = encoding
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.table = None  # future of the whole table, read by the first profile
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def profile_cached(self, column):
+        # Runs on the executor after the table has been read (its one worker takes tasks in order)
+        return profile_column(self.table.result()[column])
+
+    def profile(self, column):
+        # Future of the column's profile (already finished if it was profiled before)
+        with self.lock:
+            if self.table is None:
+                self.table = self.executor.submit(read_table, self.path, self.encoding)
+            future = self.futures.get(column)
+            if future is None:
+                future = self.futures[column] = self.executor.submit(self.profile_cached, column)
+            return future
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
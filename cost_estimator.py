@@ -0,0 +1,88 @@
+# Token counting and cost projection for a run, so the cost of a table is known before it is sent
+# rather than from the Azure bill afterwards.
+# Tokens are counted with tiktoken when it is installed (pip install tiktoken), otherwise with the
+# same characters-per-token rule the rate limiter uses. Prices are USD per million tokens for the
+# model types below; set AZURE_OPENAI_PRICE_INPUT / AZURE_OPENAI_PRICE_OUTPUT to use your own rates.
+
+import math
+import os
+
+from rate_limiter import estimate_tokens
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# USD per 1M tokens (input, output), Azure OpenAI global standard deployments
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4": (30.00, 60.00),
+    "gpt-35-turbo": (0.50, 1.50),
+}
+MESSAGE_OVERHEAD_TOKENS = 7  # role markers around the system and user messages of a chat completion
+SAMPLE_ROWS = 200  # rows tokenized by the pre-flight estimate
+
+_encodings = {}
+
+
+def count_tokens(text, model="gpt-4o-mini"):
+    if tiktoken is not None:
+        if model not in _encodings:
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                _encodings[model] = tiktoken.get_encoding("o200k_base")  # unknown names: the gpt-4o family's encoding
+            except Exception:
+                _encodings[model] = None  # encoding files could not be fetched (offline): fall back to the estimate
+        encoding = _encodings[model]
+        if encoding is not None:
+            return len(encoding.encode(text, disallowed_special=()))
+    return estimate_tokens(text)
+
+
+def model_prices(model):
+    # (input, output) USD per 1M tokens; environment overrides win, unknown models cost 0
+    input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    input_price = float(os.environ.get("AZURE_OPENAI_PRICE_INPUT", input_price))
+    output_price = float(os.environ.get("AZURE_OPENAI_PRICE_OUTPUT", output_price))
+    return input_price, output_price
+
+
+def token_cost(model, prompt_tokens, completion_tokens):
+    input_price, output_price = model_prices(model)
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1000000
+
+
+def estimate_run(assembled_prompt, sample_payloads, rows, model, rows_per_request=1, completion_tokens_per_row=300,
+                 tokens_per_minute=0, requests_per_minute=0, max_in_flight=1, seconds_per_request=2.0):
+    # Projects tokens, cost and wall-clock time for a run of the given number of rows, from the row
+    # text of a sample of them (see SAMPLE_ROWS). The prompt is counted once per request.
+    requests = math.ceil(rows / max(rows_per_request, 1))
+    row_tokens = sum(count_tokens(payload, model) for payload in sample_payloads) / max(len(sample_payloads), 1)
+    prompt_tokens = round(requests * (count_tokens(assembled_prompt, model) + MESSAGE_OVERHEAD_TOKENS)
+                          + rows * row_tokens)
+    completion_tokens = rows * completion_tokens_per_row
+
+    # The run takes as long as its tightest limit: the quota or the requests that fit in flight
+    minutes = requests * seconds_per_request / max(max_in_flight, 1) / 60
+    if tokens_per_minute:
+        minutes = max(minutes, (prompt_tokens + completion_tokens) / tokens_per_minute)
+    if requests_per_minute:
+        minutes = max(minutes, requests / requests_per_minute)
+    return {
+        "rows": rows,
+        "requests": requests,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cost": token_cost(model, prompt_tokens, completion_tokens),
+        "minutes": minutes,
+        "tokenizer": "tiktoken" if tiktoken is not None else "approximate",
+    }
+
+
+def describe_estimate(estimate):
+    return (f"{estimate['rows']} rows in {estimate['requests']} requests: about "
+            f"{estimate['prompt_tokens']:,} prompt + {estimate['completion_tokens']:,} completion tokens, "
+            f"${estimate['cost']:.2f}, {estimate['minutes']:.1f} minutes ({estimate['tokenizer']} token counts)")
@@ -0,0 +1,169 @@
+# Dead-letter store: rows that still fail after all retries are kept in SQLite with the row text, the
+# class of their error and how often they failed, instead of being dropped at the end of the run.
+# submit_engine.reprocess_dead_letters (submit_cli.py --reprocess, or the GUI's "Reprocess Failed Rows")
+# re-sends them with a strategy chosen by error class and merges the fixes back into the results; a row
+# is taken out of the store once it has been answered.
+# Entries are keyed by the input file, the prompt fingerprint, the output column prefix (fan-out runs)
+# and the row's position in the input file.
+#
+# Error classes and how they are reprocessed:
+#   json_decode     the reply was not valid JSON: re-sent alone with stricter JSON instructions
+#   not_a_dict      the reply was a list or a bare value instead of one JSON object: as json_decode
+#   context_length  the row did not fit in the model's context: sent to AZURE_OPENAI_LONG_CONTEXT_MODEL if
+#                   one is set, split with map-reduce otherwise
+#   timeout         still timing out after all retries: long rows are split with map-reduce, others re-sent alone
+#   transient       still throttled or failing with 5xx after all retries: re-sent alone
+#   bad_request     rejected by the service for another reason: re-sent alone
+#   content_filter  blocked by the content filter (the prompt refused with a 400, or the reply withheld):
+#                   left for manual review unless asked for explicitly
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from openai import APITimeoutError, BadRequestError
+
+from map_reduce import is_context_length_error
+
+ERROR_CLASSES = ("json_decode", "not_a_dict", "context_length", "timeout", "transient", "bad_request",
+                 "content_filter")
+REPROCESSED_CLASSES = ERROR_CLASSES[:-1]  # reprocessed unless other classes are asked for
+
+# Appended to the prompt when re-sending rows whose reply could not be used as a JSON object
+STRICT_JSON_INSTRUCTIONS = """
+Your previous reply to this row could not be read. Reply with exactly one JSON object whose keys are the Output_Fields
+and whose values are strings. Do not reply with a list, do not use code fences and do not write anything before or after
+the object.
+"""
+
+
+class UnexpectedReplyError(ValueError):
+    # A reply that decoded as JSON but is not an object (e.g. a list), so it has no Output_Fields
+    def __init__(self, reply):
+        super().__init__(f"Received a {type(reply).__name__} instead of a dictionary: {reply}")
+        self.reply = reply
+
+
+class ContentFilteredError(Exception):
+    # A reply withheld by the output-side content filter: a 200 with no content or finish_reason 'content_filter'
+    def __init__(self, finish_reason=None):
+        super().__init__(f"The reply was withheld by the content filter (finish_reason: {finish_reason})")
+        self.finish_reason = finish_reason
+
+
+class BatchRequestError(Exception):
+    # A request of a Batch API job that the service failed (a line of the job's error file or a non-200 reply)
+    pass
+
+
+def is_content_filter_error(error):
+    message = str(error).lower()
+    return getattr(error, "code", None) == "content_filter" or "content_filter" in message \
+        or "content management policy" in message
+
+
+def classify_error(error):
+    # The dead-letter class of the exception a row failed with
+    if isinstance(error, UnexpectedReplyError):
+        return "not_a_dict"
+    if isinstance(error, ContentFilteredError):
+        return "content_filter"
+    if isinstance(error, json.JSONDecodeError):
+        return "json_decode"
+    if isinstance(error, BadRequestError):
+        if is_context_length_error(error):
+            return "context_length"
+        if is_content_filter_error(error):
+            return "content_filter"
+        return "bad_request"
+    if isinstance(error, APITimeoutError):
+        return "timeout"
+    if isinstance(error, BatchRequestError):  # only the description is left; 429s and 5xx fall through to transient
+        if is_context_length_error(error):
+            return "context_length"
+        if is_content_filter_error(error):
+            return "content_filter"
+    return "transient"
+
+
+def describe_classes(counts):
+    # counts: {error class: rows}
+    ordered = sorted(counts.items(), key=lambda item: -item[1])
+    return ", ".join(f"{count} {error_class}" for error_class, count in ordered)
+
+
+class DeadLetterStore:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS dead_letters (
+                                       source TEXT NOT NULL,
+                                       prompt TEXT NOT NULL,
+                                       prefix TEXT NOT NULL,
+                                       row_index TEXT NOT NULL,
+                                       row_text TEXT NOT NULL,
+                                       error_class TEXT NOT NULL,
+                                       error_type TEXT NOT NULL,
+                                       error TEXT NOT NULL,
+                                       attempts INTEGER NOT NULL,
+                                       first_failed REAL NOT NULL,
+                                       last_failed REAL NOT NULL,
+                                       PRIMARY KEY (source, prompt, prefix, row_index))""")
+        self.connection.commit()
+
+    def add(self, source, prompt, prefix, index, row_text, error):
+        # Records a failed row, or a further failure of one already in the store
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO dead_letters VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1, ?, ?) "
+                "ON CONFLICT (source, prompt, prefix, row_index) DO UPDATE SET row_text = excluded.row_text, "
+                "error_class = excluded.error_class, error_type = excluded.error_type, error = excluded.error, "
+                "attempts = attempts + 1, last_failed = excluded.last_failed",
+                (source, prompt, prefix, str(index), row_text, classify_error(error), type(error).__name__,
+                 str(error), now, now))
+            self.connection.commit()
+
+    def resolve(self, source, prompt, prefix, index):
+        # Takes a row that has now been answered out of the store
+        with self.lock:
+            self.connection.execute("DELETE FROM dead_letters WHERE source = ? AND prompt = ? AND prefix = ? "
+                                    "AND row_index = ?", (source, prompt, prefix, str(index)))
+            self.connection.commit()
+
+    def indexes(self, source, prompt, prefix):
+        # Positions (as text) of the rows in the store for this file, prompt and prefix
+        with self.lock:
+            rows = self.connection.execute("SELECT row_index FROM dead_letters WHERE source = ? AND prompt = ? "
+                                           "AND prefix = ?", (source, prompt, prefix)).fetchall()
+        return {row[0] for row in rows}
+
+    def letters(self, source, prompt, prefix, classes=None):
+        # The stored rows as dicts (index, row_text, error_class, error_type, error, attempts), oldest failure first
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT row_index, row_text, error_class, error_type, error, attempts FROM dead_letters "
+                "WHERE source = ? AND prompt = ? AND prefix = ? ORDER BY first_failed",
+                (source, prompt, prefix)).fetchall()
+        keys = ("index", "row_text", "error_class", "error_type", "error", "attempts")
+        return [dict(zip(keys, row)) for row in rows if classes is None or row[2] in classes]
+
+    def counts(self, source, prompt, prefix):
+        # {error class: rows} for this file, prompt and prefix
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT error_class, COUNT(*) FROM dead_letters WHERE source = ? AND prompt = ? AND prefix = ? "
+                "GROUP BY error_class", (source, prompt, prefix)).fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def letter_source(inputfile):
+    # Input files are identified by absolute path, so a run and its reprocessing can start from different directories
+    return os.path.abspath(inputfile)
@@ -0,0 +1,224 @@
+# Spreads chat completions across several Azure OpenAI deployments (e.g. the same model deployed in
+# several regions) so one run can use the combined quota of all of them.
+# Each endpoint has its own rate limiter (see rate_limiter.py). Requests go to the least loaded healthy
+# endpoint relative to its weight; endpoints that are throttled are used only when no other is free,
+# and an endpoint is taken out of rotation for a cool-down after repeated failures. Per-endpoint
+# metrics (requests, failures, 429s, tokens, latency) are kept for the end-of-run report.
+#
+# Endpoints are listed in a JSON file named by AZURE_OPENAI_ENDPOINTS, for example:
+#   [{"name": "eastus", "endpoint": "https://eastus-resource.openai.azure.com/", "key_env": "AZURE_OPENAI_KEY_EASTUS",
+#     "deployment": "gpt-4o-mini", "weight": 2, "tpm": 450000, "rpm": 2700},
+#    {"name": "swedencentral", "endpoint": "https://sweden-resource.openai.azure.com/", "key": "...",
+#     "deployment": "mini-sweden", "model": "gpt-4o-mini", "weight": 1, "tpm": 200000}]
+# "key_env" names an environment variable holding the key so keys need not be written to the file.
+# "model" is the model type the deployment runs, which its tokens are priced as (see cost_estimator.py);
+# it defaults to AZURE_OPENAI_MODEL_NAME.
+
+import json
+import os
+import threading
+import time
+
+from openai import AzureOpenAI, RateLimitError
+
+from rate_limiter import RateLimiter, TRANSIENT_ERRORS, backoff_delay, retry_after_seconds
+from telemetry import telemetry
+
+FAILURE_THRESHOLD = 3  # consecutive failures before an endpoint is taken out of rotation
+COOLDOWN_SECONDS = 60  # how long an unhealthy endpoint stays out
+
+
+class Endpoint:
+    def __init__(self, name, endpoint, key, deployment, api_version, weight=1.0, tpm=0, rpm=0, model=None):
+        self.name = name
+        self.endpoint = endpoint
+        self.key = key
+        self.deployment = deployment
+        self.model = model or deployment  # model type the deployment's usage is priced as
+        self.api_version = api_version
+        self.weight = float(weight) or 1.0
+        self.limiter = RateLimiter(tokens_per_minute=tpm, requests_per_minute=rpm)
+        self.client = None
+        # Routing state and metrics; guarded by the pool's lock
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.throttled = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latency_total = 0.0
+
+    def get_client(self):
+        if self.client is None:
+            self.client = AzureOpenAI(
+                azure_endpoint=self.endpoint,
+                api_key=self.key,
+                api_version=self.api_version,
+                max_retries=0,  # retries are scheduled by the pool so that they can move to another endpoint
+            )
+        return self.client
+
+    def metrics(self):
+        successes = self.requests - self.failures - self.throttled
+        return {
+            "name": self.name,
+            "requests": self.requests,
+            "failures": self.failures,
+            "throttled": self.throttled,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "mean_latency_s": round(self.latency_total / successes, 3) if successes else 0.0,
+            "in_flight": self.in_flight,
+            "healthy": self.unhealthy_until <= time.monotonic(),
+        }
+
+
+def load_endpoints(path, api_version, model=None):
+    # model: the model type of entries that do not name one
+    with open(path, "r", encoding="utf-8") as file:
+        entries = json.load(file)
+    endpoints = []
+    for number, entry in enumerate(entries, start=1):
+        name = entry.get("name", f"endpoint{number}")
+        key = os.environ.get(entry["key_env"], "") if "key_env" in entry else entry.get("key", "")
+        if not key:
+            raise ValueError(f"No key for endpoint {name} in {path}"
+                             + (f": set the {entry['key_env']} environment variable" if "key_env" in entry else ""))
+        endpoints.append(Endpoint(name, entry["endpoint"], key,
+                                  entry["deployment"], entry.get("api_version", api_version),
+                                  weight=entry.get("weight", 1), tpm=entry.get("tpm", 0), rpm=entry.get("rpm", 0),
+                                  model=entry.get("model", model)))
+    if not endpoints:
+        raise ValueError(f"No endpoints listed in {path}")
+    return endpoints
+
+
+class EndpointPool:
+    def __init__(self, endpoints, failure_threshold=FAILURE_THRESHOLD, cooldown_seconds=COOLDOWN_SECONDS):
+        self.endpoints = endpoints
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.lock = threading.Lock()
+
+    def _available(self, endpoint, now):
+        return endpoint.unhealthy_until <= now and endpoint.limiter.paused_until <= now
+
+    def acquire(self, avoid=None):
+        # Least loaded relative to weight among healthy endpoints that are not being throttled (other than
+        # avoid, the endpoint a retry is moving away from, if there is a choice); if there are none, the
+        # one that becomes usable first
+        with self.lock:
+            now = time.monotonic()
+            available = [endpoint for endpoint in self.endpoints if self._available(endpoint, now)]
+            if avoid is not None and len(available) > 1:
+                available = [endpoint for endpoint in available if endpoint is not avoid]
+            if available:
+                endpoint = min(available, key=lambda e: (e.in_flight + 1) / e.weight)
+            else:
+                endpoint = min(self.endpoints, key=lambda e: max(e.unhealthy_until, e.limiter.paused_until))
+            endpoint.in_flight += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint, error=None, latency=0.0, usage=None):
+        with self.lock:
+            endpoint.in_flight -= 1
+            if error is None:
+                endpoint.consecutive_failures = 0
+                endpoint.latency_total += latency
+                if usage is not None:
+                    endpoint.prompt_tokens += usage.prompt_tokens or 0
+                    endpoint.completion_tokens += usage.completion_tokens or 0
+            elif isinstance(error, RateLimitError):
+                endpoint.throttled += 1  # out of quota, not unhealthy: its limiter pauses it
+            else:
+                endpoint.failures += 1
+                endpoint.consecutive_failures += 1
+                if endpoint.consecutive_failures >= self.failure_threshold:
+                    endpoint.unhealthy_until = time.monotonic() + self.cooldown_seconds
+                    endpoint.consecutive_failures = 0
+                    telemetry.log("WARNING", "endpoint_unhealthy",
+                                  f"Endpoint {endpoint.name} failed {self.failure_threshold} times in a row; "
+                                  f"out of rotation for {self.cooldown_seconds}s",
+                                  endpoint=endpoint.name, cooldown_s=self.cooldown_seconds)
+                    telemetry.count("endpoint_cooldowns_total", endpoint=endpoint.name)
+
+    def other_available(self, endpoint):
+        with self.lock:
+            now = time.monotonic()
+            return any(self._available(other, now) for other in self.endpoints if other is not endpoint)
+
+    def call_with_retry(self, estimated_tokens, call, max_retries=6):
+        # call(endpoint) must return a raw response (endpoint.get_client().chat.completions.with_raw_response
+        # .create(...)); returns (parsed completion, the endpoint that served it). A failed attempt is retried straight away on
+        # another endpoint when one is available, otherwise after the retry-after / backoff delay.
+        attempt = 0
+        failed = None
+        while True:
+            endpoint = self.acquire(avoid=failed)
+            waiting = time.monotonic()
+            endpoint.limiter.acquire(estimated_tokens)
+            started = time.monotonic()
+            telemetry.add("quota_wait_s", started - waiting)
+            telemetry.add("calls", 1)
+            try:
+                raw = call(endpoint)
+            except TRANSIENT_ERRORS as e:
+                self.release(endpoint, error=e)
+                telemetry.add("network_s", time.monotonic() - started)
+                telemetry.count("failed_calls_total", endpoint=endpoint.name, error=type(e).__name__)
+                attempt += 1
+                if attempt > max_retries:
+                    raise
+                response = getattr(e, "response", None)
+                headers = response.headers if response is not None else None
+                endpoint.limiter.update_from_headers(headers)
+                delay = retry_after_seconds(headers)
+                if delay is None:
+                    delay = backoff_delay(attempt)
+                if isinstance(e, RateLimitError):
+                    endpoint.limiter.pause(delay)  # quota exhausted: no worker uses this endpoint until it recovers
+                failed = endpoint
+                telemetry.add("retries", 1)
+                if self.other_available(endpoint):
+                    telemetry.log("WARNING", "retry", f"Transient error ({type(e).__name__}) on {endpoint.name}, "
+                                                      f"retry {attempt}/{max_retries} on another endpoint",
+                                  endpoint=endpoint.name, error=type(e).__name__, attempt=attempt)
+                    continue
+                telemetry.log("WARNING", "retry", f"Transient error ({type(e).__name__}) on {endpoint.name}, "
+                                                  f"retry {attempt}/{max_retries} in {delay:.1f}s",
+                              endpoint=endpoint.name, error=type(e).__name__, attempt=attempt, delay_s=delay)
+                time.sleep(delay)
+                # Waiting out a 429 is time spent on quota; backing off after a server error or timeout is not
+                telemetry.add("quota_wait_s" if isinstance(e, RateLimitError) else "network_s", delay)
+                continue
+            except Exception:
+                self.release(endpoint, latency=time.monotonic() - started)  # e.g. a bad request: the endpoint itself is fine
+                telemetry.add("network_s", time.monotonic() - started)
+                raise
+            endpoint.limiter.update_from_headers(raw.headers)
+            completion = raw.parse()
+            latency = time.monotonic() - started
+            self.release(endpoint, latency=latency, usage=completion.usage)
+            telemetry.add("network_s", latency)
+            telemetry.observe("call_latency_seconds", latency, endpoint=endpoint.name)
+            return completion, endpoint
+
+    def deployments(self):
+        # The deployments requests may go to, as one name (for cache keys and prompt fingerprints)
+        return "+".join(sorted({endpoint.deployment for endpoint in self.endpoints}))
+
+    def models(self):
+        return sorted({endpoint.model for endpoint in self.endpoints})
+
+    def metrics(self):
+        with self.lock:
+            return [endpoint.metrics() for endpoint in self.endpoints]
+
+    def describe(self):
+        return "\n".join(f"  {m['name']}: {m['requests']} requests, {m['failures']} failures, {m['throttled']} throttled, "
+                         f"{m['prompt_tokens']:,} + {m['completion_tokens']:,} tokens, "
+                         f"mean latency {m['mean_latency_s']}s{'' if m['healthy'] else ' (out of rotation)'}"
+                         for m in self.metrics())
@@ -0,0 +1,53 @@
+# Incremental re-runs: every answered row in a results file carries a fingerprint of its input row
+# and of the prompt (and model) that produced it. When a refreshed table is sent again with
+# --previous <old results>, rows whose fingerprints match an answered row of the old file are copied
+# from it, and only new, changed or previously failed rows are submitted.
+# Rows are matched by content, not position, so inserted, deleted or re-ordered rows are handled.
+# Prompts are compared after normalizing whitespace, so re-exporting an unchanged prompt from
+# query_formatter.py does not invalidate the old results.
+
+import hashlib
+import os
+
+import pandas as pd
+
+from results_store import read_store
+
+ROW_FINGERPRINT_COLUMN = "Row_Fingerprint"
+PROMPT_FINGERPRINT_COLUMN = "Prompt_Fingerprint"
+FINGERPRINT_COLUMNS = [ROW_FINGERPRINT_COLUMN, PROMPT_FINGERPRINT_COLUMN]
+FINGERPRINT_LENGTH = 16  # hex digits kept; plenty to tell the rows of one table apart
+
+
+def row_fingerprint(row_prep):
+    return hashlib.sha256(row_prep.encode("utf-8")).hexdigest()[:FINGERPRINT_LENGTH]
+
+
+def prompt_fingerprint(model, assembled_prompt):
+    lines = (" ".join(line.split()) for line in assembled_prompt.splitlines())
+    normalized = "\n".join(line for line in lines if line)
+    return hashlib.sha256(f"{model}\0{normalized}".encode("utf-8")).hexdigest()[:FINGERPRINT_LENGTH]
+
+
+def read_results(path):
+    # An earlier results file (tab-delimited text, Excel or a Parquet store), every cell read back as text
+    if os.path.splitext(path)[1].lower() == '.parquet':
+        return read_store(path)
+    if os.path.splitext(path)[1].lower() in ['.xls', '.xlsx']:
+        return pd.read_excel(path, dtype=str, keep_default_na=False)
+    return pd.read_csv(path, sep='\t', dtype=str, keep_default_na=False, encoding='utf-8')
+
+
+def previous_answers(results, prompt_key, result_columns):
+    # Returns ({row fingerprint: result dict}, rows answered under another prompt) for the answered
+    # rows of an earlier results DataFrame. Failed rows have no fingerprint and are left out.
+    if ROW_FINGERPRINT_COLUMN not in results.columns or PROMPT_FINGERPRINT_COLUMN not in results.columns:
+        return {}, 0
+    answered = results[results[ROW_FINGERPRINT_COLUMN] != ""]
+    same_prompt = answered[PROMPT_FINGERPRINT_COLUMN] == prompt_key
+    columns = [column for column in result_columns if column in results.columns]
+    answers = {}
+    for fingerprint, values in zip(answered.loc[same_prompt, ROW_FINGERPRINT_COLUMN],
+                                   answered.loc[same_prompt, columns].itertuples(index=False, name=None)):
+        answers[fingerprint] = dict(zip(columns, values))
+    return answers, int((~same_prompt).sum())
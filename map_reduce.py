@@ -0,0 +1,125 @@
+# Map-reduce for rows too long to send in one request (e.g. rows carrying long free-text notes).
+# Each cell longer than the chunk size is split into parts. Every part is sent on its own with the row's
+# short cells (map), asking for the Output_Fields as far as that part answers them, and a final request
+# combines the partial answers into the row's single Output_Fields answer (reduce).
+# Parts are made small enough for each map request to fit in the context, and when the partial answers
+# together do not fit in one reduce request they are combined in groups that do, round after round.
+# Cells are the tab-separated fields of the row text built by submit_engine.serialize_rows.
+
+import json
+
+from rate_limiter import estimate_tokens
+
+# Appended to the prompt file's text for the map requests
+MAP_INSTRUCTIONS = """
+This row is too long to send at once, so its long fields are sent in parts. In the data below, one long field holds only
+one part of its text, marked [part K of N], and other long fields are marked [sent separately].
+Answer the Output_Fields from this part and the row's other fields alone, quoting any details from the part that matter for
+an item. Leave an item empty if nothing here answers it. Do not add any additional text or commentary.
+"""
+
+# Appended to the prompt file's text for the reduce request
+REDUCE_INSTRUCTIONS = """
+This row was too long to send at once, so its long fields (marked [read in parts]) were read in parts and the Output_Fields
+were answered from each part separately. The row's short fields and the answers from every part follow the data.
+Combine them into a single answer for the whole row, as if you had read it at once. Do not add any additional text or commentary.
+"""
+
+MIN_CHUNK_TOKENS = 100  # parts are not made smaller than this to fit a map request in the context
+ANSWER_LINE_TOKENS = 4  # the "Part K: " label and line break around each partial answer in a reduce request
+OVERLAP_TOKENS = 50  # repeated between consecutive parts so that a fact cut at a boundary is seen whole in one of them
+CHARS_PER_TOKEN = 4  # as rate_limiter.estimate_tokens counts
+
+
+def is_context_length_error(error):
+    # True if a BadRequestError says the request does not fit in the model's context window
+    message = str(error).lower()
+    return "context_length_exceeded" in message or "maximum context length" in message
+
+
+def split_text(text, max_tokens, overlap_tokens=OVERLAP_TOKENS):
+    # Splits text into parts of at most about max_tokens tokens, at whitespace where possible
+    size = max(max_tokens * CHARS_PER_TOKEN, 1)
+    overlap = min(overlap_tokens * CHARS_PER_TOKEN, size // 4)
+    parts = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            space = text.rfind(" ", start + size // 2, end)
+            if space > start:
+                end = space
+        parts.append(text[start:end].strip())
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return [part for part in parts if part]
+
+
+def split_row(row_prep, chunk_tokens):
+    # Returns (map queries, reduce row): one tab-delimited row text per part of each long cell, and the row
+    # with its long cells replaced by a marker. No map queries if no cell is longer than chunk_tokens.
+    cells = row_prep.split("\t")
+    long_cells = {position: split_text(cell, chunk_tokens) for position, cell in enumerate(cells)
+                  if estimate_tokens(cell) > chunk_tokens}
+    if not long_cells:
+        return [], row_prep
+    queries = []
+    for position, parts in long_cells.items():
+        for number, part in enumerate(parts, start=1):
+            row = [f"[part {number} of {len(parts)}] {part}" if other == position
+                   else "[sent separately]" if other in long_cells else cell
+                   for other, cell in enumerate(cells)]
+            queries.append("\t".join(row))
+    reduce_row = "\t".join("[read in parts]" if position in long_cells else cell for position, cell in enumerate(cells))
+    return queries, reduce_row
+
+
+def split_row_to_fit(row_prep, chunk_tokens, max_tokens):
+    # split_row with parts made smaller (down to MIN_CHUNK_TOKENS) until every map query is at most max_tokens
+    while True:
+        queries, reduce_row = split_row(row_prep, chunk_tokens)
+        if not queries or chunk_tokens <= MIN_CHUNK_TOKENS \
+                or max(estimate_tokens(query) for query in queries) <= max_tokens:
+            return queries, reduce_row
+        chunk_tokens = max(chunk_tokens // 2, MIN_CHUNK_TOKENS)
+
+
+def answer_tokens(result):
+    # Estimated size of a partial answer in a reduce request
+    return estimate_tokens(json.dumps(result, ensure_ascii=False)) + ANSWER_LINE_TOKENS
+
+
+def group_answers(token_counts, max_tokens):
+    # Splits partial answers (given by their estimated sizes) into consecutive groups of positions whose
+    # answers fit in one reduce request of max_tokens. A group takes at least two answers, so each round
+    # of reduce requests leaves fewer answers than the one before; only the last group can hold one.
+    groups = []
+    group_tokens = 0
+    for position, tokens in enumerate(token_counts):
+        if groups and (len(groups[-1]) < 2 or group_tokens + tokens <= max_tokens):
+            groups[-1].append(position)
+            group_tokens += tokens
+        else:
+            groups.append([position])
+            group_tokens = tokens
+    return groups
+
+
+def reduce_request_count(parts, tokens_per_answer, max_tokens):
+    # Reduce requests for parts partial answers of tokens_per_answer each (for cost estimates)
+    requests = 0
+    answers = parts
+    while True:
+        groups = group_answers([tokens_per_answer] * answers, max_tokens)
+        if len(groups) == 1:
+            return requests + 1
+        requests += sum(1 for group in groups if len(group) > 1)
+        answers = len(groups)
+
+
+def build_reduce_query(reduce_row, partial_results):
+    lines = [reduce_row, "", "Answers from each part:"]
+    lines.extend(f"Part {number}: {json.dumps(result, ensure_ascii=False)}"
+                 for number, result in enumerate(partial_results, start=1))
+    return "\n".join(lines)
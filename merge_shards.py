@@ -0,0 +1,44 @@
+# Reassembles the partial results of a sharded run (submit_cli.py --shard K/N) into one table in the
+# original row order, and reports per shard how many rows it returned and which of them failed, plus
+# any rows missing from every partial or present in more than one.
+#
+# Example:
+#   python merge_shards.py --output results.txt part0.txt part1.txt part2.txt part3.txt
+
+import argparse
+import json
+import sys
+
+import submit_engine as engine
+from sharding import merge_shards
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Merge the partial results of a sharded run.")
+    parser.add_argument("partials", nargs="+", help="partial results files written by submit_cli.py --shard")
+    parser.add_argument("--output", required=True, help="merged results; .xlsx writes Excel, .parquet a Parquet store, anything else tab-delimited text")
+    parser.add_argument("--expected-rows", type=int, help="rows in the input table, to detect shards that never ran")
+    parser.add_argument("--report", help="also write the error report to this file as JSON")
+    args = parser.parse_args(argv)
+
+    merged, report = merge_shards(args.partials, args.expected_rows)
+    engine.export_results(merged, args.output)
+
+    for shard in report["shards"]:
+        print(f"{shard['path']}: {shard['rows']} rows, {shard['failed']} failed")
+        for error in shard["errors"]:
+            print(f"  row {error['Row_Index']}: {error['error_type']}: {error['error']}")
+    if report["duplicates"]:
+        print(f"Rows in more than one partial (first copy kept): {report['duplicates']}")
+    if report["missing"]:
+        print(f"Rows missing from every partial: {report['missing']}")
+    print(f"Merged {len(merged)} rows into {args.output}")
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    failed = sum(shard["failed"] for shard in report["shards"])
+    return 1 if failed or report["missing"] or report["duplicates"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,269 @@
+# Local stand-in for an Azure OpenAI deployment, for testing and benchmarking the submission
+# engine without spending money against a live endpoint.
+# Serves chat completions plus the files/batches endpoints used by the Batch API mode. Replies are
+# built from the prompt's Output_Fields line, so any prompt made with query_formatter.py works.
+# Latency, 429/500 injection, malformed JSON, list replies and content filter refusals (of the prompt or
+# of the reply) are configurable.
+#
+# Run standalone:
+#   python mock_azure_server.py --port 8765 --latency-ms 300 --jitter-ms 200 --rate-429 0.05
+#   AZURE_OPENAI_ENDPOINT=http://127.0.0.1:8765/ python submit_cli.py --input ... --prompt ... --output ...
+
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockSettings:
+    def __init__(self, latency_ms=200, jitter_ms=100, rate_429=0.0, rate_500=0.0, rate_malformed=0.0,
+                 tokens_per_minute=1000000, requests_per_minute=10000, structured_outputs=True, context_tokens=0,
+                 rate_list=0.0, rate_content_filter=0.0, rate_filtered_reply=0.0, seed=None):
+        self.latency_ms = latency_ms  # median reply latency
+        self.jitter_ms = jitter_ms  # spread of the (log-normal) latency distribution
+        self.rate_429 = rate_429  # fraction of requests answered with 429 + retry-after-ms
+        self.rate_500 = rate_500  # fraction of requests answered with 500
+        self.rate_malformed = rate_malformed  # fraction of replies whose content is not valid JSON
+        self.tokens_per_minute = tokens_per_minute  # reported through x-ratelimit-remaining-tokens
+        self.requests_per_minute = requests_per_minute
+        self.structured_outputs = structured_outputs  # False: reject response_format like older models do
+        self.context_tokens = context_tokens  # reject longer requests as exceeding the context (0 = no limit)
+        self.rate_list = rate_list  # fraction of replies that are a JSON list instead of an object
+        self.rate_content_filter = rate_content_filter  # fraction of requests refused by the content filter
+        self.rate_filtered_reply = rate_filtered_reply  # fraction of replies withheld by the output-side filter
+        self.random = random.Random(seed)
+
+    def latency(self):
+        if self.latency_ms <= 0:
+            return 0.0
+        sigma = self.jitter_ms / self.latency_ms if self.jitter_ms else 0.0
+        # Capped: with jitter much larger than the median the tail would otherwise run to hours
+        return min(self.latency_ms * self.random.lognormvariate(0, sigma), self.latency_ms + 10 * self.jitter_ms) / 1000
+
+
+def count_tokens(text):
+    return len(text) // 4 + 1
+
+
+def fake_answer(system_prompt, user_content):
+    # One JSON object per row with every Output_Fields item filled with a value derived from the row
+    match = re.search(r"Output_Fields will be \[(.*?)\]", system_prompt)
+    fields = [field.strip() for field in match.group(1).split(",")] if match else ["Answer"]
+    cells = user_content.strip(" .").split("\t")
+    return {field: f"{field} for {cells[0]}" for field in fields}
+
+
+def fake_completion(body):
+    messages = body.get("messages", [])
+    system_prompt = next((m["content"] for m in messages if m["role"] == "system"), "")
+    user_content = next((m["content"] for m in messages if m["role"] == "user"), "")
+    structured = body.get("response_format", {}).get("type") == "json_schema"
+    if "several rows" in system_prompt:  # packed request: one line per row, each led by its row ID
+        answer = []
+        for line in user_content.strip().split("\n"):
+            row_id, _, row = line.partition("\t")
+            answer.append(dict(row_id=row_id, **fake_answer(system_prompt, row)))
+        if structured:
+            answer = {"rows": answer}  # structured outputs need an object at the top level
+    else:
+        answer = fake_answer(system_prompt, user_content)
+    # Free-form replies come in a code fence, as gpt models tend to write them
+    content = json.dumps(answer) if structured else "```json\n" + json.dumps(answer) + "\n```"
+    prompt_tokens = sum(count_tokens(m["content"]) for m in messages)
+    completion_tokens = count_tokens(content)
+    return {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "mock"),
+        "choices": [{"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant", "content": content}}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+
+class MockAzureServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # the default backlog of 5 drops connections under benchmark concurrency
+
+
+class MockAzureHandler(BaseHTTPRequestHandler):
+    server_version = "MockAzureOpenAI/1.0"
+    protocol_version = "HTTP/1.1"  # keep-alive, as with the real endpoint
+
+    def log_message(self, format, *args):
+        pass  # keep benchmark output clean
+
+    def send_json(self, status, payload, headers=None):
+        with self.server.stats_lock:
+            self.server.stats[status] = self.server.stats.get(status, 0) + 1
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length)
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        if path.endswith("/chat/completions"):
+            self.chat_completions(json.loads(self.read_body()))
+        elif path.endswith("/files"):
+            self.upload_file()
+        elif path.endswith("/batches"):
+            self.create_batch(json.loads(self.read_body()))
+        else:
+            self.send_json(404, {"error": {"code": "404", "message": f"No mock for POST {path}"}})
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        state = self.server.state
+        match = re.search(r"/files/([^/]+)/content$", path)
+        if match and match.group(1) in state["files"]:
+            data = state["files"][match.group(1)]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        match = re.search(r"/batches/([^/]+)$", path)
+        if match and match.group(1) in state["batches"]:
+            self.send_json(200, state["batches"][match.group(1)])
+            return
+        self.send_json(404, {"error": {"code": "404", "message": f"No mock for GET {path}"}})
+
+    def chat_completions(self, body):
+        settings = self.server.settings
+        headers = {"x-ratelimit-remaining-tokens": settings.tokens_per_minute,
+                   "x-ratelimit-remaining-requests": settings.requests_per_minute}
+        time.sleep(settings.latency())
+        if "response_format" in body and not settings.structured_outputs:
+            self.send_json(400, {"error": {"code": "BadRequest", "param": "response_format",
+                                           "message": "Invalid parameter: 'response_format' of type 'json_schema' "
+                                                      "is not supported with this model (mock)"}})
+            return
+        prompt_tokens = sum(count_tokens(m["content"]) for m in body.get("messages", []))
+        if settings.context_tokens and prompt_tokens > settings.context_tokens:
+            self.send_json(400, {"error": {"code": "context_length_exceeded", "param": "messages",
+                                           "message": f"This model's maximum context length is {settings.context_tokens} "
+                                                      f"tokens. However, your messages resulted in {prompt_tokens} "
+                                                      "tokens (mock)"}})
+            return
+        roll = settings.random.random()
+        if settings.random.random() < settings.rate_content_filter:
+            self.send_json(400, {"error": {"code": "content_filter", "param": "prompt", "status": 400,
+                                           "message": "The response was filtered due to the prompt triggering Azure "
+                                                      "OpenAI's content management policy (mock)"}}, headers)
+            return
+        if roll < settings.rate_429:
+            headers["retry-after-ms"] = 500
+            self.send_json(429, {"error": {"code": "429", "message": "Rate limit exceeded (mock)"}}, headers)
+            return
+        if roll < settings.rate_429 + settings.rate_500:
+            self.send_json(500, {"error": {"code": "500", "message": "Internal server error (mock)"}}, headers)
+            return
+        completion = fake_completion(body)
+        if roll < settings.rate_429 + settings.rate_500 + settings.rate_malformed:
+            completion["choices"][0]["message"]["content"] = "Sure! Here is the JSON: {\"Eligibility\": "
+        elif roll < settings.rate_429 + settings.rate_500 + settings.rate_malformed + settings.rate_list:
+            message = completion["choices"][0]["message"]
+            message["content"] = json.dumps([json.loads(message["content"].strip("`").removeprefix("json"))])
+        if settings.random.random() < settings.rate_filtered_reply:
+            completion["choices"][0]["finish_reason"] = "content_filter"
+            completion["choices"][0]["message"]["content"] = None
+        self.send_json(200, completion, headers)
+
+    def upload_file(self):
+        # The SDK uploads multipart/form-data; the JSONL content is the part named 'file'
+        body = self.read_body()
+        boundary = self.headers["Content-Type"].split("boundary=")[-1].encode()
+        content = b""
+        for part in body.split(b"--" + boundary):
+            head, _, data = part.partition(b"\r\n\r\n")
+            if b'name="file"' in head:
+                content = data.rstrip(b"\r\n")
+        file_id = f"file-{next(self.server.ids)}"
+        self.server.state["files"][file_id] = content
+        self.send_json(200, {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                             "filename": "requests.jsonl", "purpose": "batch", "status": "processed"})
+
+    def create_batch(self, body):
+        # Batch jobs complete immediately: every request is answered as a chat completion would be
+        state = self.server.state
+        lines = []
+        for line in state["files"].get(body["input_file_id"], b"").decode("utf-8").splitlines():
+            if line.strip():
+                request = json.loads(line)
+                lines.append(json.dumps({"custom_id": request["custom_id"],
+                                         "response": {"status_code": 200, "body": fake_completion(request["body"])},
+                                         "error": None}))
+        output_id = f"file-{next(self.server.ids)}"
+        state["files"][output_id] = ("\n".join(lines) + "\n").encode("utf-8")
+        batch_id = f"batch-{next(self.server.ids)}"
+        state["batches"][batch_id] = {
+            "id": batch_id, "object": "batch", "endpoint": body["endpoint"], "input_file_id": body["input_file_id"],
+            "completion_window": body["completion_window"], "status": "completed", "created_at": int(time.time()),
+            "output_file_id": output_id, "error_file_id": None,
+            "request_counts": {"total": len(lines), "completed": len(lines), "failed": 0},
+        }
+        self.send_json(200, state["batches"][batch_id])
+
+
+def start_mock_server(settings=None, host="127.0.0.1", port=0):
+    # Starts the server on a background thread; returns it (server.server_address has the port)
+    server = MockAzureServer((host, port), MockAzureHandler)
+    server.settings = settings or MockSettings()
+    server.state = {"files": {}, "batches": {}}
+    server.ids = itertools.count(1)
+    server.stats = {}  # HTTP status -> number of responses sent
+    server.stats_lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for an Azure OpenAI chat completions deployment.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=200)
+    parser.add_argument("--jitter-ms", type=float, default=100)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-500", type=float, default=0.0)
+    parser.add_argument("--rate-malformed", type=float, default=0.0)
+    parser.add_argument("--rate-list", type=float, default=0.0, help="fraction of replies that are a JSON list")
+    parser.add_argument("--rate-content-filter", type=float, default=0.0,
+                        help="fraction of requests refused by the content filter")
+    parser.add_argument("--rate-filtered-reply", type=float, default=0.0,
+                        help="fraction of replies withheld by the output-side content filter (200, no content)")
+    parser.add_argument("--no-structured-outputs", action="store_true",
+                        help="reject response_format, like models without structured outputs")
+    parser.add_argument("--context-tokens", type=int, default=0,
+                        help="reject requests longer than this many tokens as exceeding the context (default: no limit)")
+    args = parser.parse_args()
+    settings = MockSettings(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, rate_429=args.rate_429,
+                            rate_500=args.rate_500, rate_malformed=args.rate_malformed,
+                            structured_outputs=not args.no_structured_outputs, context_tokens=args.context_tokens,
+                            rate_list=args.rate_list, rate_content_filter=args.rate_content_filter,
+                            rate_filtered_reply=args.rate_filtered_reply)
+    server = start_mock_server(settings, args.host, args.port)
+    print(f"Mock Azure OpenAI endpoint listening on http://{args.host}:{server.server_address[1]}/")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,9 +5,16 @@
 
 import tkinter as tk
 from tkinter import scrolledtext, messagebox, ttk, filedialog
-import pandas as pd
+import json
 import os
 
+from column_profile import PREVIEW_ROWS, ColumnProfiler, describe_profile, read_preview
+from text_encoding import detect_encoding
+
+POLL_MS = 100  # how often a column profile running in the background is checked for completion
+profiler = None  # ColumnProfiler of the loaded file
+profiled_column = None  # column whose profile is shown (or being computed)
+
 
 def load_file():
     global inputfile
@@ -19,12 +26,14 @@ def load_file():
         try:
             ext = os.path.splitext(inputfile)[1].lower()
             if ext == '.txt':
-                df = pd.read_csv(inputfile, sep='\t', encoding='Windows-1252')  # Tab-delimited text
+                encoding = detect_encoding(inputfile)  # Tab-delimited text: as the batch submitter reads it
             elif ext in ['.xls', '.xlsx']:
-                df = pd.read_excel(inputfile)  # Excel file
+                encoding = None  # Excel file
             else:
                 messagebox.showerror("Error", "Unsupported file type selected.")
                 return
+            df = read_preview(inputfile, encoding)  # only the first rows: enough to write the prompt
+            start_profiler(inputfile, encoding)
             display_dataframe(df)
             show_explanation_fields()  # Show explanation fields after loading data
         except Exception as e:
@@ -35,7 +44,9 @@ def load_test_data():
     global inputfile
     inputfile = 'test_data.txt'
     try:
-        df = pd.read_csv(inputfile, sep='\t')
+        encoding = detect_encoding(inputfile)
+        df = read_preview(inputfile, encoding)
+        start_profiler(inputfile, encoding)
         display_dataframe(df)
         show_explanation_fields()  # Show explanation fields after loading test data
     except Exception as e:
@@ -54,10 +65,12 @@ def display_dataframe(df):
         tree.heading(col, text=col)
         tree.column(col, anchor='center')
 
-    for index, row in df.iterrows():
-        tree.insert("", "end", values=list(row))
+    for row in df.head(PREVIEW_ROWS).itertuples(index=False, name=None):
+        tree.insert("", "end", values=row)
 
     tree.pack(expand=True, fill='both')
+    tk.Label(frame_data, text=f"Showing the first {len(df)} rows. Click a field's explanation box below to profile "
+                              "that column over the whole file.").pack()
 
     # Clear previous text boxes for explanation
     for widget in frame_explain.winfo_children():
@@ -78,10 +91,41 @@ def display_dataframe(df):
         text_box = tk.Entry(frame_row, width=80)
         text_box.insert(0, column)  # Initialize with column header
         text_box.pack(side=tk.LEFT)
+        text_box.bind("<FocusIn>", lambda event, column=column: show_profile(column))
 
         input_fields_dict[column] = text_box
 
 
+def start_profiler(path, encoding):
+    global profiler
+    if profiler is not None:
+        profiler.close()
+    profiler = ColumnProfiler(path, encoding)
+    label_profile.config(text="")
+
+
+def show_profile(column):
+    # Profiles the focused column in the background and shows the result when it is ready
+    global profiled_column
+    if profiler is None:
+        return
+    future = profiler.profile(column)
+    label_profile.config(text=f"Profiling {column}...")
+    profiled_column = column
+
+    def poll():
+        if profiled_column != column:
+            return  # another field has been focused since
+        if not future.done():
+            root.after(POLL_MS, poll)
+        elif future.exception() is not None:
+            label_profile.config(text=f"Could not profile {column}: {future.exception()}")
+        else:
+            label_profile.config(text=describe_profile(future.result()))
+
+    poll()
+
+
 def show_explanation_fields():
     frame_explain.pack(pady=10)  # Show the explanation frame
 
@@ -118,12 +162,19 @@ def finalize_output_fields():
 def assemble_prompt():
     global assembled_prompt
     global role, problem, input_fields_dict, output_fields_dict  # Declare as global
-    x = len(input_fields_dict)
+    # Columns whose description was cleared are left out of the prompt, and the submitter does not send them
+    described_fields = {k: v.get().strip() for k, v in input_fields_dict.items() if v.get().strip()}
+    x = len(described_fields)
     assembled_prompt = f"You will act as a {role}\n"
     assembled_prompt += f"I will provide a row of tab-delimited data containing {x} elements, with the following field names and descriptions:\n"
 
-    for k, v in input_fields_dict.items():
-        assembled_prompt += f"{k}: {v.get()}\n"
+    # Machine-readable list of the columns to send, in this order (read by the batch submitter). Written as a
+    # JSON array so column names containing commas survive the round trip.
+    input_fields_list = json.dumps(list(described_fields.keys()), ensure_ascii=False)
+    assembled_prompt += f"Input_Fields will be {input_fields_list}\n"
+
+    for k, v in described_fields.items():
+        assembled_prompt += f"{k}: {v}\n"
 
     assembled_prompt += f"The problem I would like you to address is:\n{problem}\n"
     assembled_prompt += "Analyze these data and report the following items in JSON format. Do not add any additional text or commentary:\n"
@@ -159,6 +210,7 @@ def show_help():
     help_text = (
         "Tab-delimited text data can be imported with the load buttons. "
         "Then Provide any detailed explanations so that the AI will understand your data fields. "
+        "Clear the explanation of any column the AI does not need; it will then not be sent with each row. "
         "Guide the AI's analysis strategy by suggesting the role of a human who might normally perform this analysis. "
         "Describe the problem you want the AI to solve in detail. "
         "Then specify the output fields that you want the AI to capture, providing a detailed explanation for each one. "
@@ -232,6 +284,10 @@ button_complete = tk.Button(frame_explain, text="Data Explanation Complete",
                             bg='orange')
 button_complete.pack(side=tk.LEFT, padx=(10, 0))
 
+# Profile of the column whose explanation box has focus
+label_profile = tk.Label(scrollable_content, text="", wraplength=1400, justify=tk.LEFT)
+label_profile.pack(pady=5)
+
 # Role input section
 frame_role = tk.Frame(scrollable_content)
 frame_role.pack(pady=10)
@@ -0,0 +1,108 @@
+# Pacing and retry scheduling for Azure OpenAI chat completions.
+# Submissions draw from two token buckets sized from the deployment's tokens-per-minute (TPM)
+# and requests-per-minute (RPM) quota. The buckets are corrected from the x-ratelimit-remaining-*
+# headers Azure returns on every reply (and sized from the first of them when no quota is configured),
+# and a 429 'retry-after' pauses all workers at once, so throughput sits just under the quota ceiling
+# instead of alternating between crashes and idle time.
+
+import random
+import threading
+import time
+
+from openai import RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+
+# Failures worth retrying: throttling, timeouts, dropped connections and 5xx from the service
+# (APITimeoutError is a subclass of APIConnectionError; listed for readability)
+TRANSIENT_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+
+def estimate_tokens(text):
+    # Rough local estimate (about 4 characters per token for English text); only used for pacing
+    return len(text) // 4 + 1
+
+
+def retry_after_seconds(headers):
+    # Azure sends retry-after-ms and/or retry-after (seconds) on 429 responses
+    if not headers:
+        return None
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = headers.get(name)
+        if value is None:
+            continue
+        try:
+            return max(float(value) * scale, 0.0)
+        except ValueError:
+            continue
+    return None
+
+
+class RateLimiter:
+    def __init__(self, tokens_per_minute=0, requests_per_minute=0, headroom=0.9):
+        # A budget of 0 means 'unknown': it is taken from the first x-ratelimit-remaining-* header for that
+        # dimension, and until then there is no local pacing for it (429s still pause the run)
+        self.headroom = headroom
+        self.token_capacity = tokens_per_minute * headroom
+        self.request_capacity = requests_per_minute * headroom
+        self.tokens = self.token_capacity
+        self.requests = self.request_capacity
+        self.paused_until = 0.0
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.tokens = min(self.token_capacity, self.tokens + elapsed * self.token_capacity / 60)
+        self.requests = min(self.request_capacity, self.requests + elapsed * self.request_capacity / 60)
+
+    def acquire(self, tokens):
+        # Block the calling worker until the request fits in both budgets
+        tokens = min(tokens, self.token_capacity)  # a single oversized request must still be able to go
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait_for = self.paused_until - now
+                if wait_for <= 0:
+                    token_short = tokens - self.tokens if self.token_capacity else 0
+                    request_short = 1 - self.requests if self.request_capacity else 0
+                    if token_short <= 0 and request_short <= 0:
+                        self.tokens -= tokens if self.token_capacity else 0
+                        self.requests -= 1 if self.request_capacity else 0
+                        return
+                    wait_for = max(token_short * 60 / self.token_capacity if token_short > 0 else 0,
+                                   request_short * 60 / self.request_capacity if request_short > 0 else 0)
+            time.sleep(wait_for)
+
+    def pause(self, seconds):
+        # Hold back every worker, not just the one that was throttled
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def update_from_headers(self, headers):
+        # The service's view of the remaining budget wins whenever it is lower than ours. A dimension with no
+        # configured quota is sized from the first remaining value seen, the closest thing to the quota there is.
+        if not headers:
+            return
+        with self.lock:
+            for name, attr, capacity_attr in (("x-ratelimit-remaining-tokens", "tokens", "token_capacity"),
+                                              ("x-ratelimit-remaining-requests", "requests", "request_capacity")):
+                value = headers.get(name)
+                if value is None:
+                    continue
+                try:
+                    remaining = float(value)
+                except ValueError:
+                    continue
+                if not getattr(self, capacity_attr):
+                    if remaining <= 0:
+                        continue  # nothing to size the bucket from; the 429 that follows pauses the run
+                    setattr(self, capacity_attr, remaining * self.headroom)
+                    setattr(self, attr, getattr(self, capacity_attr))
+                setattr(self, attr, min(getattr(self, attr), remaining))
+
+
+def backoff_delay(attempt, base_delay=1.0, max_delay=60.0):
+    # Exponential backoff with full jitter so that workers throttled together do not retry together
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
@@ -0,0 +1,89 @@
+# Disk-backed cache of AI replies so that re-running a table (after a crash, after tweaking the
+# export, or with duplicate rows) does not pay for rows that have already been answered.
+# Entries are keyed by hashes of (model deployment, prompt) and of the row text, and stored in SQLite.
+# When the stored replies grow beyond max_bytes the least recently used entries are evicted.
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+def prompt_digest(model, assembled_prompt):
+    # Computed once per run; combined with each row's hash by row_cache_key
+    digest = hashlib.sha256()
+    for part in (model, assembled_prompt):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")  # separator so ('ab', 'c') and ('a', 'bc') differ
+    return digest.hexdigest()
+
+
+def row_cache_key(prompt_key, row_hash):
+    # row_hash is the SHA-256 hex digest of the row text (see submit_engine.serialize_rows)
+    return f"{prompt_key}:{row_hash}"
+
+
+def cache_key(model, assembled_prompt, row_prep):
+    return row_cache_key(prompt_digest(model, assembled_prompt), hashlib.sha256(row_prep.encode("utf-8")).hexdigest())
+
+
+class ResponseCache:
+    def __init__(self, path, max_bytes=500 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # Write-ahead logging without a sync per commit: a cache entry lost in a power cut is just a miss
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                       key TEXT PRIMARY KEY,
+                                       response TEXT NOT NULL,
+                                       size INTEGER NOT NULL,
+                                       last_used REAL NOT NULL)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.connection.commit()
+        self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key):
+        # Returns the decoded reply, or None on a miss
+        with self.lock:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.connection.commit()
+        return json.loads(row[0])
+
+    def put(self, key, results_json):
+        response = json.dumps(results_json)
+        size = len(response.encode("utf-8"))
+        with self.lock:
+            old = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.total_bytes -= old[0] if old else 0
+            self.connection.execute("INSERT OR REPLACE INTO responses (key, response, size, last_used) "
+                                    "VALUES (?, ?, ?, ?)", (key, response, size, time.time()))
+            self.total_bytes += size
+            self._evict()
+            self.connection.commit()
+
+    def _evict(self):
+        # Drop least recently used entries until the cache fits again
+        while self.total_bytes > self.max_bytes:
+            rows = self.connection.execute("SELECT key, size FROM responses ORDER BY last_used LIMIT 100").fetchall()
+            if not rows:
+                self.total_bytes = 0
+                return
+            for key, size in rows:
+                self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    return
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
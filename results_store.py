@@ -0,0 +1,136 @@
+# Columnar results store: finished rows are appended to a Parquet file one row group at a time while
+# a run progresses, and Excel exports are streamed from it a batch at a time, so neither the run nor
+# the export has to hold the whole results table in memory.
+# Needs pyarrow (pip install pyarrow). Excel exports use xlsxwriter's constant-memory mode when it is
+# installed (pip install xlsxwriter), and openpyxl's write-only mode (pandas' default Excel engine) otherwise.
+# Every column is stored as text, as the results are in the exported files.
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+try:
+    import openpyxl
+    from openpyxl.cell import WriteOnlyCell
+except ImportError:
+    openpyxl = None
+
+EXPORT_BATCH_ROWS = 10000  # rows read from the store at a time when exporting
+EXCEL_MAX_ROWS = 1048576  # including the header row
+
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError("Parquet results need pyarrow: pip install pyarrow")
+
+
+def text_columns(frame, columns):
+    # Column name -> list of str or None (for missing values), in the given column order
+    frame = frame.reindex(columns=columns)
+    return {column: frame[column].astype(str).where(frame[column].notna(), None).tolist() for column in columns}
+
+
+class ResultsStore:
+    def __init__(self, path, columns):
+        require_pyarrow()
+        self.path = path
+        self.columns = list(columns)
+        self.schema = pa.schema([(column, pa.string()) for column in self.columns])
+        self.writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+        self.rows = 0
+
+    def append(self, frame):
+        # Writes frame's rows as one row group; columns missing from frame are left empty and extra ones dropped
+        if len(frame) == 0:
+            return
+        table = pa.Table.from_pydict(text_columns(frame, self.columns), schema=self.schema)
+        self.writer.write_table(table)
+        self.rows += len(frame)
+
+    def close(self):
+        self.writer.close()
+
+
+def write_store(df, path, batch_rows=EXPORT_BATCH_ROWS):
+    # Writes an in-memory table to a new store
+    store = ResultsStore(path, df.columns)
+    try:
+        for start in range(0, len(df), batch_rows):
+            store.append(df.iloc[start:start + batch_rows])
+    finally:
+        store.close()
+
+
+def iter_store(path, batch_rows=EXPORT_BATCH_ROWS):
+    # Yields the stored results as DataFrames of at most batch_rows rows
+    require_pyarrow()
+    parquet = pq.ParquetFile(path)
+    for batch in parquet.iter_batches(batch_size=batch_rows):
+        yield batch.to_pandas()
+
+
+def read_store(path):
+    # Whole store as a DataFrame of text, missing values as empty strings (like read_csv(keep_default_na=False))
+    require_pyarrow()
+    return pq.read_table(path).to_pandas().fillna("")
+
+
+def store_columns(path):
+    require_pyarrow()
+    return pq.ParquetFile(path).schema_arrow.names
+
+
+def frame_rows(columns, frames):
+    # Yields the rows of the frames as lists of values in the given column order, missing values as ""
+    row = 1  # the header row
+    for frame in frames:
+        if row + len(frame) > EXCEL_MAX_ROWS:
+            raise ValueError(f"Too many rows for one Excel sheet ({EXCEL_MAX_ROWS - 1} at most); "
+                             "export as tab-delimited text instead")
+        yield from frame.reindex(columns=columns).astype(object).fillna("").values.tolist()
+        row += len(frame)
+
+
+def text_cell(worksheet, value):
+    # openpyxl would store text starting with '=' as a formula; results are always written as text
+    if not (isinstance(value, str) and value.startswith("=")):
+        return value
+    cell = WriteOnlyCell(worksheet, value=value)
+    cell.data_type = "s"
+    return cell
+
+
+def write_xlsx(columns, frames, file_path):
+    # Writes the frames (an iterable of DataFrames with these columns) to one Excel sheet. Each row is
+    # written to disk as it comes (xlsxwriter's constant-memory mode, or openpyxl's write-only mode), so
+    # memory use does not grow with the table.
+    if xlsxwriter is None:
+        if openpyxl is None:
+            raise ImportError("Excel results need xlsxwriter or openpyxl: pip install xlsxwriter")
+        workbook = openpyxl.Workbook(write_only=True)
+        worksheet = workbook.create_sheet()
+        worksheet.append(list(columns))
+        for values in frame_rows(columns, frames):
+            worksheet.append([text_cell(worksheet, value) for value in values])
+        workbook.save(file_path)
+        return
+    workbook = xlsxwriter.Workbook(file_path, {"constant_memory": True, "strings_to_numbers": False,
+                                               "strings_to_formulas": False, "strings_to_urls": False})
+    try:
+        worksheet = workbook.add_worksheet()
+        worksheet.write_row(0, 0, columns)
+        for row, values in enumerate(frame_rows(columns, frames), start=1):
+            worksheet.write_row(row, 0, values)
+    finally:
+        workbook.close()
+
+
+def export_store_to_xlsx(path, file_path):
+    write_xlsx(store_columns(path), iter_store(path), file_path)
@@ -0,0 +1,74 @@
+# Multi-row packing: several table rows are sent in one chat completion so the (long) system
+# prompt is paid for once per request rather than once per row. Each row is tagged with a short
+# row ID and the model is asked for a JSON array holding one object per row ID; the reply is then
+# demultiplexed back to the rows. Rows missing from (or malformed in) the reply are returned to
+# the caller so they can be retried one at a time.
+
+import json
+
+from rate_limiter import estimate_tokens
+from structured_output import extract_json
+
+# Appended to the prompt file's text when more than one row is sent per request
+PACKING_INSTRUCTIONS = """
+The data below contain several rows. Each line starts with a row ID, followed by a tab and then the tab-delimited row.
+Analyze each row independently. Report a JSON array containing one object per row. Each object must contain a "row_id" item
+holding the row ID exactly as given, plus the requested Output_Fields for that row. Do not add any additional text or commentary.
+"""
+
+
+def pack_rows(rows, max_rows, token_budget, completion_tokens_per_row):
+    # rows: iterable of (index, row_prep). Yields lists of rows whose combined input plus expected
+    # output stays within token_budget. A single row larger than the budget is sent on its own.
+    batch = []
+    batch_tokens = 0
+    for index, row_prep in rows:
+        row_tokens = estimate_tokens(row_prep) + completion_tokens_per_row
+        if batch and (len(batch) >= max_rows or batch_tokens + row_tokens > token_budget):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append((index, row_prep))
+        batch_tokens += row_tokens
+    if batch:
+        yield batch
+
+
+def build_packed_query(batch):
+    # Row IDs are positions within the request (1, 2, ...) to keep them short and unambiguous
+    return "\n".join(f"{row_id}\t{row_prep}" for row_id, (index, row_prep) in enumerate(batch, start=1))
+
+
+def unpack_results(results_json, batch):
+    # Returns (results, missing): results maps df index -> result dict, missing lists the
+    # (index, row_prep) pairs the reply did not answer properly
+    by_row_id = {}
+    if isinstance(results_json, dict) and isinstance(results_json.get("rows"), list):
+        results_json = results_json["rows"]  # structured outputs wrap the array in an object
+    if isinstance(results_json, list):
+        for item in results_json:
+            if isinstance(item, dict) and "row_id" in item:
+                by_row_id[str(item["row_id"]).strip()] = {k: v for k, v in item.items() if k != "row_id"}
+    elif isinstance(results_json, dict):  # tolerate {"1": {...}, "2": {...}}
+        for key, value in results_json.items():
+            if isinstance(value, dict):
+                by_row_id[str(key).strip()] = value
+
+    results = {}
+    missing = []
+    for row_id, (index, row_prep) in enumerate(batch, start=1):
+        result = by_row_id.get(str(row_id))
+        if result:
+            results[index] = result
+        else:
+            missing.append((index, row_prep))
+    return results, missing
+
+
+def parse_packed_reply(content, batch):
+    # Like unpack_results, but every row is treated as missing if the reply holds no valid JSON
+    try:
+        results_json = extract_json(content)
+    except json.JSONDecodeError:
+        return {}, list(batch)
+    return unpack_results(results_json, batch)
@@ -0,0 +1,70 @@
+# Append-only journal of completed rows so that a long run survives a crash.
+# Each finished row (answered or failed) is written as one JSON line and flushed immediately.
+# The journal file name carries a fingerprint of the input file, prompt and model deployment (both
+# deployments of a cascade), so a restart with the same inputs finds it and only the missing or
+# failed rows are re-sent.
+# A run that finishes (not cancelled or stopped by its budget) deletes its journal, so only
+# interrupted runs are offered for resuming; rows that failed are kept in the dead-letter store.
+
+import hashlib
+import json
+import os
+
+
+def run_fingerprint(inputfile, assembled_prompt, model):
+    # The input file is identified by path, size and modification time rather than by hashing
+    # its contents, which would mean reading a multi-GB export before the run can start
+    stat = os.stat(inputfile)
+    digest = hashlib.sha256()
+    for part in (os.path.abspath(inputfile), str(stat.st_size), str(stat.st_mtime_ns), model, assembled_prompt):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+def journal_path(inputfile, assembled_prompt, model, scope=""):
+    # scope tells apart runs over different parts of the same file (e.g. the shards of a sharded run)
+    fingerprint = run_fingerprint(inputfile, assembled_prompt, model)
+    return f"{inputfile}.{fingerprint}.{scope}.journal.jsonl" if scope else f"{inputfile}.{fingerprint}.journal.jsonl"
+
+
+def load_journal(path):
+    # Returns {row index as text: latest record}; a later line for the same row wins, so a row
+    # that failed and then succeeded on resume counts as done. A torn last line is ignored.
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            records[record["index"]] = record
+    return records
+
+
+class RunJournal:
+    def __init__(self, path, resume=True):
+        self.path = path
+        self.file = open(path, "a" if resume else "w", encoding="utf-8")
+
+    def record_result(self, index, results_json):
+        self._append({"index": str(index), "status": "ok", "result": results_json})
+
+    def record_error(self, index, error):
+        self._append({"index": str(index), "status": "error", "error_type": type(error).__name__,
+                      "error": str(error)})
+
+    def _append(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()  # a crash after this point cannot lose the row
+
+    def close(self):
+        self.file.close()
+
+    def discard(self):
+        # Closes and deletes the journal of a run that finished: there is nothing left to resume
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
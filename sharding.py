@@ -0,0 +1,87 @@
+# Sharded runs: a job is split into N shards that separate processes or machines (each with its own
+# credentials and quota) run independently, and merge_shards.py reassembles the partial results.
+# 'range' shards are N contiguous blocks of rows; 'hash' shards assign each row by a hash of its
+# content, so the split does not depend on row order and identical rows land on the same shard.
+# Partial results carry a Row_Index column (the row's position in the input table) so the merge
+# can restore the original order, and failed rows are listed in a '<partial>.errors.jsonl' file.
+
+import json
+import os
+
+import pandas as pd
+
+from incremental_run import read_results
+
+SHARD_MODES = ("range", "hash")
+ROW_INDEX_COLUMN = "Row_Index"
+
+
+def parse_shard(text):
+    # 'K/N' -> (K, N), shards numbered from 0
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise ValueError(f"Shard must be given as K/N (e.g. 0/4), not {text!r}")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Shard {text}: K must be between 0 and N-1")
+    return index, count
+
+
+def shard_label(index, count, mode):
+    return f"shard{index}of{count}-{mode}"
+
+
+def range_bounds(index, count, total_rows):
+    # (start, stop) of range shard index out of count over total_rows rows
+    return index * total_rows // count, (index + 1) * total_rows // count
+
+
+def in_hash_shard(row_hashes, index, count):
+    # row_hashes: SHA-256 hex digests of the rows' text (see submit_engine.serialize_rows)
+    return [int(row_hash[:16], 16) % count == index for row_hash in row_hashes]
+
+
+def error_report_path(partial_path):
+    return partial_path + ".errors.jsonl"
+
+
+def write_error_report(partial_path, failures):
+    # failures: {row position: exception}
+    with open(error_report_path(partial_path), "w", encoding="utf-8") as file:
+        for index, error in sorted(failures.items()):
+            file.write(json.dumps({ROW_INDEX_COLUMN: int(index), "error_type": type(error).__name__,
+                                   "error": str(error)}) + "\n")
+
+
+def read_error_report(partial_path):
+    path = error_report_path(partial_path)
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def merge_shards(paths, expected_rows=None):
+    # Returns (merged DataFrame in input order without Row_Index, report). The report has one entry
+    # per partial file (rows, failed rows and their errors) plus rows found in more than one partial
+    # and rows missing from all of them (gaps in Row_Index, or up to expected_rows if given).
+    parts = []
+    report = {"shards": [], "duplicates": [], "missing": []}
+    for path in paths:
+        part = read_results(path)
+        if ROW_INDEX_COLUMN not in part.columns:
+            raise ValueError(f"{path} has no {ROW_INDEX_COLUMN} column; was it written by a sharded run?")
+        part[ROW_INDEX_COLUMN] = part[ROW_INDEX_COLUMN].astype(int)
+        errors = read_error_report(path)
+        report["shards"].append({"path": path, "rows": len(part), "failed": len(errors), "errors": errors})
+        parts.append(part)
+    if not parts:
+        raise ValueError("No partial results to merge")
+
+    merged = pd.concat(parts, ignore_index=True)
+    duplicated = merged[ROW_INDEX_COLUMN].duplicated(keep="first")
+    report["duplicates"] = sorted(set(merged.loc[duplicated, ROW_INDEX_COLUMN].tolist()))
+    merged = merged[~duplicated].sort_values(ROW_INDEX_COLUMN, kind="stable")
+    total_rows = expected_rows if expected_rows is not None else (merged[ROW_INDEX_COLUMN].max() + 1 if len(merged) else 0)
+    report["missing"] = sorted(set(range(total_rows)) - set(merged[ROW_INDEX_COLUMN].tolist()))
+    return merged.drop(columns=[ROW_INDEX_COLUMN]).reset_index(drop=True), report
@@ -0,0 +1,77 @@
+# Structured outputs: the prompt's 'Output_Fields will be [...]' items are compiled into a JSON schema
+# and sent as response_format, so models that support structured outputs (gpt-4o, gpt-4o-mini 2024-07-18
+# and later) can only reply with exactly those fields and a reply never needs to be re-sent for bad JSON.
+# For models without structured outputs, extract_json pulls the JSON out of whatever the model wrote
+# (code fences, leading chatter, trailing commentary).
+
+import functools
+import json
+import re
+
+
+def row_schema(fields):
+    # Every field is a string: results are stored as text in the table anyway
+    return {
+        "type": "object",
+        "properties": {field: {"type": "string"} for field in fields},
+        "required": list(fields),
+        "additionalProperties": False,
+    }
+
+
+@functools.lru_cache(maxsize=32)
+def response_format(fields, packed=False):
+    # fields: tuple of Output_Fields names. Structured outputs need an object at the top level, so a
+    # packed request (several rows) is answered as {"rows": [{"row_id": ..., <fields>}, ...]}.
+    if not fields:
+        return None
+    if packed:
+        item = row_schema(("row_id",) + tuple(fields))
+        schema = {"type": "object", "properties": {"rows": {"type": "array", "items": item}},
+                  "required": ["rows"], "additionalProperties": False}
+        name = "output_rows"
+    else:
+        schema = row_schema(fields)
+        name = "output_fields"
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+
+def is_unsupported_error(error):
+    # True if a BadRequestError says the deployment does not accept response_format / json_schema
+    message = str(error).lower()
+    return "response_format" in message or "json_schema" in message
+
+
+def missing_fields(results_json, fields):
+    # Output_Fields a decoded reply does not answer (absent or blank); all of them if it is not an object
+    if not isinstance(results_json, dict):
+        return list(fields)
+    return [field for field in fields if str(results_json.get(field, "")).strip() == ""]
+
+
+FENCE = re.compile(r"```(?:json)?\s*(.*?)\s*```", re.DOTALL | re.IGNORECASE)
+_decoder = json.JSONDecoder()
+
+
+def extract_json(content):
+    # Decodes the JSON object or array in a reply. Tries the whole reply, then the inside of a code
+    # fence, then the first '{' or '[' onwards (ignoring anything after the JSON ends).
+    # Raises json.JSONDecodeError if the reply holds no JSON.
+    content = content.strip()
+    try:
+        return json.loads(content)
+    except json.JSONDecodeError as e:
+        error = e
+    match = FENCE.search(content)
+    if match:
+        try:
+            return json.loads(match.group(1))
+        except json.JSONDecodeError:
+            pass
+    for start, char in enumerate(content):
+        if char in "{[":
+            try:
+                return _decoder.raw_decode(content, start)[0]
+            except json.JSONDecodeError:
+                continue
+    raise error
@@ -2,39 +2,38 @@
 # For correct usage, load a text prompt generated with the partner application. The formatting
 # of the prompt is key to signaling which data elements need to be captured from the AI responses
 # You will need to specify your own URL for your AZURE_OPENAI_ENDPOINT and also your AZURE_OPENAI_KEY
-# where indicated in the code.
+# where indicated in submit_engine.py (or set them as environment variables).
+# This window is a thin shell over submit_engine; submit_cli.py runs the same engine without a display.
 
 import tkinter as tk
-from tkinter import messagebox, ttk, filedialog, simpledialog
+from tkinter import messagebox, filedialog, simpledialog
 import pandas as pd
-import re
-import os
-from openai import AzureOpenAI
-import json
-import requests
-from openai import BadRequestError  # need to error catch if a prompt violates policy filters
-import sys  # Import sys to exit the script
-from datetime import datetime, timedelta
-
-
-
-# URL and key for Azure OpenAI go here
-client = AzureOpenAI(
-    azure_endpoint=os.environ.get("AZURE_OPENAI_ENDPOINT", "https://[copy URL for your AI endpoint here]/"),
-    api_key=os.environ.get("AZURE_OPENAI_KEY", "[your open AI key goes here]"),
-    api_version="2024-05-01-preview",
-)
-
-# Set the model type (eg. gpt 3.5, and specific name of the deployed model in our azure instance)
-AZURE_OPENAI_MODEL = os.environ.get("AZURE_OPENAI_MODEL",
-                                    "gpt-4o-mini")  # switch to 'gpt-4o' to use the gpt4o model (10x more expensive per token)
-AZURE_OPENAI_MODEL_NAME = os.environ.get("AZURE_OPENAI_MODEL_NAME",
-                                         "gpt-4o-mini")  # switch to 'gpt-4o' to use the gpt4o model
-
+import queue
+import threading
+import time
+import submit_engine as engine
+from batch_mode import FINISHED_STATES
+from virtual_table import VirtualTable
+from cost_estimator import describe_estimate
+from dead_letter import REPROCESSED_CLASSES, classify_error, describe_classes
+from telemetry import telemetry
+
+
+inputfile = ""  # path of the loaded table; also identifies the run journal
+last_batch_id = ""  # most recently submitted Batch API job, offered as the default when retrieving results
 input_fields = []  # Initialize the input_fields list
 df = pd.DataFrame()  # Initialize an empty DataFrame
 assembled_prompt = ""  # Initialize assembled_prompt
 
+# A run executes on a background worker thread. It reports each finished row through progress_queue,
+# which the Tk thread drains every POLL_MS milliseconds; df_lock guards df while both threads use it.
+POLL_MS = 100
+run_control = None  # engine.RunControl of the run in progress, None when idle
+run_stats = {}  # progress of the current run: total, started, processed, errors
+run_prompts = []  # (output column prefix, prompt) of the last run, whose failed rows Reprocess Failed Rows re-sends
+progress_queue = queue.Queue()
+df_lock = threading.Lock()
+
 
 
 def load_file():
@@ -45,26 +44,11 @@ def load_file():
         filetypes=[("All files", "*.*")]
     )
     if inputfile:
-        ext = os.path.splitext(inputfile)[1].lower()
         global df  # Declare df as global
         try:
-            if ext == '.txt':
-                encodings = ['utf-8', 'Windows-1252']  # List of encodings to try
-                for encoding in encodings:
-                    try:
-                        df = pd.read_csv(inputfile, sep='\t', encoding=encoding)
-                        input_fields = df.columns.tolist()  # Create a list of headers
-                        display_dataframe(df)
-                        return  # Exit the function if successful
-                    except Exception as e:
-                        last_error = e  # Store the last error message
-                messagebox.showerror("Error", f"Failed to load file: {last_error}")
-            elif ext in ['.xls', '.xlsx']:
-                df = pd.read_excel(inputfile)
-                input_fields = df.columns.tolist()
-                display_dataframe(df)
-            else:
-                messagebox.showerror("Error", "Unsupported file type selected.")
+            df = engine.read_table(inputfile)
+            input_fields = df.columns.tolist()  # Create a list of headers
+            display_dataframe(df)
         except Exception as e:
             messagebox.showerror("Error", f"Failed to load file: {e}")
 
@@ -75,7 +59,7 @@ def load_test_data():
     inputfile = 'test_data.txt'
     try:
         global df  # Declare df as global
-        df = pd.read_csv(inputfile, sep='\t')
+        df = engine.read_table(inputfile)
         input_fields = df.columns.tolist()  # Create a list of headers
         display_dataframe(df)
     except Exception as e:
@@ -83,62 +67,41 @@ def load_test_data():
 
 
 def display_dataframe(df):
-    # Clear the Treeview
-    for i in tree.get_children():
-        tree.delete(i)
-
-    # Insert new data into the Treeview
-    for index, row in df.iterrows():
-        tree.insert("", "end", values=list(row))
-
-    # Update column headings
-    tree["columns"] = list(df.columns)
-    for col in df.columns:
-        tree.heading(col, text=col)
-        tree.column(col, anchor="center")
+    # Only the rows that fit in the window are materialized; see virtual_table.py
+    table.set_dataframe(df)
 
 
 def load_prompt():
-    global assembled_prompt  # Declare assembled_prompt as global
     filename = filedialog.askopenfilename(title="Select Prompt File", filetypes=[("Text files", "*.txt")])
     if filename:
-        encodings = ['utf-8', 'Windows-1252']  # List of encodings to try
-        for encoding in encodings:
-            try:
-                with open(filename, "r", encoding=encoding) as file:
-                    assembled_prompt = file.read()
-                text_prompt.delete(1.0, tk.END)  # Clear previous content
-                text_prompt.insert(tk.END, assembled_prompt)  # Display loaded prompt
-
-                # Parse for output fields
-                parse_output_fields(assembled_prompt)
-                return  # Exit the function if successful
-            except Exception as e:
-                last_error = e  # Store the last error message
-        messagebox.showerror("Error", f"Failed to load prompt: {last_error}")
+        try:
+            show_prompt(engine.read_prompt(filename))
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load prompt: {e}")
     else:
         messagebox.showwarning("Warning", "No file selected.")
 
 
 def load_test_prompt():
-    global assembled_prompt  # Declare assembled_prompt as global
-    filename = 'test_promptv2.txt'
     try:
-        with open(filename, "r") as file:
-            assembled_prompt = file.read()
-        text_prompt.delete(1.0, tk.END)  # Clear previous content
-        text_prompt.insert(tk.END, assembled_prompt)  # Display loaded prompt
-
-        # Parse for output fields
-        parse_output_fields(assembled_prompt)
+        show_prompt(engine.read_prompt('test_promptv2.txt'))
     except Exception as e:
         messagebox.showerror("Error", f"Failed to load test prompt: {e}")
 
 
+def show_prompt(prompt_text):
+    global assembled_prompt  # Declare assembled_prompt as global
+    assembled_prompt = prompt_text
+    text_prompt.delete(1.0, tk.END)  # Clear previous content
+    text_prompt.insert(tk.END, assembled_prompt)  # Display loaded prompt
+
+    # Parse for output fields
+    parse_output_fields(assembled_prompt)
+
+
 def parse_output_fields(assembled_prompt):
-    match = re.search(r"Output_Fields will be \[(.*?)\]", assembled_prompt)
-    if match:
-        output_headers = [header.strip() for header in match.group(1).split(',')]
+    output_headers = engine.parse_output_fields(assembled_prompt)
+    if output_headers:
         display_output_headers(output_headers)
         create_dataframe(output_headers)
 
@@ -149,82 +112,306 @@ def display_output_headers(output_headers):
 
 
 def create_dataframe(output_headers):
-    # Load the original DataFrame
-    original_df = pd.read_csv(inputfile, sep='\t')
+    # Add the output headers as new columns of the loaded table
+    engine.add_output_columns(df, output_headers)
+    display_dataframe(df)  # Display the modified DataFrame in the original text area
 
-    # Create a new DataFrame with the output headers as columns
-    for header in output_headers:
-        original_df[header] = ""  # Add new columns with empty values
 
-    display_dataframe(original_df)  # Display the modified DataFrame in the original text area
+def confirm_resume(answered, failed):
+    return messagebox.askyesno("Resume Previous Run",
+                               f"A partial run of this file and prompt was found: {answered} rows completed, "
+                               f"{failed} failed.\nResume it and only send the remaining rows?")
 
 
-def run_conversation_w_input0(input, assembled_prompt):
-    messages = [{"role": "system", "content": f"""{assembled_prompt}
-    """
-                 },
-                {"role": "user", "content": input}, ]
-
-    # this is the actual chat completion API call
-    print("evaluating", input)
-    response = client.chat.completions.create(
-        model=AZURE_OPENAI_MODEL,
-        messages=messages,
-    )
-    print(response)
-    return response
+def prompt_input_fields():
+    # The columns sent with each row (see engine.prompt_input_fields); warns if the prompt describes
+    # fields the loaded table does not have
+    fields, missing, unused = engine.prompt_input_fields(input_fields, assembled_prompt)
+    if missing:
+        messagebox.showwarning("Input Fields", "The prompt describes fields that are not columns of the loaded "
+                                               f"table:\n{', '.join(missing)}\nRows will be sent without them.")
+    return fields
 
 
 def send_query_to_ai(row_limit=None):
-    global df  # Use the global DataFrame
-    global assembled_prompt  # Use the global assembled_prompt
-    processed_records = 0
-    qc_record = ""  # capture the output of the LLM for any qc analysis needs
-    cumulative_error_details = []  # capture prompts that triggered errors during processing for display at the end of execution
-    stopping_number = row_limit if row_limit is not None else len(df)  # Limit to specified rows or all
-
-    for index, row in df.iterrows():
-        if processed_records >= stopping_number:
+    if run_control is not None:
+        messagebox.showwarning("Warning", "A run is already in progress.")
+        return
+    try:
+        fields = prompt_input_fields()
+    except ValueError as e:
+        messagebox.showerror("Error", str(e))
+        return
+    # Ask about resuming here: dialogs must be shown from the Tk thread, not the worker
+    estimate = engine.estimate_submission(df, fields, assembled_prompt, row_limit=row_limit)
+    if row_limit is None and not messagebox.askokcancel("Estimated Cost",
+                                                        f"Estimate for this run:\n{describe_estimate(estimate)}\n\n"
+                                                        "Send the rows?"):
+        return
+    previous = engine.previous_run(inputfile, assembled_prompt)
+    resume = confirm_resume(*previous) if previous else False
+    use_cache = use_cache_var.get()  # unticked = bypass cached replies (fresh replies are still stored)
+
+    def submit(control, on_row):
+        return engine.run_submission(df, fields, assembled_prompt, inputfile=inputfile,
+                                     row_limit=row_limit, use_cache=use_cache, on_row=on_row,
+                                     confirm_resume=lambda answered, failed: resume,
+                                     control=control, df_lock=df_lock)
+
+    run_prompts[:] = [("", assembled_prompt)]
+    start_run(len(df) if row_limit is None else min(row_limit, len(df)), submit)
+
+
+def send_fanout_to_ai():
+    # Sends every row with each of several prompt files in one pass; each prompt's output columns are
+    # named '<prompt file name>.<field>' (see engine.run_fanout)
+    if run_control is not None:
+        messagebox.showwarning("Warning", "A run is already in progress.")
+        return
+    filenames = filedialog.askopenfilenames(title="Select Prompt Files", filetypes=[("Text files", "*.txt")])
+    if not filenames:
+        return
+    try:
+        prompts = engine.read_prompts(filenames)
+        # The loaded table's own columns: df also has the output columns of prompts loaded before
+        columns = engine.fanout_input_columns(input_fields, [name for name, _ in prompts])
+        estimates = []
+        for name, prompt in prompts:
+            fields, missing, _ = engine.prompt_input_fields(columns, prompt)
+            if missing:
+                messagebox.showwarning("Input Fields", f"The prompt {name} describes fields that are not columns of "
+                                                       f"the loaded table:\n{', '.join(missing)}\n"
+                                                       "Rows will be sent without them.")
+            estimates.append(f"{name}: {describe_estimate(engine.estimate_submission(df, fields, prompt))}")
+    except ValueError as e:
+        messagebox.showerror("Error", str(e))
+        return
+    if not messagebox.askokcancel("Estimated Cost", "Estimate for this run:\n" + "\n".join(estimates)
+                                  + "\n\nSend the rows?"):
+        return
+    resumable = {name: engine.previous_run(inputfile, prompt) for name, prompt in prompts}
+    resume = {name: confirm_resume(*previous) if previous else False for name, previous in resumable.items()}
+    use_cache = use_cache_var.get()
+    with df_lock:
+        for name, prompt in prompts:
+            engine.add_output_columns(df, engine.parse_output_fields(prompt), engine.fanout_prefix(name))
+    display_dataframe(df)
+
+    def submit(control, on_row):
+        # The journals left by earlier runs ask about resuming in prompt order
+        answers = iter(resume[name] for name, _ in prompts if resumable[name])
+        summaries = engine.run_fanout(df, prompts, inputfile=inputfile, use_cache=use_cache, on_row=on_row,
+                                      confirm_resume=lambda answered, failed: next(answers),
+                                      control=control, df_lock=df_lock, input_columns=columns)
+        return {"processed_records": sum(summary["processed_records"] for summary in summaries.values()),
+                "errors": [error for summary in summaries.values() for error in summary["errors"]],
+                "cancelled": control.cancelled.is_set(),
+                "budget_exceeded": any(summary["budget_exceeded"] for summary in summaries.values())}
+
+    run_prompts[:] = [(engine.fanout_prefix(name), prompt) for name, prompt in prompts]
+    start_run(len(df) * len(prompts), submit)
+
+
+def reprocess_failed_rows():
+    # Re-sends the failed rows of the last run (or of the loaded file and prompt) that are in the dead-letter
+    # store, with a strategy chosen by their error class (see dead_letter.py)
+    if run_control is not None:
+        messagebox.showwarning("Warning", "A run is already in progress.")
+        return
+    prompts = list(run_prompts) or [("", assembled_prompt)]
+    if not inputfile or not prompts[0][1]:
+        messagebox.showwarning("Warning", "Load data and a prompt before reprocessing failed rows.")
+        return
+    counts = engine.dead_letter_counts(inputfile, prompts)
+    total = sum(counts.get(error_class, 0) for error_class in REPROCESSED_CLASSES)
+    if not total:
+        messagebox.showinfo("Reprocess Failed Rows", "No failed rows to reprocess"
+                            + (f" ({describe_classes(counts)} left for review)." if counts else "."))
+        return
+    held = {error_class: count for error_class, count in counts.items() if error_class not in REPROCESSED_CLASSES}
+    if not messagebox.askokcancel("Reprocess Failed Rows",
+                                  f"Failed rows by cause: {describe_classes(counts)}.\n"
+                                  f"Re-send {total} of them?"
+                                  + (f"\n({describe_classes(held)} are left for review.)" if held else "")):
+        return
+
+    def submit(control, on_row):
+        summary = engine.reprocess_dead_letters(df, prompts, inputfile, on_row=on_row, control=control,
+                                                df_lock=df_lock)
+        return {"processed_records": sum(summary["fixed"].values()) + sum(summary["failed"].values()),
+                "errors": [], "cancelled": summary["cancelled"], "budget_exceeded": summary["budget_exceeded"]}
+
+    start_run(total, submit)
+
+
+def start_run(total, submit):
+    # Runs submit(control, on_row) on a worker thread and follows its progress from the Tk thread
+    global run_control
+    run_control = engine.RunControl()
+    run_stats.update(total=total, started=time.monotonic(), processed=0, errors=0)
+
+    def on_row(processed_records, index, outcome):
+        # Called on the worker thread: hand over to the Tk thread
+        progress_queue.put(("row", processed_records, index, isinstance(outcome, Exception)))
+
+    def work(control):
+        try:
+            progress_queue.put(("done", submit(control, on_row)))
+        except Exception as e:
+            progress_queue.put(("failed", e))
+
+    threading.Thread(target=work, args=(run_control,), daemon=True).start()
+    set_running(True)
+    root.after(POLL_MS, poll_progress)
+
+
+def poll_progress():
+    global run_control
+    finished = None
+    while True:
+        try:
+            message = progress_queue.get_nowait()
+        except queue.Empty:
             break
+        if message[0] == "row":
+            _, processed_records, index, failed = message
+            run_stats["processed"] = processed_records
+            run_stats["errors"] += failed
+            table.mark_row_changed(index)  # repainted on the table's refresh timer
+        else:
+            finished = message
+
+    # Update the processed records counter and run statistics
+    elapsed = time.monotonic() - run_stats["started"]
+    rate = run_stats["processed"] / elapsed if elapsed > 0 else 0
+    remaining = run_stats["total"] - run_stats["processed"]
+    eta = time.strftime("%H:%M:%S", time.gmtime(remaining / rate)) if rate > 0 else "--:--:--"
+    processed_label.config(text=f"Processed Records: {run_stats['processed']} of {run_stats['total']}")
+    progress_label.config(text=f"{rate:.2f} rows/sec | ETA {eta} | Errors: {run_stats['errors']} | "
+                               f"Tokens used: {engine.token_usage.total_tokens} (${engine.token_usage.cost:.4f})")
+    cache = engine.get_response_cache()
+    cache_label.config(text=f"Cache: {cache.hits} hits / {cache.misses} misses")
+
+    if finished is None:
+        root.after(POLL_MS, poll_progress)
+        return
+    run_control = None
+    set_running(False)
+    table.redraw()
+    if finished[0] == "failed":
+        messagebox.showerror("Error", f"Run stopped: {finished[1]}")
+    else:
+        summary = finished[1]
+        state = "cancelled" if summary["cancelled"] else "complete"
+        title = "Run " + state
+        if summary["budget_exceeded"]:
+            state = f"stopped at the ${engine.AZURE_OPENAI_BUDGET_USD:g} budget"
+            title = "Run stopped"
+        causes = {}
+        for error in summary["errors"][::2]:  # error details are recorded as (exception, row) pairs
+            error_class = classify_error(error)
+            causes[error_class] = causes.get(error_class, 0) + 1
+        messagebox.showinfo(title, f"Run {state}: {summary['processed_records']} rows processed, "
+                                   f"{run_stats['errors']} errors.\nUsage: {engine.token_usage.describe()}\n"
+                                   f"Bound by {' - '.join(telemetry.bottleneck())}"
+                                   + (f"\nFailed rows by cause: {describe_classes(causes)}. Use Reprocess Failed "
+                                      "Rows to re-send them." if causes else ""))
+
+
+def set_running(running):
+    # Enable the run controls only while a run is in progress, and the send, merge and export buttons (which
+    # read or write df while the workers are filling it in) only while idle
+    for button in (button_test_first_10, button_send_query, button_send_fanout, button_reprocess,
+                   button_retrieve_batch, button_export_tsv, button_export_xlsx):
+        button.config(state='disabled' if running else 'normal')
+    for button in (button_pause, button_cancel):
+        button.config(state='normal' if running else 'disabled')
+    button_pause.config(text="Pause")
+
+
+def toggle_pause():
+    if run_control is None:
+        return
+    if run_control.resumed.is_set():
+        run_control.pause()  # requests already in flight still finish
+        button_pause.config(text="Resume")
+    else:
+        run_control.resume()
+        button_pause.config(text="Pause")
+
+
+def cancel_run():
+    if run_control is not None:
+        run_control.cancel()  # stop sending; outstanding requests drain and are recorded
+        button_cancel.config(state='disabled')
+
+
+def write_batch_file():
+    if df.empty or not assembled_prompt:
+        messagebox.showwarning("Warning", "Load data and a prompt before writing a batch file.")
+        return None
+    file_path = filedialog.asksaveasfilename(initialfile="requests.jsonl", defaultextension=".jsonl",
+                                             filetypes=[("JSON Lines", "*.jsonl"), ("All files", "*.*")])
+    if file_path:
         try:
-            row_prep = '\t'.join(row[input_fields].astype(str))  # Generate the tab-delimited string
-            processed_records += 1
-            query = f""" {row_prep} ."""  # Keep triple quotes for this. Use f-string to insert the variables.
-            results = run_conversation_w_input0(query, assembled_prompt)  # Ensure assembled_prompt is defined
-
-            # Extract the content and remove the code block formatting
-            json_content = results.choices[0].message.content.strip('```json\n').strip('```')
-
-            # Now load the JSON data
-            results_json = json.loads(json_content)  # converts the json to a dict!
-            print("Results JSON:", results_json)  # check the data type of results_json
-
-            if isinstance(results_json,
-                          dict):  # Error Catching for occasional instances when chat completion comes back as a list
-                for key, value in results_json.items():
-                    df.at[index, key] = str(value)  # Convert value to string before updating dataframe
-            elif isinstance(results_json, list):
-                print("Received a list instead of a dictionary:", results_json)
-                # Handle the list case as needed
-            else:
-                print("Unexpected response format:", results_json)
-
-            # Update the displayed DataFrame and processed records counter
-            display_dataframe(df)
-            processed_label.config(text=f"Processed Records: {processed_records}")
-            print(results_json)
-            print("Processed records:", str(processed_records))
-            qc_record += str(processed_records) + ": " + str(results_json) + "\n"
-        except BadRequestError as e:  # catch errors due to inadvertent content policy violations in prompts
-            print("Error occurred (bad request):", e)
-            cumulative_error_details.append(e)
-            cumulative_error_details.append(row_prep)
-            continue
-        except json.JSONDecodeError as er:  # catch errors due to LLM occasionally returning incorrect JSON format
-            print("Error occurred (JSON decode):", er)
-            cumulative_error_details.append(er)
-            cumulative_error_details.append(row_prep)
-            continue
+            fields = prompt_input_fields()
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return None
+        count = engine.write_batch_file(df, fields, assembled_prompt, file_path)
+        messagebox.showinfo("Success", f"Wrote {count} batch requests to {file_path}")
+    return file_path
+
+
+def submit_batch_job():
+    global last_batch_id
+    file_path = write_batch_file()
+    if not file_path:
+        return
+    try:
+        batch = engine.submit_batch_job(file_path)
+    except Exception as e:
+        messagebox.showerror("Error", f"Failed to submit batch job: {e}")
+        return
+    last_batch_id = batch.id
+    telemetry.log("INFO", "batch_submitted", f"Submitted batch job: {batch.id}", batch_id=batch.id)
+    messagebox.showinfo("Batch Submitted", f"Batch job ID: {batch.id}\n"
+                                           "Keep this ID. Results can be retrieved later with 'Retrieve Batch Results', "
+                                           "after loading the same data and prompt.")
+
+
+def retrieve_batch_results():
+    if run_control is not None:
+        messagebox.showwarning("Warning", "A run is already in progress.")
+        return
+    try:
+        fields = prompt_input_fields()
+    except ValueError as e:
+        messagebox.showerror("Error", str(e))
+        return
+    batch_id = simpledialog.askstring("Retrieve Batch Results", "Batch job ID:", initialvalue=last_batch_id)
+    if not batch_id:
+        return
+    try:
+        batch = engine.get_client().batches.retrieve(batch_id.strip())
+    except Exception as e:
+        messagebox.showerror("Error", f"Failed to look up batch job: {e}")
+        return
+    if batch.status not in FINISHED_STATES:
+        messagebox.showinfo("Batch Status", f"Batch job {batch.id} is {batch.status}. Try again later.")
+        return
+
+    processed_records, cumulative_error_details = engine.merge_batch_results(df, batch, fields, assembled_prompt,
+                                                                             inputfile=inputfile, df_lock=df_lock)
+    display_dataframe(df)
+    processed_label.config(text=f"Processed Records: {processed_records}")
+    for error in cumulative_error_details:
+        telemetry.log("WARNING", "batch_error", f"Batch error: {error}", batch_id=batch.id)
+    messagebox.showinfo("Batch Results", f"Batch job {batch.id} {batch.status}: merged {processed_records} rows, "
+                                         f"{len(cumulative_error_details)} errors."
+                        + ("\nFirst errors:\n" + "\n".join(cumulative_error_details[:5])
+                           + "\nFailed rows can be re-sent with Reprocess Failed Rows."
+                           if cumulative_error_details else ""))
 
 
 def export_to_tsv():
@@ -235,7 +422,7 @@ def export_to_tsv():
     file_path = filedialog.asksaveasfilename(defaultextension=".txt",
                                              filetypes=[("Text files", "*.txt"), ("All files", "*.*")])
     if file_path:
-        df.to_csv(file_path, sep='\t', index=False)
+        engine.export_to_tsv(df, file_path)
         messagebox.showinfo("Success", "Data exported successfully as tab-delimited text.")
 
 
@@ -247,7 +434,7 @@ def export_to_xlsx():
     file_path = filedialog.asksaveasfilename(defaultextension=".xlsx",
                                              filetypes=[("Excel files", "*.xlsx"), ("All files", "*.*")])
     if file_path:
-        df.to_excel(file_path, index=False)
+        engine.export_to_xlsx(df, file_path)
         messagebox.showinfo("Success", "Data exported successfully as Excel file.")
 
 
@@ -269,14 +456,9 @@ button_load.pack(side=tk.LEFT)
 button_load_test_data = tk.Button(frame_input, text="Load Test Data", command=load_test_data, bg='orange')
 button_load_test_data.pack(side=tk.LEFT)
 
-# Create a Treeview for displaying DataFrame
-tree = ttk.Treeview(root, show='headings')
-tree.pack(pady=10, fill=tk.BOTH, expand=True)
-
-# Create a scrollbar for the Treeview
-scrollbar = ttk.Scrollbar(root, orient="vertical", command=tree.yview)
-scrollbar.pack(side='right', fill='y')
-tree.configure(yscroll=scrollbar.set)
+# Create a virtualized table (Treeview + scrollbar) for displaying DataFrame
+table = VirtualTable(root, lock=df_lock)
+table.pack(pady=10, fill=tk.BOTH, expand=True)
 
 # Load prompt section
 label_load_prompt = tk.Label(root, text='Load Prompt File:')
@@ -295,6 +477,18 @@ button_load_test_prompt.pack(side=tk.LEFT)
 processed_label = tk.Label(root, text="Processed Records: 0")
 processed_label.pack(pady=5)
 
+# Live run statistics
+progress_label = tk.Label(root, text="")
+progress_label.pack(pady=5)
+
+# Response cache hit/miss counter and bypass switch
+cache_label = tk.Label(root, text="Cache: 0 hits / 0 misses")
+cache_label.pack(pady=5)
+
+use_cache_var = tk.BooleanVar(value=True)
+check_use_cache = tk.Checkbutton(root, text="Reuse cached AI replies", variable=use_cache_var)
+check_use_cache.pack(pady=5)
+
 # Buttons to send queries to AI
 button_test_first_10 = tk.Button(root, text="Test first 10 rows with AI",
                                  command=lambda: send_query_to_ai(row_limit=10), bg='lightgreen')
@@ -303,6 +497,39 @@ button_test_first_10.pack(pady=5)
 button_send_query = tk.Button(root, text="Send entire dataset to AI", command=send_query_to_ai, bg='lightgreen')
 button_send_query.pack(pady=10)
 
+button_send_fanout = tk.Button(root, text="Send entire dataset with several prompts...", command=send_fanout_to_ai,
+                               bg='lightgreen')
+button_send_fanout.pack(pady=5)
+
+# Controls for the run in progress
+frame_run = tk.Frame(root)
+frame_run.pack(pady=5)
+
+button_pause = tk.Button(frame_run, text="Pause", command=toggle_pause, bg='lightyellow', state='disabled')
+button_pause.pack(side=tk.LEFT)
+
+button_cancel = tk.Button(frame_run, text="Cancel", command=cancel_run, bg='salmon', state='disabled')
+button_cancel.pack(side=tk.LEFT)
+
+button_reprocess = tk.Button(frame_run, text="Reprocess Failed Rows", command=reprocess_failed_rows,
+                             bg='lightgreen')
+button_reprocess.pack(side=tk.LEFT)
+
+# Offline Batch API mode (half price, separate quota, results typically within 24 hours)
+frame_batch = tk.Frame(root)
+frame_batch.pack(pady=5)
+
+button_write_batch = tk.Button(frame_batch, text="Write Batch File (requests.jsonl)", command=write_batch_file,
+                               bg='lightgreen')
+button_write_batch.pack(side=tk.LEFT)
+
+button_submit_batch = tk.Button(frame_batch, text="Submit Batch Job", command=submit_batch_job, bg='lightgreen')
+button_submit_batch.pack(side=tk.LEFT)
+
+button_retrieve_batch = tk.Button(frame_batch, text="Retrieve Batch Results", command=retrieve_batch_results,
+                                  bg='lightgreen')
+button_retrieve_batch.pack(side=tk.LEFT)
+
 # Buttons for exporting data
 button_export_tsv = tk.Button(root, text="Export Results as Tab-Delimited Text", command=export_to_tsv, bg='lightblue')
 button_export_tsv.pack(pady=5)
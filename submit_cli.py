@@ -0,0 +1,398 @@
+# Command line entry point for batch submission of tabular data to the Azure OpenAI endpoint.
+# Runs the same engine as the submit-retrieve GUI, without Tk, so jobs can be scripted, run from
+# cron or run on compute nodes without a display. Progress is streamed to stdout.
+#
+# Example:
+#   python submit_cli.py --input test_data.txt --prompt test_promptv2.txt --output results.txt --concurrency 16
+#
+# Sharded runs: start one process per shard (on one or several machines, each with its own credentials),
+# then reassemble the partial results with merge_shards.py:
+#   python submit_cli.py --input data.txt --prompt prompt.txt --output part0.txt --shard 0/4 --shard-by hash
+#
+# Several prompts over one table in a single pass (output columns are named '<prompt file name>.<field>'):
+#   python submit_cli.py --input cohort.txt --prompt eligibility.txt staging.txt --output results.txt
+#
+# Overnight runs through the Batch API, without the GUI: submit the rows as a batch job, then merge its replies
+# into --output once it has finished (--batch merge exits with status 4 while the job is still running, so it
+# can be retried from cron), or block until then with --batch wait:
+#   python submit_cli.py --input data.txt --prompt prompt.txt --output results.txt --batch submit
+#   python submit_cli.py --input data.txt --prompt prompt.txt --output results.txt --batch wait --batch-id batch_...
+#
+# Rows that failed are kept in a dead-letter store (see dead_letter.py). To re-send them and merge the fixes
+# into the results, run the same command again with --reprocess.
+#
+# Endpoint, key and deployment are read from the same environment variables as the GUI
+# (AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_KEY, AZURE_OPENAI_MODEL, ...).
+
+import argparse
+import sys
+import time
+
+import submit_engine as engine
+from batch_mode import FINISHED_STATES
+from cost_estimator import describe_estimate
+from dead_letter import ERROR_CLASSES, REPROCESSED_CLASSES, classify_error, describe_classes
+from sharding import SHARD_MODES, ROW_INDEX_COLUMN, parse_shard, shard_label, write_error_report
+from telemetry import LEVELS, telemetry
+
+PROGRESS_INTERVAL = 1.0  # seconds between progress lines; failed rows are always printed
+BATCH_ACTIONS = ("submit", "wait", "merge")
+BATCH_RUNNING = 4  # exit status of --batch merge while the batch job has not finished
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Submit each row of a table to an Azure OpenAI deployment "
+                                                 "using a prompt prepared with query_formatter.py.")
+    parser.add_argument("--input", required=True, help="tab-delimited text (.txt) or Excel (.xls/.xlsx) table")
+    parser.add_argument("--prompt", required=True, nargs="+",
+                        help="prompt file saved by query_formatter.py; with several, every row is sent with each of "
+                             "them in one pass and each prompt's output columns are prefixed with its file name")
+    parser.add_argument("--output", required=True, help="results file; .xlsx writes Excel, .parquet a Parquet results store, anything else tab-delimited text")
+    parser.add_argument("--concurrency", type=int, default=engine.MAX_IN_FLIGHT,
+                        help="maximum number of requests in flight (default: %(default)s)")
+    parser.add_argument("--rows-per-request", type=int, default=engine.ROWS_PER_REQUEST,
+                        help="rows packed into each request (default: %(default)s)")
+    parser.add_argument("--start", type=int, default=0, help="first row to send (0-based, default: 0)")
+    parser.add_argument("--end", type=int, default=None, help="stop before this row (default: end of table)")
+    parser.add_argument("--no-cache", action="store_true", help="do not reuse cached replies")
+    parser.add_argument("--chunksize", type=int, default=0,
+                        help="stream the input this many rows at a time and append results to the output as they "
+                             "complete, keeping memory bounded on very large tables (.parquet and .xlsx output is collected in a "
+                             "Parquet store, one row group per chunk)")
+    parser.add_argument("--fresh", action="store_true", help="ignore the journal of an interrupted run and start over")
+    parser.add_argument("--previous",
+                        help="results file of an earlier run: rows whose input and prompt are unchanged are copied "
+                             "from it and only new, changed or failed rows are sent")
+    parser.add_argument("--budget", type=float, default=engine.AZURE_OPENAI_BUDGET_USD,
+                        help="stop sending before the run's cost would exceed this many USD (default: %(default)s, 0 = no cap)")
+    parser.add_argument("--reprocess", action="store_true",
+                        help="instead of a run, re-send the rows of an earlier run of --input and --prompt that are in "
+                             "the dead-letter store, with a strategy chosen by their error class, and merge the fixes "
+                             "into the existing --output")
+    parser.add_argument("--classes", nargs="+", choices=ERROR_CLASSES, default=list(REPROCESSED_CLASSES),
+                        help="error classes to reprocess (default: all but content_filter, which is left for review)")
+    parser.add_argument("--estimate", action="store_true",
+                        help="only print the projected tokens, cost and time of the run and exit")
+    parser.add_argument("--batch", choices=BATCH_ACTIONS,
+                        help="use the Batch API instead of sending rows directly: 'submit' writes the rows to "
+                             "<output>.requests.jsonl and starts a batch job, 'wait' polls the job given by --batch-id "
+                             "until it finishes and merges its replies into --output, 'merge' merges them if it has "
+                             "finished")
+    parser.add_argument("--batch-id", help="batch job printed by --batch submit, for --batch wait and --batch merge")
+    parser.add_argument("--poll", type=float, default=60,
+                        help="seconds between status checks with --batch wait (default: %(default)s)")
+    parser.add_argument("--shard", help="run only shard K of N (K/N, numbered from 0) and write partial results "
+                                        "with a Row_Index column for merge_shards.py")
+    parser.add_argument("--shard-by", choices=SHARD_MODES, default="range",
+                        help="split rows into contiguous ranges or by a hash of their content (default: %(default)s)")
+    parser.add_argument("--telemetry", default=engine.AZURE_OPENAI_TELEMETRY_PATH,
+                        help="append structured telemetry (JSON lines) to this file")
+    parser.add_argument("--log-level", choices=list(LEVELS), default=engine.AZURE_OPENAI_LOG_LEVEL.upper(),
+                        help="lowest level written to the telemetry file; DEBUG logs every request (default: %(default)s)")
+    parser.add_argument("--metrics", help="write counters and histograms in the Prometheus text format to this "
+                                          "file at the end of the run")
+    args = parser.parse_args(argv)
+    if len(args.prompt) > 1 and args.chunksize and not args.reprocess:
+        parser.error("--chunksize runs one prompt at a time; it cannot be combined with several --prompt files")
+    if args.batch:
+        if len(args.prompt) > 1 or args.chunksize or args.shard or args.reprocess:
+            parser.error("--batch sends one prompt over the whole table; it cannot be combined with several --prompt "
+                         "files, --chunksize, --shard or --reprocess")
+        if args.batch != "submit" and not args.batch_id:
+            parser.error(f"--batch {args.batch} needs the --batch-id printed by --batch submit")
+    if args.shard:
+        if args.start or args.end is not None:
+            parser.error("--shard selects the rows itself; it cannot be combined with --start/--end")
+        try:
+            args.shard = parse_shard(args.shard) + (args.shard_by,)
+        except ValueError as e:
+            parser.error(str(e))
+    return args
+
+
+def progress_printer(total, started, interval=PROGRESS_INTERVAL):
+    # Prints failed rows as they happen and the progress at most every interval seconds
+    last = 0.0
+
+    def on_row(processed_records, index, outcome):
+        nonlocal last
+        now = time.monotonic()
+        failed = isinstance(outcome, Exception)
+        if not failed and now - last < interval:
+            return
+        last = now
+        status = f"error ({type(outcome).__name__})" if failed else "ok"
+        print(f"[{processed_records}/{total}] row {index}: {status} ({processed_records / (now - started):.2f} rows/s)",
+              flush=True)
+    return on_row
+
+
+def failure_collector(on_row, failures, fanout=False):
+    # Keeps {row index: exception} of the rows that failed, for a sharded run's error report. In a
+    # fan-out run a row that failed with one prompt stays failed when another prompt answers it.
+    def collect(processed_records, index, outcome):
+        if isinstance(outcome, Exception):
+            failures[index] = outcome
+        elif not fanout:
+            failures.pop(index, None)
+        on_row(processed_records, index, outcome)
+    return collect
+
+
+def resume_policy(args):
+    def confirm_resume(answered, failed):
+        if args.fresh:
+            return False
+        print(f"Resuming interrupted run: {answered} rows already answered, {failed} failed rows will be retried")
+        return True
+    return confirm_resume
+
+
+def print_summary(summary, started, args):
+    errors = len(summary["errors"]) // 2  # error details are recorded as (exception, row) pairs
+    print(f"Processed {summary['processed_records']} rows in {time.monotonic() - started:.1f}s, "
+          f"{errors} errors. Results written to {args.output}")
+    if errors:
+        counts = {}
+        for error in summary["errors"][::2]:
+            error_class = classify_error(error)
+            counts[error_class] = counts.get(error_class, 0) + 1
+        print(f"Failed rows by cause: {describe_classes(counts)}. They are kept in "
+              f"{engine.AZURE_OPENAI_DEAD_LETTER_PATH}; run the same command with --reprocess to re-send them")
+    if args.previous:
+        print(f"Incremental: {summary['reused']} unchanged rows copied from {args.previous}")
+    if engine.AZURE_OPENAI_ESCALATION_MODEL:
+        print(f"Cascade: {summary['escalated']} rows escalated to {engine.AZURE_OPENAI_ESCALATION_MODEL}")
+    print(f"Usage: {engine.token_usage.describe()}")
+    print("Endpoints:\n" + engine.get_endpoint_pool().describe())
+    print("Telemetry: " + telemetry.describe())
+    if args.metrics:
+        telemetry.write_prometheus(args.metrics)
+    if summary["budget_exceeded"]:
+        print(f"Stopped at the ${args.budget:g} budget; run again with a higher --budget to send the remaining rows")
+        return 3
+    return 1 if errors else 0
+
+
+def streaming_estimate(args, assembled_prompt):
+    # Counts the rows in range chunk by chunk and tokenizes a sample from the first chunk
+    first_chunk = None
+    total_rows = 0
+    for chunk in engine.iter_table_chunks(args.input, args.chunksize):
+        if first_chunk is None:
+            first_chunk = chunk
+        total_rows += len(chunk.loc[args.start:args.end - 1 if args.end is not None else None])
+    if args.shard:
+        total_rows //= args.shard[1]  # roughly this shard's share
+    input_fields, _, _ = engine.prompt_input_fields(first_chunk.columns, assembled_prompt)
+    return engine.estimate_submission(first_chunk, input_fields, assembled_prompt, total_rows=total_rows,
+                                      rows_per_request=args.rows_per_request, max_in_flight=args.concurrency)
+
+
+def previous_results(args, assembled_prompt, prefix=""):
+    # {row fingerprint: result} from --previous, or None
+    if not args.previous:
+        return None
+    answers, stale = engine.load_previous_results(args.previous, assembled_prompt, prefix)
+    print(f"Previous results{' for ' + prefix[:-1] if prefix else ''}: {len(answers)} answered rows can be reused"
+          + (f"; {stale} rows were answered with a different prompt or model and will be re-sent" if stale else ""))
+    return answers
+
+
+def combine_summaries(summaries):
+    # One summary for print_summary from run_fanout's per-prompt summaries
+    combined = {"processed_records": 0, "errors": [], "reused": 0, "escalated": 0, "budget_exceeded": False}
+    for summary in summaries.values():
+        combined["processed_records"] += summary["processed_records"]
+        combined["errors"] += summary["errors"]
+        combined["reused"] += summary["reused"]
+        combined["escalated"] += summary["escalated"]
+        combined["budget_exceeded"] = combined["budget_exceeded"] or summary["budget_exceeded"]
+    return combined
+
+
+def main_fanout(args, df):
+    # Several prompts over the same rows in one pass, see engine.run_fanout
+    prompts = engine.read_prompts(args.prompt)
+    journal_scope = ""
+    if args.shard:
+        # The same rows for every prompt: hash on the columns the prompts send (the first prompt's, then any the
+        # others add), so the shard holds the same rows as a single-prompt run when the prompts share their fields
+        sent = []
+        for _, assembled_prompt in prompts:
+            fields = engine.prompt_input_fields(df.columns, assembled_prompt)[0]
+            sent += [field for field in fields if field not in sent]
+        df = engine.select_shard(df, sent, args.shard).copy()
+        journal_scope = shard_label(*args.shard)
+        print(f"Shard {args.shard[0]}/{args.shard[1]} ({args.shard[2]}): {len(df)} rows")
+    columns = list(df.columns)  # before the output columns are added
+    for name, assembled_prompt in prompts:
+        output_headers = engine.parse_output_fields(assembled_prompt)
+        if not output_headers:
+            print(f"Warning: no 'Output_Fields will be [...]' line found in the prompt {name}", file=sys.stderr)
+        engine.add_output_columns(df, output_headers, engine.fanout_prefix(name))
+        input_fields, _, _ = engine.prompt_input_fields(columns, assembled_prompt)
+        print(f"Estimate ({name}):", describe_estimate(engine.estimate_submission(
+            df, input_fields, assembled_prompt, start=args.start, stop=args.end,
+            rows_per_request=args.rows_per_request, max_in_flight=args.concurrency)))
+    if args.estimate:
+        return 0
+    total = len(df.iloc[args.start:args.end]) * len(prompts)
+    started = time.monotonic()
+    failures = {}
+    previous = {name: previous_results(args, assembled_prompt, engine.fanout_prefix(name))
+                for name, assembled_prompt in prompts} if args.previous else None
+    summaries = engine.run_fanout(df, prompts, inputfile=args.input, start=args.start, stop=args.end,
+                                  max_in_flight=args.concurrency, rows_per_request=args.rows_per_request,
+                                  use_cache=not args.no_cache,
+                                  on_row=failure_collector(progress_printer(total, started), failures, fanout=True),
+                                  confirm_resume=resume_policy(args), budget=args.budget, previous=previous,
+                                  journal_scope=journal_scope, input_columns=columns)
+    for name, summary in summaries.items():
+        print(f"{name}: {summary['processed_records']} rows, {len(summary['errors']) // 2} errors")
+    if args.shard:
+        df.insert(0, ROW_INDEX_COLUMN, df.index)
+        write_error_report(args.output, failures)
+    engine.export_results(df, args.output)
+    return print_summary(combine_summaries(summaries), started, args)
+
+
+def main_reprocess(args):
+    # Re-sends the dead-lettered rows of an earlier run and merges the fixes into its results file
+    if len(args.prompt) > 1:
+        prompts = [(engine.fanout_prefix(name), prompt) for name, prompt in engine.read_prompts(args.prompt)]
+    else:
+        prompts = [("", engine.read_prompt(args.prompt[0]))]
+    counts = engine.dead_letter_counts(args.input, prompts)
+    print(f"Dead-letter store: {describe_classes(counts) or 'no failed rows'} for {args.input}")
+    if not any(counts.get(error_class) for error_class in args.classes) or args.estimate:
+        return 0
+    df = engine.read_results(args.output)
+    if ROW_INDEX_COLUMN in df.columns:
+        df.index = df[ROW_INDEX_COLUMN].astype(int)  # partial results of a sharded run
+    else:
+        # Streamed runs write only the rows from --start on; other runs write the whole table
+        offset = args.start if args.chunksize else 0
+        df.index = range(offset, offset + len(df))
+    started = time.monotonic()
+    total = sum(counts.get(error_class, 0) for error_class in args.classes)
+    summary = engine.reprocess_dead_letters(df, prompts, args.input, classes=args.classes,
+                                            max_in_flight=args.concurrency,
+                                            on_row=progress_printer(total, started), budget=args.budget)
+    engine.export_results(df, args.output)
+    fixed = sum(summary["fixed"].values())
+    print(f"Reprocessed {fixed + sum(summary['failed'].values())} rows in {time.monotonic() - started:.1f}s: "
+          f"{fixed} fixed ({describe_classes(summary['fixed']) or 'none'}), "
+          f"still failing: {describe_classes(summary['failed']) or 'none'}. Results written to {args.output}")
+    if summary["missing"]:
+        print(f"{summary['missing']} failed rows are not in {args.output} and were left in the store")
+    print(f"Usage: {engine.token_usage.describe()}")
+    if args.metrics:
+        telemetry.write_prometheus(args.metrics)
+    if summary["budget_exceeded"]:
+        print(f"Stopped at the ${args.budget:g} budget")
+        return 3
+    return 1 if summary["failed"] else 0
+
+
+def main_batch(args, df):
+    # Batch API run in steps that need no GUI: submit the rows, then wait for the job or merge it later
+    assembled_prompt = engine.read_prompt(args.prompt[0])
+    input_fields, missing, unused = engine.prompt_input_fields(df.columns, assembled_prompt)
+    engine.warn_input_fields(missing, unused)
+    if args.batch == "submit":
+        path = args.output + ".requests.jsonl"
+        count = engine.write_batch_file(df.iloc[args.start:args.end], input_fields, assembled_prompt, path)
+        batch = engine.submit_batch_job(path)
+        print(f"Wrote {count} batch requests to {path} and submitted batch job {batch.id}")
+        print(f"Merge its replies into {args.output} with the same command and --batch merge --batch-id {batch.id} "
+              "once it has finished, or with --batch wait to wait for it")
+        return 0
+    output_headers = engine.parse_output_fields(assembled_prompt)
+    if not output_headers:
+        print("Warning: no 'Output_Fields will be [...]' line found in the prompt", file=sys.stderr)
+    engine.add_output_columns(df, output_headers)
+    if args.batch == "wait":
+        batch = engine.wait_for_batch_job(args.batch_id, args.poll, lambda message: print(message, flush=True))
+    else:
+        batch = engine.get_client().batches.retrieve(args.batch_id)
+        if batch.status not in FINISHED_STATES:
+            print(f"Batch job {batch.id} is {batch.status}. Try again later.")
+            return BATCH_RUNNING
+    processed_records, cumulative_error_details = engine.merge_batch_results(df, batch, input_fields, assembled_prompt,
+                                                                             inputfile=args.input)
+    for error in cumulative_error_details:
+        print(f"Batch error: {error}", file=sys.stderr)
+    engine.export_results(df, args.output)
+    print(f"Batch job {batch.id} {batch.status}: merged {processed_records} rows, "
+          f"{len(cumulative_error_details)} errors. Results written to {args.output}")
+    return 1 if cumulative_error_details or batch.status != "completed" else 0
+
+
+def main_streaming(args):
+    assembled_prompt = engine.read_prompt(args.prompt[0])
+    print("Estimate:", describe_estimate(streaming_estimate(args, assembled_prompt)))
+    if args.estimate:
+        return 0
+    started = time.monotonic()
+    failures = {}
+    summary = engine.run_streaming(args.input, assembled_prompt, args.output, chunksize=args.chunksize,
+                                   start=args.start, stop=args.end, confirm_resume=resume_policy(args),
+                                   on_row=failure_collector(progress_printer("?", started), failures),
+                                   shard=args.shard, max_in_flight=args.concurrency,
+                                   rows_per_request=args.rows_per_request, use_cache=not args.no_cache,
+                                   budget=args.budget, previous=previous_results(args, assembled_prompt))
+    if args.shard:
+        write_error_report(args.output, failures)
+    return print_summary(summary, started, args)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    telemetry.configure(args.telemetry, args.log_level, engine.AZURE_OPENAI_CONSOLE_LEVEL)
+    if args.reprocess:
+        return main_reprocess(args)
+    if args.chunksize:
+        return main_streaming(args)
+    df = engine.read_table(args.input)
+    if args.batch:
+        return main_batch(args, df)
+    if len(args.prompt) > 1:
+        return main_fanout(args, df)
+    assembled_prompt = engine.read_prompt(args.prompt[0])
+    input_fields, missing, unused = engine.prompt_input_fields(df.columns, assembled_prompt)
+    engine.warn_input_fields(missing, unused)
+    output_headers = engine.parse_output_fields(assembled_prompt)
+    if not output_headers:
+        print("Warning: no 'Output_Fields will be [...]' line found in the prompt", file=sys.stderr)
+    engine.add_output_columns(df, output_headers)
+    journal_scope = ""
+    if args.shard:
+        df = engine.select_shard(df, input_fields, args.shard).copy()
+        journal_scope = shard_label(*args.shard)
+        print(f"Shard {args.shard[0]}/{args.shard[1]} ({args.shard[2]}): {len(df)} rows")
+
+    print("Estimate:", describe_estimate(engine.estimate_submission(
+        df, input_fields, assembled_prompt, start=args.start, stop=args.end,
+        rows_per_request=args.rows_per_request, max_in_flight=args.concurrency)))
+    if args.estimate:
+        return 0
+    total = len(df.iloc[args.start:args.end])
+    started = time.monotonic()
+    failures = {}
+    summary = engine.run_submission(df, input_fields, assembled_prompt, inputfile=args.input,
+                                    start=args.start, stop=args.end, max_in_flight=args.concurrency,
+                                    rows_per_request=args.rows_per_request, use_cache=not args.no_cache,
+                                    on_row=failure_collector(progress_printer(total, started), failures),
+                                    confirm_resume=resume_policy(args), budget=args.budget,
+                                    previous=previous_results(args, assembled_prompt), journal_scope=journal_scope)
+
+    if args.shard:
+        df.insert(0, ROW_INDEX_COLUMN, df.index)  # position in the input table, for merge_shards.py
+        write_error_report(args.output, failures)
+    engine.export_results(df, args.output)
+    return print_summary(summary, started, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
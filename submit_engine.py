@@ -0,0 +1,1393 @@
+# Engine behind the batch query submission GUI (submit-retrieve.py) and the command line
+# entry point (submit_cli.py): loading tables and prompts, submitting rows to the Azure OpenAI
+# deployment, merging the replies into the table and exporting the results.
+# Nothing in here touches Tk, so it can be imported, scripted, run from cron or benchmarked on
+# machines without a display.
+# You will need to specify your own URL for your AZURE_OPENAI_ENDPOINT and also your AZURE_OPENAI_KEY
+# where indicated in the code.
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from contextlib import nullcontext
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import pandas as pd
+from openai import AzureOpenAI
+from openai import BadRequestError  # need to error catch if a prompt violates policy filters
+
+from rate_limiter import TRANSIENT_ERRORS, estimate_tokens
+from endpoint_pool import Endpoint, EndpointPool, load_endpoints
+from row_packing import PACKING_INSTRUCTIONS, pack_rows, build_packed_query, parse_packed_reply
+from map_reduce import (MAP_INSTRUCTIONS, REDUCE_INSTRUCTIONS, answer_tokens, build_reduce_query, group_answers,
+                        is_context_length_error, reduce_request_count, split_row_to_fit)
+from batch_mode import write_batch_requests, submit_batch, wait_for_batch, read_batch_results
+from response_cache import ResponseCache, cache_key, prompt_digest, row_cache_key
+from run_journal import RunJournal, journal_path, load_journal
+from cost_estimator import SAMPLE_ROWS, estimate_run, token_cost
+from structured_output import response_format, is_unsupported_error, extract_json, missing_fields
+from incremental_run import (FINGERPRINT_COLUMNS, FINGERPRINT_LENGTH, PROMPT_FINGERPRINT_COLUMN, ROW_FINGERPRINT_COLUMN,
+                             row_fingerprint, prompt_fingerprint, read_results, previous_answers)
+from sharding import ROW_INDEX_COLUMN, range_bounds, in_hash_shard, shard_label
+from results_store import EXPORT_BATCH_ROWS, ResultsStore, write_store, write_xlsx, export_store_to_xlsx
+from telemetry import telemetry
+from text_encoding import detect_encoding
+from dead_letter import (REPROCESSED_CLASSES, STRICT_JSON_INSTRUCTIONS, BatchRequestError, ContentFilteredError,
+                         DeadLetterStore, UnexpectedReplyError, classify_error, letter_source)
+
+# URL and key for Azure OpenAI go here
+AZURE_OPENAI_ENDPOINT = os.environ.get("AZURE_OPENAI_ENDPOINT", "https://[copy URL for your AI endpoint here]/")
+AZURE_OPENAI_KEY = os.environ.get("AZURE_OPENAI_KEY", "[your open AI key goes here]")
+AZURE_OPENAI_API_VERSION = "2024-08-01-preview"  # structured outputs need 2024-08-01-preview or later
+
+# Set the model type (eg. gpt 3.5, and specific name of the deployed model in our azure instance)
+AZURE_OPENAI_MODEL = os.environ.get("AZURE_OPENAI_MODEL",
+                                    "gpt-4o-mini")  # switch to 'gpt-4o' to use the gpt4o model (10x more expensive per token)
+AZURE_OPENAI_MODEL_NAME = os.environ.get("AZURE_OPENAI_MODEL_NAME",
+                                         "gpt-4o-mini")  # switch to 'gpt-4o' to use the gpt4o model
+
+# Cascade: when AZURE_OPENAI_ESCALATION_MODEL names a stronger deployment (e.g. 'gpt-4o'), every row is
+# still sent to AZURE_OPENAI_MODEL first, and only rows whose reply is unparseable, misses Output_Fields or
+# reports a Confidence item below AZURE_OPENAI_ESCALATE_BELOW are re-sent to the stronger deployment.
+# The deployment that produced each row's answer is recorded in the TIER_COLUMN column.
+AZURE_OPENAI_ESCALATION_MODEL = os.environ.get("AZURE_OPENAI_ESCALATION_MODEL", "")
+AZURE_OPENAI_ESCALATION_MODEL_NAME = os.environ.get("AZURE_OPENAI_ESCALATION_MODEL_NAME", AZURE_OPENAI_ESCALATION_MODEL)
+AZURE_OPENAI_ESCALATE_BELOW = float(os.environ.get("AZURE_OPENAI_ESCALATE_BELOW", "0"))  # 0 = ignore Confidence
+CONFIDENCE_FIELD = "Confidence"  # add it to the prompt's Output_Fields (e.g. as 0-100) to escalate on confidence
+TIER_COLUMN = "Answered_By"
+
+# Name of the Global-Batch deployment used by the offline Batch API mode
+AZURE_OPENAI_BATCH_MODEL = os.environ.get("AZURE_OPENAI_BATCH_MODEL", AZURE_OPENAI_MODEL)
+
+# Maximum number of rows that may be awaiting a reply from Azure at the same time.
+# Raise this towards what your deployment's quota allows; 1 reproduces the old one-row-at-a-time behaviour.
+MAX_IN_FLIGHT = int(os.environ.get("AZURE_OPENAI_MAX_IN_FLIGHT", "8"))
+
+# To spread the load over several deployments (e.g. the same model in several regions), list them in a
+# JSON file and set AZURE_OPENAI_ENDPOINTS to its path (format in endpoint_pool.py). Otherwise the
+# endpoint, key and deployment above are used on their own.
+AZURE_OPENAI_ENDPOINTS = os.environ.get("AZURE_OPENAI_ENDPOINTS", "")
+
+# Quota of the deployment as shown in Azure AI Studio (0 = unknown, pace only on 429s and rate limit headers)
+AZURE_OPENAI_TPM = int(os.environ.get("AZURE_OPENAI_TPM", "0"))  # tokens per minute
+AZURE_OPENAI_RPM = int(os.environ.get("AZURE_OPENAI_RPM", "0"))  # requests per minute
+AZURE_OPENAI_MAX_RETRIES = int(os.environ.get("AZURE_OPENAI_MAX_RETRIES", "6"))
+EXPECTED_COMPLETION_TOKENS = 300  # allowance for the reply when estimating a request's token cost
+EXPECTED_SECONDS_PER_REQUEST = 2.0  # typical reply latency, used by the pre-flight time estimate
+
+# Ask for replies matching a JSON schema built from the prompt's Output_Fields (structured outputs).
+# Set to 0 for deployments whose model does not support it; it is also switched off automatically
+# for the rest of the session if the deployment rejects it.
+AZURE_OPENAI_STRUCTURED_OUTPUTS = os.environ.get("AZURE_OPENAI_STRUCTURED_OUTPUTS", "1") != "0"
+
+# Spending cap for one run in USD (0 = no cap): no request is sent that could take the run past it
+AZURE_OPENAI_BUDGET_USD = float(os.environ.get("AZURE_OPENAI_BUDGET_USD", "0"))
+
+# Multi-row packing: send up to ROWS_PER_REQUEST rows in one chat completion (1 = one row per request).
+# PACK_TOKEN_BUDGET caps the estimated input + output tokens of the rows packed into a single request.
+ROWS_PER_REQUEST = int(os.environ.get("AZURE_OPENAI_ROWS_PER_REQUEST", "1"))
+PACK_TOKEN_BUDGET = int(os.environ.get("AZURE_OPENAI_PACK_TOKEN_BUDGET", "6000"))
+
+# Map-reduce for rows too long for one request (see map_reduce.py): a row whose text is estimated above
+# AZURE_OPENAI_MAX_ROW_TOKENS (0 = whatever fits in AZURE_OPENAI_CONTEXT_TOKENS next to the prompt and the
+# reply), or that the service rejects for exceeding the context, has its long cells split into parts of
+# AZURE_OPENAI_MAP_CHUNK_TOKENS (smaller if a part would not fit in the context) that are sent in parallel
+# (up to AZURE_OPENAI_MAP_PARALLEL at a time, on request slots of the run's window left idle, so no more
+# than max_in_flight requests are ever outstanding), and one more request combines their answers (in
+# groups that fit in the context first, if they do not all fit in one request). Set AZURE_OPENAI_MAP_REDUCE=0 to let such rows fail instead.
+AZURE_OPENAI_MAP_REDUCE = os.environ.get("AZURE_OPENAI_MAP_REDUCE", "1") != "0"
+AZURE_OPENAI_CONTEXT_TOKENS = int(os.environ.get("AZURE_OPENAI_CONTEXT_TOKENS", "128000"))
+AZURE_OPENAI_MAX_ROW_TOKENS = int(os.environ.get("AZURE_OPENAI_MAX_ROW_TOKENS", "0"))
+AZURE_OPENAI_MAP_CHUNK_TOKENS = int(os.environ.get("AZURE_OPENAI_MAP_CHUNK_TOKENS", "8000"))
+AZURE_OPENAI_MAP_PARALLEL = int(os.environ.get("AZURE_OPENAI_MAP_PARALLEL", "4"))
+
+# Replies are cached on disk keyed by (deployment, prompt, row) so re-runs and duplicate rows are free
+AZURE_OPENAI_CACHE_PATH = os.environ.get("AZURE_OPENAI_CACHE_PATH", "response_cache.sqlite3")
+AZURE_OPENAI_CACHE_MAX_MB = int(os.environ.get("AZURE_OPENAI_CACHE_MAX_MB", "500"))
+
+# Rows that still fail after all retries are kept in a dead-letter store (see dead_letter.py) for
+# reprocess_dead_letters to re-send. Rows that exceeded the context are re-sent to
+# AZURE_OPENAI_LONG_CONTEXT_MODEL, a deployment with a larger context window, if one is set, and split
+# with map-reduce otherwise.
+AZURE_OPENAI_DEAD_LETTER_PATH = os.environ.get("AZURE_OPENAI_DEAD_LETTER_PATH", "dead_letters.sqlite3")
+AZURE_OPENAI_LONG_CONTEXT_MODEL = os.environ.get("AZURE_OPENAI_LONG_CONTEXT_MODEL", "")
+AZURE_OPENAI_LONG_CONTEXT_MODEL_NAME = os.environ.get("AZURE_OPENAI_LONG_CONTEXT_MODEL_NAME",
+                                                      AZURE_OPENAI_LONG_CONTEXT_MODEL)
+
+# Run telemetry (see telemetry.py): JSON-lines log file (none if empty), its level and the console's level
+AZURE_OPENAI_TELEMETRY_PATH = os.environ.get("AZURE_OPENAI_TELEMETRY_PATH", "")
+AZURE_OPENAI_LOG_LEVEL = os.environ.get("AZURE_OPENAI_LOG_LEVEL", "INFO")
+AZURE_OPENAI_CONSOLE_LEVEL = os.environ.get("AZURE_OPENAI_CONSOLE_LEVEL", "INFO")
+telemetry.configure(AZURE_OPENAI_TELEMETRY_PATH, AZURE_OPENAI_LOG_LEVEL, AZURE_OPENAI_CONSOLE_LEVEL)
+
+client = None  # created on first use so that importing the engine needs no credentials
+endpoint_pool = None
+response_cache = None
+dead_letters = None
+structured_outputs = AZURE_OPENAI_STRUCTURED_OUTPUTS
+worker_state = threading.local()  # request_slots: the max_in_flight window of the run a worker thread is serving
+
+
+class UsageCounter:
+    # Tokens reported by the service for the current run, summed across worker threads, and their cost
+    def __init__(self, model):
+        self.model = model  # model type the prices are looked up for unless add() names another
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.prompt_tokens = 0
+            self.completion_tokens = 0
+            self.by_model = {}  # model -> [prompt tokens, completion tokens]
+
+    def add(self, usage, model=None):
+        if usage is None:
+            return
+        with self.lock:
+            self.requests += 1
+            self.prompt_tokens += usage.prompt_tokens or 0
+            self.completion_tokens += usage.completion_tokens or 0
+            tokens = self.by_model.setdefault(model or self.model, [0, 0])
+            tokens[0] += usage.prompt_tokens or 0
+            tokens[1] += usage.completion_tokens or 0
+
+    @property
+    def total_tokens(self):
+        return self.prompt_tokens + self.completion_tokens
+
+    @property
+    def cost(self):
+        with self.lock:  # worker threads add models to by_model while the run is in progress
+            by_model = [(model, prompt, completion) for model, (prompt, completion) in self.by_model.items()]
+        return sum(token_cost(model, prompt, completion) for model, prompt, completion in by_model)
+
+    def describe(self):
+        with self.lock:
+            requests, prompt_tokens, completion_tokens = self.requests, self.prompt_tokens, self.completion_tokens
+        return (f"{requests} requests, {prompt_tokens:,} prompt + {completion_tokens:,} "
+                f"completion tokens, ${self.cost:.4f}")
+
+
+token_usage = UsageCounter(AZURE_OPENAI_MODEL_NAME)
+
+
+class RunControl:
+    # Lets another thread (e.g. the GUI) pause, resume or cancel a run. Requests already in flight
+    # are always allowed to finish so that their answers are written and journaled.
+    def __init__(self):
+        self.resumed = threading.Event()
+        self.resumed.set()
+        self.cancelled = threading.Event()
+
+    def pause(self):
+        self.resumed.clear()
+
+    def resume(self):
+        self.resumed.set()
+
+    def cancel(self):
+        self.cancelled.set()
+        self.resumed.set()  # wake a paused run so it can wind down
+
+    def accepting(self):
+        return self.resumed.is_set() and not self.cancelled.is_set()
+
+
+def get_client():
+    # Client for AZURE_OPENAI_ENDPOINT, used for the Batch API (files and batch jobs)
+    global client
+    if client is None:
+        client = AzureOpenAI(
+            azure_endpoint=AZURE_OPENAI_ENDPOINT,
+            api_key=AZURE_OPENAI_KEY,
+            api_version=AZURE_OPENAI_API_VERSION,
+            max_retries=0,  # batch jobs are submitted once; failures are reported to the user
+        )
+    return client
+
+
+def get_endpoint_pool():
+    # Deployments chat completions are spread across; each has its own rate limiter and client
+    global endpoint_pool
+    if endpoint_pool is None:
+        if AZURE_OPENAI_ENDPOINTS:
+            endpoints = load_endpoints(AZURE_OPENAI_ENDPOINTS, AZURE_OPENAI_API_VERSION, AZURE_OPENAI_MODEL_NAME)
+        else:
+            endpoints = [Endpoint("default", AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_KEY, AZURE_OPENAI_MODEL,
+                                  AZURE_OPENAI_API_VERSION, tpm=AZURE_OPENAI_TPM, rpm=AZURE_OPENAI_RPM,
+                                  model=AZURE_OPENAI_MODEL_NAME)]
+        endpoint_pool = EndpointPool(endpoints)
+    return endpoint_pool
+
+
+def get_response_cache():
+    global response_cache
+    if response_cache is None:
+        response_cache = ResponseCache(AZURE_OPENAI_CACHE_PATH, max_bytes=AZURE_OPENAI_CACHE_MAX_MB * 1024 * 1024)
+    return response_cache
+
+
+def get_dead_letters():
+    global dead_letters
+    if dead_letters is None:
+        dead_letters = DeadLetterStore(AZURE_OPENAI_DEAD_LETTER_PATH)
+    return dead_letters
+
+
+# Streaming ingestion: rows are read and submitted STREAM_CHUNK_ROWS at a time
+STREAM_CHUNK_ROWS = int(os.environ.get("AZURE_OPENAI_STREAM_CHUNK_ROWS", "5000"))
+
+
+def read_table(path):
+    # Tab-delimited text or Excel; raises ValueError for anything else
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.txt':
+        encoding = detect_encoding(path)
+        try:
+            return pd.read_csv(path, sep='\t', encoding=encoding)
+        except UnicodeDecodeError:
+            if encoding == 'Windows-1252':
+                raise
+            return pd.read_csv(path, sep='\t', encoding='Windows-1252')  # not utf-8 after the sampled part
+    elif ext in ['.xls', '.xlsx']:
+        return pd.read_excel(path)
+    raise ValueError("Unsupported file type selected.")
+
+
+def iter_table_chunks(path, chunksize=None):
+    # Yields the table as DataFrames of at most chunksize rows. Index labels continue across chunks
+    # (0..n-1 for the whole file) so journal entries and row ranges refer to the same rows as read_table.
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.txt':
+        # Chunks already submitted cannot be decoded again, so the whole file is checked before the first one
+        # (and is then decoded exactly as read_table decodes it)
+        yield from pd.read_csv(path, sep='\t', encoding=detect_encoding(path, whole_file=True),
+                               chunksize=chunksize or STREAM_CHUNK_ROWS)
+    elif ext in ['.xls', '.xlsx']:
+        yield pd.read_excel(path)  # Excel files cannot be read incrementally
+    else:
+        raise ValueError("Unsupported file type selected.")
+
+
+def count_rows(path, chunksize=None):
+    # Number of data rows in a table, read chunk by chunk
+    return sum(len(chunk) for chunk in iter_table_chunks(path, chunksize))
+
+
+def read_prompt(path):
+    encodings = ['utf-8', 'Windows-1252']  # List of encodings to try
+    for encoding in encodings:
+        try:
+            with open(path, "r", encoding=encoding) as file:
+                return file.read()
+        except UnicodeDecodeError as e:
+            last_error = e  # Store the last error message
+    raise last_error
+
+
+def read_prompts(paths):
+    # [(name, assembled prompt)] for a fan-out run (see run_fanout), each named after its file
+    prompts = []
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name in dict(prompts):
+            raise ValueError(f"Two prompt files are named '{name}'; rename one so their output columns differ")
+        prompts.append((name, read_prompt(path)))
+    return prompts
+
+
+def parse_output_fields(assembled_prompt):
+    # Returns the names from the prompt's 'Output_Fields will be [...]' line (empty if there is none)
+    match = re.search(r"Output_Fields will be \[(.*?)\]", assembled_prompt)
+    if match:
+        return [header.strip() for header in match.group(1).split(',')]
+    return []
+
+
+def parse_input_fields(assembled_prompt):
+    # Returns the names from the prompt's 'Input_Fields will be [...]' line (empty if there is none, as in
+    # prompts saved by older versions of query_formatter.py). The line is a JSON array; prompts saved before
+    # it was (e.g. [Name, Date of Birth]) are split on commas.
+    match = re.search(r"Input_Fields will be (\[.*\])", assembled_prompt)
+    if not match:
+        return []
+    try:
+        listed = json.loads(match.group(1))
+    except json.JSONDecodeError:
+        listed = match.group(1)[1:-1].split(',')
+    if not isinstance(listed, list):
+        listed = [listed]
+    return [str(field).strip() for field in listed if str(field).strip()]
+
+
+def prompt_input_fields(columns, assembled_prompt):
+    # Returns (fields, missing, unused): the columns sent with each row, which are the ones the prompt's
+    # Input_Fields line lists in the prompt's order (all of them if the prompt has no such line); the
+    # listed fields the table does not have; and the table's columns that will not be sent.
+    columns = list(columns)
+    listed = parse_input_fields(assembled_prompt)
+    if not listed:
+        return columns, [], []
+    by_name = {str(column).strip(): column for column in columns}
+    fields = [by_name[field] for field in listed if field in by_name]
+    missing = [field for field in listed if field not in by_name]
+    if not fields:
+        raise ValueError(f"None of the prompt's Input_Fields ({', '.join(listed)}) are columns of the table")
+    results = set(output_columns(parse_output_fields(assembled_prompt)))
+    unused = [column for column in columns if column not in fields and column not in results]
+    return fields, missing, unused
+
+
+def output_columns(output_headers):
+    # The prompt's Output_Fields plus the columns the engine fills in itself
+    tier = [TIER_COLUMN] if AZURE_OPENAI_ESCALATION_MODEL else []
+    return output_headers + tier + FINGERPRINT_COLUMNS
+
+
+def answering_model():
+    # What answers the rows: the deployment (all the deployments of AZURE_OPENAI_ENDPOINTS), or the pair of
+    # tiers of a cascade
+    if AZURE_OPENAI_ESCALATION_MODEL:
+        return f"{get_endpoint_pool().deployments()}>{AZURE_OPENAI_ESCALATION_MODEL}"
+    return get_endpoint_pool().deployments()
+
+
+def load_previous_results(path, assembled_prompt, prefix=""):
+    # Returns ({row fingerprint: result}, rows answered under a different prompt or model) from an
+    # earlier results file, for run_submission(previous=...) to reuse. prefix selects one prompt's
+    # columns of a fan-out run's results (see run_fanout).
+    result_columns = [column for column in output_columns(parse_output_fields(assembled_prompt))
+                      if column not in FINGERPRINT_COLUMNS]
+    results = read_results(path)
+    if prefix:
+        results = results[[column for column in results.columns if column.startswith(prefix)]]
+        results = results.rename(columns=lambda column: column[len(prefix):])
+    return previous_answers(results, prompt_fingerprint(answering_model(), assembled_prompt), result_columns)
+
+
+def add_output_columns(df, output_headers, prefix=""):
+    # Create the output columns up front so they appear in exports even for rows that failed
+    for header in output_columns(output_headers):
+        if prefix + header not in df.columns:
+            df[prefix + header] = ""  # Add new columns with empty values
+    return df
+
+
+def serialize_rows(df, input_fields):
+    # Builds every row's tab-delimited text in one column-wise pass instead of a Series per row.
+    # Returns (payloads, hashes): lists aligned with df's rows by position, hashes being the
+    # SHA-256 of each payload, used by the cache and duplicate detection.
+    if len(df) == 0 or not input_fields:
+        payloads = [""] * len(df)
+    else:
+        # fillna: newer pandas keeps missing values as NaN through astype(str); send them as 'nan' as before
+        columns = [df[field].astype(str).fillna("nan") for field in input_fields]
+        payloads = columns[0].str.cat(columns[1:], sep='\t').tolist() if len(columns) > 1 else columns[0].tolist()
+    hashes = [hashlib.sha256(payload.encode("utf-8")).hexdigest() for payload in payloads]
+    return payloads, hashes
+
+
+def row_payloads(df, input_fields):
+    # Yields (df index, tab-delimited row text) for each row
+    payloads, _ = serialize_rows(df, input_fields)
+    return zip(df.index, payloads)
+
+
+def select_shard(df, input_fields, shard, total_rows=None):
+    # Rows of df that belong to shard (index, count, mode), see sharding.py. df's index labels must be
+    # the rows' positions in the input table; range shards need the table's total_rows when df is only
+    # part of it (e.g. a streamed chunk).
+    index, count, mode = shard
+    if mode == "range":
+        start, stop = range_bounds(index, count, len(df) if total_rows is None else total_rows)
+        return df[(df.index >= start) & (df.index < stop)]
+    _, hashes = serialize_rows(df, input_fields)
+    return df[in_hash_shard(hashes, index, count)]
+
+
+def estimate_submission(df, input_fields, assembled_prompt, start=0, stop=None, row_limit=None,
+                        rows_per_request=None, max_in_flight=None, total_rows=None):
+    # Pre-flight projection of tokens, cost and time for sending rows start..stop of df (see
+    # cost_estimator.estimate_run). total_rows overrides the row count when df is only part of the
+    # table, e.g. the first chunk of a streamed file.
+    rows_per_request = rows_per_request or ROWS_PER_REQUEST
+    selected = df.iloc[start:stop]
+    if row_limit is not None:
+        selected = selected.head(row_limit)
+    payloads, _ = serialize_rows(selected.sample(n=min(SAMPLE_ROWS, len(selected)), random_state=0), input_fields)
+    prompt = assembled_prompt + PACKING_INSTRUCTIONS if rows_per_request > 1 else assembled_prompt
+    return estimate_run(prompt, payloads, len(selected) if total_rows is None else total_rows,
+                        AZURE_OPENAI_MODEL_NAME, rows_per_request=rows_per_request,
+                        completion_tokens_per_row=EXPECTED_COMPLETION_TOKENS,
+                        tokens_per_minute=AZURE_OPENAI_TPM, requests_per_minute=AZURE_OPENAI_RPM,
+                        max_in_flight=max_in_flight or MAX_IN_FLIGHT, seconds_per_request=EXPECTED_SECONDS_PER_REQUEST)
+
+
+def request_format(assembled_prompt, packed=False):
+    # response_format for a request with this prompt, or None to let the model reply free-form
+    if not structured_outputs:
+        return None
+    return response_format(tuple(parse_output_fields(assembled_prompt)), packed)
+
+
+def run_conversation_w_input0(input, assembled_prompt, expected_completion_tokens=EXPECTED_COMPLETION_TOKENS,
+                              packed=False, escalate=False, deployment=None, model_name=None):
+    # escalate sends the request to AZURE_OPENAI_ESCALATION_MODEL instead of each endpoint's own deployment;
+    # deployment sends it to any other one, priced as model_name (e.g. AZURE_OPENAI_LONG_CONTEXT_MODEL)
+    global structured_outputs
+    if escalate:
+        deployment, model_name = AZURE_OPENAI_ESCALATION_MODEL, AZURE_OPENAI_ESCALATION_MODEL_NAME
+    messages = [{"role": "system", "content": f"""{assembled_prompt}
+    """
+                 },
+                {"role": "user", "content": input}, ]
+    options = {}
+    output_format = request_format(assembled_prompt, packed)
+    if output_format is not None:
+        options["response_format"] = output_format
+
+    # this is the actual chat completion API call
+    telemetry.log("DEBUG", "evaluating", input=input)
+    estimated_tokens = estimate_tokens(assembled_prompt + input) + expected_completion_tokens
+    try:
+        response, endpoint = get_endpoint_pool().call_with_retry(
+            estimated_tokens,
+            lambda endpoint: endpoint.get_client().chat.completions.with_raw_response.create(
+                model=deployment or endpoint.deployment,
+                messages=messages,
+                **options,
+            ),
+            max_retries=AZURE_OPENAI_MAX_RETRIES)
+    except BadRequestError as e:
+        if output_format is None or not is_unsupported_error(e):
+            raise
+        telemetry.log("WARNING", "structured_outputs_unsupported",
+                      f"Deployment does not support structured outputs, continuing without them: {e}", error=str(e))
+        structured_outputs = False
+        return run_conversation_w_input0(input, assembled_prompt, expected_completion_tokens, packed,
+                                         deployment=deployment, model_name=model_name)
+    token_usage.add(response.usage, model_name or endpoint.model)  # priced as the deployment that answered
+    if response.usage is not None:
+        telemetry.add("prompt_tokens", response.usage.prompt_tokens or 0)
+        telemetry.add("completion_tokens", response.usage.completion_tokens or 0)
+    telemetry.log("DEBUG", "response", response=response)
+    return response
+
+
+def extract_json_content(results):
+    # Raises ContentFilteredError if the output-side content filter withheld the reply
+    choice = results.choices[0]
+    if choice.finish_reason == "content_filter" or choice.message.content is None:
+        raise ContentFilteredError(choice.finish_reason)
+    return choice.message.content
+
+
+def parse_reply_content(content):
+    if content is None:  # e.g. a Batch API reply withheld by the content filter
+        raise ContentFilteredError()
+    # Now load the JSON data (code fences and any text around the JSON are ignored)
+    return extract_json(content)  # converts the json to a dict!
+
+
+def write_result(df, index, results_json, prefix=""):
+    # prefix is put before each column name (see run_fanout)
+    if isinstance(results_json, dict):  # Error Catching for occasional instances when chat completion comes back as a list
+        for key, value in results_json.items():
+            df.at[index, prefix + key] = str(value)  # Convert value to string before updating dataframe
+    elif isinstance(results_json, list):
+        telemetry.log("WARNING", "unexpected_reply", f"Received a list instead of a dictionary: {results_json}",
+                      index=index, reply=results_json)
+        # Handle the list case as needed
+    else:
+        telemetry.log("WARNING", "unexpected_reply", f"Unexpected response format: {results_json}",
+                      index=index, reply=results_json)
+
+
+def row_token_limit(assembled_prompt):
+    # Largest row (in estimated tokens) sent in a single request
+    if AZURE_OPENAI_MAX_ROW_TOKENS:
+        return AZURE_OPENAI_MAX_ROW_TOKENS
+    return AZURE_OPENAI_CONTEXT_TOKENS - estimate_tokens(assembled_prompt) - EXPECTED_COMPLETION_TOKENS
+
+
+def timed_part(call, *args):
+    # Runs call on a map-reduce worker thread; returns (result or exception, its telemetry record)
+    telemetry.start_request(0.0, 0)
+    try:
+        outcome = call(*args)
+    except Exception as e:
+        outcome = e
+    return outcome, telemetry.finish_request()
+
+
+def split_long_row(row_prep, assembled_prompt):
+    # (map queries, reduce row) for a row too long for one request, with parts that fit next to the map prompt
+    return split_row_to_fit(row_prep, AZURE_OPENAI_MAP_CHUNK_TOKENS, row_token_limit(assembled_prompt + MAP_INSTRUCTIONS))
+
+
+def reduce_token_limit(assembled_prompt, reduce_row):
+    # Room for partial answers in a reduce request, next to the reduce prompt and the row's short fields
+    return row_token_limit(assembled_prompt + REDUCE_INSTRUCTIONS) - estimate_tokens(reduce_row) \
+        - estimate_tokens(build_reduce_query("", []))
+
+
+def map_reduce_row(row_prep, assembled_prompt, escalate=False):
+    # Answers a row too long for one request (see map_reduce.py); None if no cell of it is long enough to split.
+    # Raises the first error of any part, like a single request would.
+    queries, reduce_row = split_long_row(row_prep, assembled_prompt)
+    if not queries:
+        return None
+    telemetry.count("map_reduce_rows_total")
+    telemetry.count("map_reduce_parts_total", len(queries))
+    telemetry.log("DEBUG", "map_reduce", parts=len(queries), row_tokens=estimate_tokens(row_prep))
+
+    def answer_part(query):
+        results = run_conversation_w_input0(f""" {query} .""", assembled_prompt + MAP_INSTRUCTIONS, escalate=escalate)
+        return parse_reply_content(extract_json_content(results))
+
+    # The parts run on this request's own slot plus whichever slots of the window are idle, never beyond it
+    slots = getattr(worker_state, "request_slots", None)
+    spare = 0
+    while slots is not None and spare < min(AZURE_OPENAI_MAP_PARALLEL, len(queries)) - 1 \
+            and slots.acquire(blocking=False):
+        spare += 1
+    try:
+        with ThreadPoolExecutor(max_workers=1 + spare) as executor:
+            parts = list(executor.map(lambda query: timed_part(answer_part, query), queries))
+    finally:
+        for _ in range(spare):
+            slots.release()
+    for _, request in parts:
+        telemetry.absorb(request)
+    for outcome, _ in parts:
+        if isinstance(outcome, Exception):
+            raise outcome
+
+    def reduce_answers(answers):
+        query = f""" {build_reduce_query(reduce_row, answers)} ."""
+        results = run_conversation_w_input0(query, assembled_prompt + REDUCE_INSTRUCTIONS, escalate=escalate)
+        return parse_reply_content(extract_json_content(results))
+
+    # Answers that do not fit in one reduce request are combined in groups that do, until one request is left
+    answers = [outcome for outcome, _ in parts]
+    limit = reduce_token_limit(assembled_prompt, reduce_row)
+    while True:
+        groups = group_answers([answer_tokens(answer) for answer in answers], limit)
+        if len(groups) == 1:
+            return reduce_answers(answers)
+        telemetry.count("map_reduce_group_reduces_total", sum(1 for group in groups if len(group) > 1))
+        answers = [reduce_answers([answers[position] for position in group]) if len(group) > 1
+                   else answers[group[0]] for group in groups]
+
+
+def process_row(row_prep, assembled_prompt, escalate=False):
+    # Runs on a worker thread: submit one row and decode the JSON reply. No DataFrame access here.
+    if AZURE_OPENAI_MAP_REDUCE and estimate_tokens(row_prep) > row_token_limit(assembled_prompt):
+        outcome = map_reduce_row(row_prep, assembled_prompt, escalate)
+        if outcome is not None:
+            return outcome
+    query = f""" {row_prep} ."""  # Keep triple quotes for this. Use f-string to insert the variables.
+    try:
+        results = run_conversation_w_input0(query, assembled_prompt, escalate=escalate)
+    except BadRequestError as e:
+        # The estimate can fall short (e.g. for text that tokenizes densely): split the row after all
+        outcome = map_reduce_row(row_prep, assembled_prompt, escalate) \
+            if AZURE_OPENAI_MAP_REDUCE and is_context_length_error(e) else None
+        if outcome is None:
+            raise
+        return outcome
+    started = time.monotonic()
+    try:
+        return parse_reply_content(extract_json_content(results))
+    finally:
+        telemetry.add("parse_s", time.monotonic() - started)
+
+
+def needs_escalation(outcome, output_fields):
+    # True for replies the stronger deployment should redo: unparseable, not an object, missing Output_Fields, or
+    # less confident than AZURE_OPENAI_ESCALATE_BELOW. Refused and throttled requests are not retried.
+    if isinstance(outcome, json.JSONDecodeError):
+        return True
+    if isinstance(outcome, Exception):
+        return False
+    if not isinstance(outcome, dict):  # e.g. a list: it has no Output_Fields, even if the prompt names none
+        return True
+    if missing_fields(outcome, output_fields):
+        return True
+    confidence = outcome.get(CONFIDENCE_FIELD)
+    if AZURE_OPENAI_ESCALATE_BELOW and confidence is not None:
+        try:
+            return float(str(confidence).strip(" %")) < AZURE_OPENAI_ESCALATE_BELOW
+        except ValueError:
+            return True
+    return False
+
+
+def cascade(outcomes, assembled_prompt):
+    # Re-sends the rows needs_escalation picks out to the stronger deployment and tags every answer
+    # with the deployment that produced it
+    output_fields = parse_output_fields(assembled_prompt)
+    cascaded = []
+    for index, row_prep, outcome in outcomes:
+        tier = get_endpoint_pool().deployments()
+        if needs_escalation(outcome, output_fields):
+            telemetry.log("DEBUG", "escalate", index=index, model=AZURE_OPENAI_ESCALATION_MODEL)
+            telemetry.count("escalations_total")
+            try:
+                outcome = process_row(row_prep, assembled_prompt, escalate=True)
+                tier = AZURE_OPENAI_ESCALATION_MODEL
+            except (BadRequestError, json.JSONDecodeError, ContentFilteredError) + TRANSIENT_ERRORS as e:
+                outcome = e
+        if isinstance(outcome, dict):
+            outcome = dict(outcome, **{TIER_COLUMN: tier})
+        cascaded.append((index, row_prep, outcome))
+    return cascaded
+
+
+def process_batch(batch, assembled_prompt):
+    # Runs on a worker thread. batch is a list of (df index, row_prep); returns a list of
+    # (df index, row_prep, outcome) where outcome is the decoded reply or the exception it raised
+    outcomes = []
+    remaining = batch
+    if len(batch) > 1:
+        try:
+            results = run_conversation_w_input0(build_packed_query(batch), assembled_prompt + PACKING_INSTRUCTIONS,
+                                                expected_completion_tokens=EXPECTED_COMPLETION_TOKENS * len(batch),
+                                                packed=True)
+            started = time.monotonic()
+            packed_results, remaining = parse_packed_reply(extract_json_content(results), batch)
+            telemetry.add("parse_s", time.monotonic() - started)
+            outcomes.extend((index, row_prep, packed_results[index]) for index, row_prep in batch
+                            if index in packed_results)
+        except (BadRequestError, ContentFilteredError) + TRANSIENT_ERRORS as e:
+            telemetry.log("WARNING", "packed_request_failed",
+                          f"Packed request failed, falling back to single rows: {e}", error=type(e).__name__)
+        if remaining:
+            telemetry.log("INFO", "packing_fallback",
+                          f"Falling back to single-row requests for {len(remaining)} of {len(batch)} packed rows",
+                          rows=len(remaining), packed=len(batch))
+            telemetry.count("packing_fallback_rows_total", len(remaining))
+
+    for index, row_prep in remaining:
+        try:
+            outcomes.append((index, row_prep, process_row(row_prep, assembled_prompt)))
+        except (BadRequestError, json.JSONDecodeError, ContentFilteredError) + TRANSIENT_ERRORS as e:
+            outcomes.append((index, row_prep, e))
+    if AZURE_OPENAI_ESCALATION_MODEL:
+        outcomes = cascade(outcomes, assembled_prompt)
+    return outcomes
+
+
+def previous_run(inputfile, assembled_prompt, journal_scope=""):
+    # Returns (answered, failed) row counts of an interrupted run of this file and prompt, or None
+    # (finished runs delete their journal)
+    if not inputfile:
+        return None
+    previous = load_journal(journal_path(inputfile, assembled_prompt, answering_model(), journal_scope))
+    if not previous:
+        return None
+    answered = sum(1 for record in previous.values() if record["status"] == "ok")
+    return answered, len(previous) - answered
+
+
+def open_run_journal(inputfile, assembled_prompt, confirm_resume, journal_scope=""):
+    # Returns (journal, answered records). If an earlier run of the same file, prompt and model
+    # left a journal behind, confirm_resume(answered, failed) decides whether to resume it; the
+    # answered records are then restored into the table and only missing or failed rows re-sent.
+    # journal_scope keeps the journals of runs over different parts of the file (shards) apart.
+    if not inputfile:
+        return None, {}
+    path = journal_path(inputfile, assembled_prompt, answering_model(), journal_scope)
+    previous = load_journal(path)
+    answered = {}
+    resume = False
+    if previous:
+        answered = {key: record for key, record in previous.items() if record["status"] == "ok"}
+        resume = confirm_resume(len(answered), len(previous) - len(answered))
+        if resume:
+            telemetry.log("INFO", "resume", f"Resuming run: {len(answered)} answered rows found in {path}",
+                          answered=len(answered), journal=path)
+        else:
+            answered = {}
+    return RunJournal(path, resume=resume), answered
+
+
+def restore_answered(df, indexes, answered, df_lock, prefix=""):
+    # Writes journaled answers into the rows of df (among indexes) they belong to; returns those rows' index keys
+    completed = set()
+    if not answered:
+        return completed
+    with df_lock:
+        for index in indexes:
+            record = answered.get(str(index))
+            if record is not None:
+                write_result(df, index, record["result"], prefix)
+                completed.add(str(index))
+    return completed
+
+
+def log_row_error(index, kind, error):
+    telemetry.log("ERROR", "row_failed", f"Error occurred ({kind}) on row {index}: {error}",
+                  index=index, error_type=type(error).__name__, error=str(error))
+    telemetry.count("row_errors_total", error=type(error).__name__)
+
+
+def log_run_summary():
+    telemetry.log("INFO", "run_summary", usage=token_usage.describe(), **telemetry.summary())
+    telemetry.flush()
+
+
+def prepare_submission(df, input_fields, assembled_prompt, inputfile=None, row_limit=None, start=0, stop=None,
+                       rows_per_request=None, use_cache=True, on_row=None,
+                       confirm_resume=lambda answered, failed: True, control=None, df_lock=None,
+                       journal=None, answered=None, previous=None, journal_scope="", prefix="", serialized=None,
+                       replies=None):
+    # Sets up the submission of rows start..stop of df (at most row_limit of them) with one prompt, for
+    # run_submission or run_fanout. Returns (jobs, close, summarize): jobs yields (assembled_prompt, batch,
+    # finish, process_batch) for submit_jobs; close(finished) closes the journal if it was opened here,
+    # deleting it if the run finished (see run_finished);
+    # summarize(budget_exceeded) returns the summary dict described in run_submission.
+    # prefix is put before the names of the columns the replies are written to (see run_fanout), and
+    # serialized, if given, is serialize_rows' output for the selected rows with input_fields.
+    # replies, if given, maps df indexes to the outcomes of a finished Batch API job (the decoded reply or the
+    # exception the row failed with): those rows are recorded from it, nothing is sent and no journal is kept.
+    df_lock = df_lock or nullcontext()
+    rows_per_request = rows_per_request or ROWS_PER_REQUEST
+    cache = get_response_cache()
+    processed_records = 0
+    qc_record = ""  # capture the output of the LLM for any qc analysis needs
+    cumulative_error_details = []  # capture prompts that triggered errors during processing for display at the end of execution
+    selected = df.iloc[start:stop]
+    stopping_number = row_limit if row_limit is not None else len(selected)  # Limit to specified rows or all
+    pending = {}  # cache key -> df indexes waiting on the same request (identical rows are sent only once)
+    sent_keys = {}  # df index of each row actually sent -> its cache key
+    escalated = 0  # rows answered by AZURE_OPENAI_ESCALATION_MODEL
+    reused = 0  # rows copied from previous results
+    prompt_key = prompt_digest(answering_model(), assembled_prompt)  # cascaded answers are cached apart
+    prompt_fp = prompt_fingerprint(answering_model(), assembled_prompt)
+    owns_journal = journal is None and replies is None  # False when this is one piece of a streamed run
+    if owns_journal:
+        journal, answered = open_run_journal(inputfile, assembled_prompt, confirm_resume, journal_scope)
+    completed = restore_answered(df, selected.index, answered, df_lock, prefix)
+    # Failed rows are kept in the dead-letter store, and taken out of it once they are answered
+    letters = get_dead_letters() if inputfile else None
+    source = letter_source(inputfile) if inputfile else ""
+    open_letters = letters.indexes(source, prompt_fp, prefix) if letters is not None else set()
+
+    def record(index, row_prep, outcome):
+        nonlocal processed_records, qc_record, escalated
+        processed_records += 1
+        if not isinstance(outcome, (dict, Exception)):  # e.g. a list: there are no Output_Fields to write
+            outcome = UnexpectedReplyError(outcome)
+        if (AZURE_OPENAI_ESCALATION_MODEL and isinstance(outcome, dict)
+                and outcome.get(TIER_COLUMN) == AZURE_OPENAI_ESCALATION_MODEL):
+            escalated += 1
+        if isinstance(outcome, dict):  # stored with the answer for incremental re-runs
+            outcome = dict(outcome, **{ROW_FINGERPRINT_COLUMN: row_fingerprint(row_prep),
+                                       PROMPT_FINGERPRINT_COLUMN: prompt_fp})
+        if journal is not None:
+            if isinstance(outcome, Exception):
+                journal.record_error(index, outcome)
+            else:
+                journal.record_result(index, outcome)
+        if letters is not None:
+            if isinstance(outcome, Exception):
+                letters.add(source, prompt_fp, prefix, index, row_prep, outcome)
+            elif str(index) in open_letters:
+                letters.resolve(source, prompt_fp, prefix, index)
+        try:
+            if isinstance(outcome, Exception):
+                raise outcome
+            results_json = outcome
+            telemetry.log("DEBUG", "result", index=index, result=results_json)  # check the data type of results_json
+            with df_lock:
+                write_result(df, index, results_json, prefix)
+            qc_record += str(processed_records) + ": " + str(results_json) + "\n"
+        except BadRequestError as e:  # catch errors due to inadvertent content policy violations in prompts
+            log_row_error(index, "bad request", e)
+            cumulative_error_details.append(e)
+            cumulative_error_details.append(row_prep)
+        except json.JSONDecodeError as er:  # catch errors due to LLM occasionally returning incorrect JSON format
+            log_row_error(index, "JSON decode", er)
+            cumulative_error_details.append(er)
+            cumulative_error_details.append(row_prep)
+        except TRANSIENT_ERRORS as et:  # still throttled / timing out after all retries: skip the row, keep the run
+            log_row_error(index, "gave up after retries", et)
+            cumulative_error_details.append(et)
+            cumulative_error_details.append(row_prep)
+        except ContentFilteredError as ec:  # catch replies withheld by the output-side content filter
+            log_row_error(index, "content filter", ec)
+            cumulative_error_details.append(ec)
+            cumulative_error_details.append(row_prep)
+        except UnexpectedReplyError as eu:  # catch replies that are valid JSON but not an object
+            log_row_error(index, "unexpected reply", eu)
+            cumulative_error_details.append(eu)
+            cumulative_error_details.append(row_prep)
+        except BatchRequestError as eb:  # catch requests of a Batch API job that the service failed
+            log_row_error(index, "batch request", eb)
+            cumulative_error_details.append(eb)
+            cumulative_error_details.append(row_prep)
+        if on_row is not None:
+            on_row(processed_records, index, outcome)
+
+    def rows_to_send():
+        # Answers unchanged and cached rows straight away and holds back duplicates of rows already on their way
+        nonlocal reused
+        rows = selected.head(stopping_number)
+        payloads, hashes = serialized if serialized is not None else serialize_rows(rows, input_fields)
+        for index, row_prep, row_hash in zip(rows.index, payloads, hashes):
+            if replies is not None:
+                if index in replies:
+                    if isinstance(replies[index], dict):
+                        cache.put(row_cache_key(prompt_key, row_hash), replies[index])
+                    record(index, row_prep, replies[index])
+                continue
+            if completed and str(index) in completed:
+                continue  # answered in the run being resumed
+            if previous:
+                answer = previous.get(row_hash[:FINGERPRINT_LENGTH])
+                if answer is not None:
+                    reused += 1
+                    telemetry.count("reused_rows_total")
+                    record(index, row_prep, answer)
+                    continue
+            key = row_cache_key(prompt_key, row_hash)
+            if key in pending:
+                pending[key].append(index)
+                continue
+            cached = cache.get(key) if use_cache else None
+            if cached is not None:
+                telemetry.count("cache_hits_total")
+                record(index, row_prep, cached)
+                continue
+            pending[key] = [index]
+            sent_keys[index] = key
+            yield index, row_prep
+
+    def finish(index, row_prep, outcome):
+        # Called for each reply: store it and record it for every row that was waiting on it
+        key = sent_keys.pop(index)
+        if isinstance(outcome, dict):
+            cache.put(key, outcome)
+        for waiting_index in pending.pop(key):
+            record(waiting_index, row_prep, outcome)
+
+    def jobs():
+        for batch in pack_rows(rows_to_send(), rows_per_request, PACK_TOKEN_BUDGET, EXPECTED_COMPLETION_TOKENS):
+            yield assembled_prompt, batch, finish, process_batch
+
+    def close(finished=False):
+        if owns_journal and journal is not None:
+            if finished:
+                journal.discard()
+            else:
+                journal.close()
+
+    def summarize(budget_exceeded):
+        return {"processed_records": processed_records, "errors": cumulative_error_details, "qc_record": qc_record,
+                "cancelled": control is not None and control.cancelled.is_set(), "budget_exceeded": budget_exceeded,
+                "escalated": escalated, "reused": reused}
+
+    return jobs(), close, summarize
+
+
+def run_submission(df, input_fields, assembled_prompt, inputfile=None, row_limit=None, start=0, stop=None,
+                   max_in_flight=None, rows_per_request=None, use_cache=True, on_row=None,
+                   confirm_resume=lambda answered, failed: True, control=None, df_lock=None,
+                   journal=None, answered=None, budget=None, previous=None, journal_scope=""):
+    # Sends rows start..stop of df (at most row_limit of them) and writes the replies into df.
+    # on_row(processed_records, index, outcome) is called on the calling thread after each row,
+    # where outcome is the decoded reply or the exception that row failed with.
+    # control (a RunControl) pauses or cancels the run; df_lock, if given, is held while df is written
+    # so that another thread can read df safely while the run is in progress.
+    # journal and answered let a caller that submits a table in several pieces keep one journal open
+    # across them (see run_streaming); otherwise the journal is opened and closed here, under
+    # journal_scope if the run covers only part of inputfile (see open_run_journal).
+    # budget caps the run's spend in USD (default AZURE_OPENAI_BUDGET_USD, 0 = no cap); token_usage
+    # holds the spend so far, so for a streamed run the cap covers all of its pieces.
+    # previous ({row fingerprint: result}, see load_previous_results) answers unchanged rows from an
+    # earlier results file without sending them.
+    # Returns a summary dict with the processed count, the error details and the qc record.
+    max_in_flight = max_in_flight or MAX_IN_FLIGHT
+    budget = AZURE_OPENAI_BUDGET_USD if budget is None else budget
+    whole_run = journal is None  # False when this is one piece of a streamed run
+    if whole_run:
+        token_usage.reset()
+        telemetry.reset()
+    jobs, close, summarize = prepare_submission(df, input_fields, assembled_prompt, inputfile, row_limit, start, stop,
+                                                rows_per_request, use_cache, on_row, confirm_resume, control,
+                                                df_lock, journal, answered, previous, journal_scope)
+    finished = False
+    try:
+        budget_exceeded = submit_jobs(jobs, max_in_flight, control, budget)
+        finished = run_finished(control, budget_exceeded)
+    finally:
+        close(finished)
+    if whole_run:
+        log_run_summary()
+    return summarize(budget_exceeded)
+
+
+def run_finished(control, budget_exceeded):
+    # True unless the run was cancelled or stopped by its budget, i.e. there is nothing left to resume
+    return not budget_exceeded and not (control is not None and control.cancelled.is_set())
+
+
+def fanout_prefix(name):
+    # Output columns of the prompt called name are written as '<name>.<field>'
+    return f"{name}."
+
+
+def fanout_input_columns(columns, names):
+    # The columns of a fan-out table that are not the output of one of the prompts called names
+    prefixes = tuple(fanout_prefix(name) for name in names)
+    return [column for column in columns if not str(column).startswith(prefixes)]
+
+
+def run_fanout(df, prompts, inputfile=None, row_limit=None, start=0, stop=None, max_in_flight=None,
+               rows_per_request=None, use_cache=True, on_row=None, confirm_resume=lambda answered, failed: True,
+               control=None, df_lock=None, budget=None, previous=None, journal_scope="", input_columns=None):
+    # Runs several prompts over the same rows of df in one pass. prompts is a list of (name, assembled prompt);
+    # each prompt's replies go to its own columns (see fanout_prefix), and add_output_columns(df, ..., prefix)
+    # should have been called for each. Every (row, prompt) request is scheduled through one window of
+    # max_in_flight requests and one budget, with each row's requests for all prompts sent together.
+    # Rows are serialized once for all the prompts that send the same Input_Fields. Each prompt keeps its own
+    # cache entries and journal. previous maps prompt names to load_previous_results answers.
+    # input_columns are the table's own columns, before any output columns were added to df (by default the
+    # columns of df that are not a prompt's output, see fanout_input_columns).
+    # on_row(processed_records, index, outcome) counts (row, prompt) results. Returns {name: summary}
+    # (see run_submission).
+    max_in_flight = max_in_flight or MAX_IN_FLIGHT
+    budget = AZURE_OPENAI_BUDGET_USD if budget is None else budget
+    token_usage.reset()
+    telemetry.reset()
+    processed_records = 0
+
+    def count_row(_, index, outcome):
+        nonlocal processed_records
+        processed_records += 1
+        if on_row is not None:
+            on_row(processed_records, index, outcome)
+
+    rows = df.iloc[start:stop]
+    rows = rows.head(row_limit) if row_limit is not None else rows
+    if input_columns is None:
+        input_columns = fanout_input_columns(df.columns, [name for name, _ in prompts])
+    columns = list(input_columns)
+    serialized = {}  # tuple of input fields -> serialize_rows output for rows
+    submissions = {}
+    finished = False
+    try:
+        for name, assembled_prompt in prompts:
+            input_fields, missing, unused = prompt_input_fields(columns, assembled_prompt)
+            warn_input_fields(missing, unused)
+            fields = tuple(input_fields)
+            if fields not in serialized:
+                serialized[fields] = serialize_rows(rows, input_fields)
+            submissions[name] = prepare_submission(
+                df, input_fields, assembled_prompt, inputfile, row_limit, start, stop, rows_per_request, use_cache,
+                count_row, confirm_resume, control, df_lock, previous=(previous or {}).get(name),
+                journal_scope=journal_scope, prefix=fanout_prefix(name), serialized=serialized[fields])
+        budget_exceeded = submit_jobs(interleave(jobs for jobs, _, _ in submissions.values()),
+                                      max_in_flight, control, budget)
+        finished = run_finished(control, budget_exceeded)
+    finally:
+        for _, close, _ in submissions.values():
+            close(finished)
+    log_run_summary()
+    return {name: summarize(budget_exceeded) for name, (_, _, summarize) in submissions.items()}
+
+
+def interleave(iterables):
+    # Round-robin over several iterables until all are exhausted
+    iterators = [iter(iterable) for iterable in iterables]
+    while iterators:
+        for iterator in list(iterators):
+            try:
+                yield next(iterator)
+            except StopIteration:
+                iterators.remove(iterator)
+
+
+def request_cost_estimate(batch, assembled_prompt, prompt_tokens):
+    # Upper estimate of what sending batch costs, held against the budget while it is in flight. Rows too
+    # long for one request count their map-reduce parts and reduce request; with a cascade every row may
+    # also be re-sent to AZURE_OPENAI_ESCALATION_MODEL, and dead-lettered rows may go to
+    # AZURE_OPENAI_LONG_CONTEXT_MODEL, so the estimate is at the most expensive tier that can answer.
+    requests = len(batch)  # escalated rows are re-sent alone, so the prompt is counted once per row
+    row_tokens = 0
+    for _, row_prep in batch:
+        tokens = estimate_tokens(row_prep)
+        row_tokens += tokens
+        if AZURE_OPENAI_MAP_REDUCE and tokens > row_token_limit(assembled_prompt):
+            queries, reduce_row = split_long_row(row_prep, assembled_prompt)
+            if queries:
+                reduces = reduce_request_count(len(queries), EXPECTED_COMPLETION_TOKENS,
+                                               reduce_token_limit(assembled_prompt, reduce_row))
+                requests += len(queries) + reduces - 1  # the parts and reduce requests instead of the row's own
+                row_tokens += (len(queries) + reduces - 1) * EXPECTED_COMPLETION_TOKENS  # answers read by reduces
+    prompt = requests * prompt_tokens + row_tokens
+    completion = requests * EXPECTED_COMPLETION_TOKENS
+    cost = max(token_cost(model, prompt, completion) for model in get_endpoint_pool().models())  # any may answer
+    if AZURE_OPENAI_ESCALATION_MODEL:
+        cost += token_cost(AZURE_OPENAI_ESCALATION_MODEL_NAME, prompt, completion)
+    if AZURE_OPENAI_LONG_CONTEXT_MODEL:
+        cost = max(cost, token_cost(AZURE_OPENAI_LONG_CONTEXT_MODEL_NAME, prompt, completion))
+    return cost
+
+
+def timed_batch(process, batch, assembled_prompt, submitted, slots):
+    # process (e.g. process_batch) on a worker thread, returning its outcomes with the request's telemetry record.
+    # The request holds one of slots (acquired by submit_jobs) until it returns.
+    telemetry.start_request(time.monotonic() - submitted, len(batch))
+    worker_state.request_slots = slots
+    try:
+        outcomes = process(batch, assembled_prompt)
+    finally:
+        worker_state.request_slots = None
+        slots.release()
+        request = telemetry.finish_request()
+    return outcomes, request
+
+
+def submit_jobs(jobs, max_in_flight, control=None, budget=0):
+    # jobs yields (assembled prompt, batch, finish, process). Keeps up to max_in_flight requests outstanding;
+    # process(batch, assembled prompt) runs on a worker thread and returns (index, row_prep, outcome) for each
+    # row, and finish(index, row_prep, outcome) is called on this thread for every row as its request completes.
+    # With a budget, a request is only sent if the spend so far plus the estimated cost of the requests
+    # in flight and of this one stays within it. Returns True if the run was stopped by the budget.
+    in_flight = {}  # future -> finish callback; each future returns (df index, row_prep, outcome) for its rows
+    reserved = {}  # future -> estimated cost of its request
+    budget_exceeded = False
+    prompt_tokens = {}  # assembled prompt -> estimated tokens
+    slots = threading.BoundedSemaphore(max_in_flight)  # one per outstanding request, map-reduce parts included
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        while True:
+            if control is not None and not in_flight:
+                control.resumed.wait()  # paused with nothing outstanding: sleep until resumed or cancelled
+            # Top up the window so that at most max_in_flight requests are outstanding.
+            # While paused or cancelled nothing new is sent and the outstanding requests drain.
+            if (control is None or control.accepting()) and not budget_exceeded:
+                for assembled_prompt, batch, finish, process in jobs:
+                    if assembled_prompt not in prompt_tokens:
+                        prompt_tokens[assembled_prompt] = estimate_tokens(assembled_prompt + PACKING_INSTRUCTIONS)
+                    estimate = request_cost_estimate(batch, assembled_prompt, prompt_tokens[assembled_prompt]) \
+                        if budget else 0
+                    if budget and token_usage.cost + sum(reserved.values()) + estimate > budget:
+                        telemetry.log("WARNING", "budget_reached",
+                                      f"Budget of ${budget:g} reached (spent ${token_usage.cost:.4f}); "
+                                      "no further requests will be sent", budget=budget, spent=token_usage.cost)
+                        budget_exceeded = True
+                        break
+                    slots.acquire()  # waits while map-reduce parts are using slots left idle
+                    future = executor.submit(timed_batch, process, batch, assembled_prompt, time.monotonic(), slots)
+                    in_flight[future] = finish
+                    reserved[future] = estimate
+                    if len(in_flight) >= max_in_flight:
+                        break
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                del reserved[future]
+                finish = in_flight.pop(future)
+                outcomes, request = future.result()
+                started = time.monotonic()
+                for index, row_prep, outcome in outcomes:
+                    finish(index, row_prep, outcome)
+                request["write_s"] = time.monotonic() - started
+                telemetry.request(request)
+    return budget_exceeded
+
+
+def remediate_row(row_prep, assembled_prompt, error_class):
+    # Runs on a worker thread: re-sends a dead-lettered row with the strategy for its error class
+    # (see dead_letter.py). Rows are always sent alone here, never packed with others.
+    if error_class in ("json_decode", "not_a_dict"):
+        outcome = process_row(row_prep, assembled_prompt + STRICT_JSON_INSTRUCTIONS)
+    elif error_class == "context_length" and AZURE_OPENAI_LONG_CONTEXT_MODEL:
+        results = run_conversation_w_input0(f""" {row_prep} .""", assembled_prompt,
+                                            deployment=AZURE_OPENAI_LONG_CONTEXT_MODEL,
+                                            model_name=AZURE_OPENAI_LONG_CONTEXT_MODEL_NAME)
+        outcome = parse_reply_content(extract_json_content(results))
+    elif error_class in ("context_length", "timeout"):
+        # Parts of a long row fit in the context and are answered faster; rows without long cells are re-sent whole
+        outcome = map_reduce_row(row_prep, assembled_prompt)
+        if outcome is None:
+            outcome = process_row(row_prep, assembled_prompt)
+    else:
+        outcome = process_row(row_prep, assembled_prompt)
+    if not isinstance(outcome, dict):
+        raise UnexpectedReplyError(outcome)
+    return outcome
+
+
+def remediate_batch(error_class, batch, assembled_prompt):
+    # process for submit_jobs: remediate_row for each (df index, row_prep) of batch
+    outcomes = []
+    for index, row_prep in batch:
+        try:
+            outcomes.append((index, row_prep, remediate_row(row_prep, assembled_prompt, error_class)))
+        except (BadRequestError, json.JSONDecodeError, ContentFilteredError,
+                UnexpectedReplyError) + TRANSIENT_ERRORS as e:
+            outcomes.append((index, row_prep, e))
+    return outcomes
+
+
+def reprocess_dead_letters(df, prompts, inputfile, classes=REPROCESSED_CLASSES, max_in_flight=None, on_row=None,
+                           control=None, df_lock=None, budget=None):
+    # Re-sends the rows of inputfile that are in the dead-letter store for each (prefix, assembled prompt) of
+    # prompts ('' for an ordinary run, fanout_prefix(name) for a fan-out run), if their error class is one of
+    # classes, and writes the fixes into df, whose index labels must be the rows' positions in inputfile.
+    # Fixed rows are cached and taken out of the store; rows that fail again stay in it with their new error.
+    # on_row, control, df_lock and budget are as for run_submission.
+    # Returns {"fixed": {class: rows}, "failed": {class of the new error: rows}, "missing": rows not in df,
+    # "cancelled", "budget_exceeded"}.
+    max_in_flight = max_in_flight or MAX_IN_FLIGHT
+    budget = AZURE_OPENAI_BUDGET_USD if budget is None else budget
+    df_lock = df_lock or nullcontext()
+    token_usage.reset()
+    telemetry.reset()
+    letters = get_dead_letters()
+    cache = get_response_cache()
+    source = letter_source(inputfile)
+    summary = {"fixed": {}, "failed": {}, "missing": 0}
+    processed_records = 0
+    labels = {str(label): label for label in df.index}  # the store keeps row positions as text
+
+    def prompt_jobs(prefix, assembled_prompt):
+        prompt_fp = prompt_fingerprint(answering_model(), assembled_prompt)
+        pending = {}  # df index -> error class it is being reprocessed for
+
+        def finish(index, row_prep, outcome):
+            nonlocal processed_records
+            processed_records += 1
+            error_class = pending.pop(index)
+            if isinstance(outcome, Exception):
+                log_row_error(index, f"reprocessing {error_class}", outcome)
+                letters.add(source, prompt_fp, prefix, index, row_prep, outcome)
+                failed_class = classify_error(outcome)  # may differ from the error it failed with before
+                summary["failed"][failed_class] = summary["failed"].get(failed_class, 0) + 1
+            else:
+                outcome = dict(outcome, **{ROW_FINGERPRINT_COLUMN: row_fingerprint(row_prep),
+                                           PROMPT_FINGERPRINT_COLUMN: prompt_fp})
+                with df_lock:
+                    write_result(df, index, outcome, prefix)
+                cache.put(cache_key(answering_model(), assembled_prompt, row_prep), outcome)
+                letters.resolve(source, prompt_fp, prefix, index)
+                summary["fixed"][error_class] = summary["fixed"].get(error_class, 0) + 1
+            if on_row is not None:
+                on_row(processed_records, index, outcome)
+
+        for letter in letters.letters(source, prompt_fp, prefix, classes):
+            index = labels.get(letter["index"])
+            if index is None:
+                summary["missing"] += 1
+                continue
+            pending[index] = letter["error_class"]
+            yield (assembled_prompt, [(index, letter["row_text"])], finish,
+                   partial(remediate_batch, letter["error_class"]))
+
+    jobs = interleave(prompt_jobs(prefix, assembled_prompt) for prefix, assembled_prompt in prompts)
+    budget_exceeded = submit_jobs(jobs, max_in_flight, control, budget)
+    log_run_summary()
+    return dict(summary, cancelled=control is not None and control.cancelled.is_set(),
+                budget_exceeded=budget_exceeded)
+
+
+def dead_letter_counts(inputfile, prompts):
+    # {error class: rows} in the dead-letter store for inputfile and each (prefix, assembled prompt) of prompts
+    counts = {}
+    for prefix, assembled_prompt in prompts:
+        stored = get_dead_letters().counts(letter_source(inputfile),
+                                           prompt_fingerprint(answering_model(), assembled_prompt), prefix)
+        for error_class, count in stored.items():
+            counts[error_class] = counts.get(error_class, 0) + count
+    return counts
+
+
+def warn_input_fields(missing, unused):
+    # Reports a mismatch between the prompt's Input_Fields and the table's columns (see prompt_input_fields)
+    if missing:
+        telemetry.log("WARNING", "input_fields_missing",
+                      f"Warning: the prompt describes fields the table does not have: {', '.join(missing)}",
+                      missing=missing)
+    if unused:
+        telemetry.log("INFO", "input_fields_unused",
+                      f"Not sent (not listed in the prompt's Input_Fields): {', '.join(map(str, unused))}",
+                      unused=unused)
+
+
+def results_store_path(output_path):
+    # Streaming runs collect their results in a Parquet store: the output itself if it is .parquet,
+    # '<output>.parquet' next to it if it is Excel (exported from the store when the run ends, then deleted), and none
+    # for tab-delimited text, which is appended to directly
+    extension = os.path.splitext(output_path)[1].lower()
+    if extension == ".parquet":
+        return output_path
+    if extension == ".xlsx":
+        return output_path + ".parquet"
+    return None
+
+
+def run_streaming(inputfile, assembled_prompt, output_path, chunksize=None, start=0, stop=None,
+                  confirm_resume=lambda answered, failed: True, on_row=None, shard=None, **submission_options):
+    # Reads inputfile chunk by chunk, submits each chunk and appends its results to output_path
+    # (tab-delimited text, or one Parquet row group per chunk; see results_store_path), so peak memory
+    # depends on the chunk size rather than the size of the table.
+    # Rows are identified by their position in the file; start/stop select a range of them.
+    # shard (index, count, mode) runs only that shard's rows and writes them with a Row_Index column
+    # for merge_shards.py.
+    output_headers = parse_output_fields(assembled_prompt)
+    token_usage.reset()
+    telemetry.reset()
+    total_rows = count_rows(inputfile, chunksize) if shard is not None and shard[2] == "range" else None
+    journal, answered = open_run_journal(inputfile, assembled_prompt, confirm_resume,
+                                         shard_label(*shard) if shard is not None else "")
+    totals = {"processed_records": 0, "errors": [], "cancelled": False, "budget_exceeded": False, "escalated": 0,
+              "reused": 0}
+    columns = None
+    processed_before = 0
+    store_path = results_store_path(output_path)
+    store = None
+    finished = False
+    try:
+        with (open(output_path, "w", encoding="utf-8", newline="") if store_path is None else nullcontext()) as output:
+            for chunk in iter_table_chunks(inputfile, chunksize):
+                if stop is not None and chunk.index[0] >= stop:
+                    break
+                if chunk.index[0] < start or (stop is not None and chunk.index[-1] >= stop):
+                    chunk = chunk.loc[start:stop - 1 if stop is not None else None].copy()
+                if columns is None:
+                    columns = chunk.columns.tolist()
+                    input_fields, missing, unused = prompt_input_fields(columns, assembled_prompt)
+                    warn_input_fields(missing, unused)
+                    columns += [header for header in output_columns(output_headers) if header not in columns]
+                    if shard is not None:
+                        columns.insert(0, ROW_INDEX_COLUMN)
+                    if store_path is not None:
+                        store = ResultsStore(store_path, columns)
+                if shard is not None:
+                    chunk = select_shard(chunk, input_fields, shard, total_rows).copy()
+                if chunk.empty:
+                    continue
+                add_output_columns(chunk, output_headers)
+
+                def chunk_on_row(processed_records, index, outcome):
+                    if on_row is not None:
+                        on_row(processed_before + processed_records, index, outcome)
+
+                summary = run_submission(chunk, input_fields, assembled_prompt, inputfile=inputfile,
+                                         on_row=chunk_on_row, journal=journal, answered=answered,
+                                         **submission_options)
+                processed_before += summary["processed_records"]
+                totals["processed_records"] += summary["processed_records"]
+                totals["errors"] += summary["errors"]
+                totals["escalated"] += summary["escalated"]
+                totals["reused"] += summary["reused"]
+
+                if shard is not None:
+                    chunk[ROW_INDEX_COLUMN] = chunk.index
+                # Keys the model invented are dropped so every chunk has the same columns as the header
+                if store is not None:
+                    store.append(chunk)
+                else:
+                    chunk.reindex(columns=columns).to_csv(output, sep='\t', index=False, header=output.tell() == 0)
+                    output.flush()
+                if summary["cancelled"] or summary["budget_exceeded"]:
+                    totals["cancelled"] = summary["cancelled"]
+                    totals["budget_exceeded"] = summary["budget_exceeded"]
+                    break
+        finished = not totals["cancelled"] and not totals["budget_exceeded"]
+    finally:
+        if store is not None:
+            store.close()
+        if journal is not None:
+            if finished:
+                journal.discard()
+            else:
+                journal.close()
+    if store is not None and store_path != output_path:
+        export_store_to_xlsx(store_path, output_path)
+        os.remove(store_path)  # only kept if the export fails, so the results are not lost
+    log_run_summary()
+    return totals
+
+
+def write_batch_file(df, input_fields, assembled_prompt, path):
+    return write_batch_requests(path, row_payloads(df, input_fields), assembled_prompt, AZURE_OPENAI_BATCH_MODEL,
+                                response_format=request_format(assembled_prompt))
+
+
+def submit_batch_job(path):
+    return submit_batch(get_client(), path)
+
+
+def wait_for_batch_job(batch_id, poll_seconds=60, progress=print):
+    # Blocks until the batch job is finished (see batch_mode.wait_for_batch); for submit_cli.py --batch wait
+    return wait_for_batch(get_client(), batch_id, poll_seconds, progress)
+
+
+def merge_batch_results(df, batch, input_fields, assembled_prompt, inputfile=None, df_lock=None):
+    # Returns (merged row count, error details) after writing a finished batch job's replies into df. The
+    # replies are recorded like those of a live run (see prepare_submission): answers get their row and prompt
+    # fingerprints and go to the response cache, and failed rows go to the dead-letter store.
+    indexes = {str(index): index for index in df.index}  # custom_id is the DataFrame index as text
+    replies = {}
+    cumulative_error_details = []
+    for custom_id, content, error in read_batch_results(get_client(), batch):
+        index = indexes.get(custom_id)
+        if index is None:
+            cumulative_error_details.append(f"{custom_id}: not a row of the loaded table")
+        elif error:
+            replies[index] = BatchRequestError(error)
+        else:
+            try:
+                replies[index] = parse_reply_content(content)
+            except (json.JSONDecodeError, ContentFilteredError) as er:  # incorrect JSON, or a filtered reply
+                replies[index] = er
+
+    def on_row(processed_records, index, outcome):
+        if isinstance(outcome, Exception):
+            cumulative_error_details.append(f"{index}: {outcome}")
+
+    jobs, close, summarize = prepare_submission(df, input_fields, assembled_prompt, inputfile=inputfile,
+                                                on_row=on_row, df_lock=df_lock, replies=replies)
+    for _ in jobs:  # nothing is sent: the rows are recorded from replies as they come up
+        pass
+    close(True)
+    summary = summarize(False)
+    return summary["processed_records"] - len(summary["errors"]) // 2, cumulative_error_details
+
+
+def export_to_tsv(df, file_path):
+    df.to_csv(file_path, sep='\t', index=False)
+
+
+def export_to_xlsx(df, file_path):
+    # Streamed row by row with a constant-memory writer (see results_store.py) rather than built in memory
+    frames = (df.iloc[start:start + EXPORT_BATCH_ROWS] for start in range(0, len(df), EXPORT_BATCH_ROWS))
+    write_xlsx(df.columns.tolist(), frames, file_path)
+
+
+def export_to_parquet(df, file_path):
+    write_store(df, file_path)
+
+
+def export_results(df, file_path):
+    # By extension: .xlsx Excel, .parquet a Parquet results store, anything else tab-delimited text
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension == ".xlsx":
+        export_to_xlsx(df, file_path)
+    elif extension == ".parquet":
+        export_to_parquet(df, file_path)
+    else:
+        export_to_tsv(df, file_path)
@@ -0,0 +1,223 @@
+# Run telemetry. Each request (one worker task: a row or a packed group of rows, with any fallback and
+# escalation calls it needed) is timed in stages: queue wait before a worker picks it up, quota wait in
+# the rate limiter and behind 429s, network time of the HTTP calls, retries, tokens, reply parsing and
+# the writes into the DataFrame. Requests and other events go to a JSON-lines log at a chosen level;
+# counters and histograms can be written in the Prometheus text format, and the end-of-run summary says
+# whether a slow run was bound by quota, by the network or by local overhead.
+#
+# Configured from the environment (or with the command line tool's --telemetry/--log-level/--metrics):
+#   AZURE_OPENAI_TELEMETRY_PATH   JSON-lines log file (default: none)
+#   AZURE_OPENAI_LOG_LEVEL        lowest level written to it: DEBUG, INFO, WARNING or ERROR (default: INFO)
+#   AZURE_OPENAI_CONSOLE_LEVEL    lowest level whose messages are also printed (default: INFO)
+# At DEBUG every request is logged with its timings; at INFO only run-level events and problems are.
+
+import json
+import sys
+import threading
+import time
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+REQUEST_TIMINGS = ("queue_wait_s", "quota_wait_s", "network_s", "parse_s", "write_s")
+REQUEST_COUNTS = ("rows", "calls", "retries", "prompt_tokens", "completion_tokens")
+LOCAL_BOUND_SHARE = 0.5  # share of the run the submitting thread may spend writing results before it is the bottleneck
+
+
+class Histogram:
+    def __init__(self, buckets=SECONDS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            position = len(self.buckets)
+        self.counts[position] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th quantile (Prometheus-style approximation)
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for position, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.buckets[position] if position < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+def metric_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+class Telemetry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()  # the request being timed on this worker thread
+        self.file = None
+        self.level = LEVELS["INFO"]
+        self.console_level = LEVELS["INFO"]
+        self.reset()
+
+    def configure(self, path="", level="INFO", console_level="INFO"):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+            self.file = open(path, "a", encoding="utf-8") if path else None
+            self.level = LEVELS[level.upper()]
+            self.console_level = LEVELS[console_level.upper()]
+
+    def reset(self):
+        # Called at the start of a run
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.totals = dict.fromkeys(REQUEST_TIMINGS + REQUEST_COUNTS, 0)
+            self.requests = 0
+            self.started = time.monotonic()
+
+    def enabled(self, level):
+        return self.file is not None and LEVELS[level] >= self.level
+
+    def log(self, level, event, message=None, **fields):
+        # Writes an event to the log if level is high enough, and prints message if one is given and
+        # level reaches the console level
+        if self.enabled(level):
+            line = json.dumps({"ts": round(time.time(), 3), "level": level, "event": event, **fields}, default=str)
+            with self.lock:
+                self.file.write(line + "\n")
+        if message is not None and LEVELS[level] >= self.console_level:
+            with self.lock:  # one whole line at a time when several workers report together
+                sys.stdout.write(message + "\n")
+
+    def count(self, name, amount=1, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def start_request(self, queue_wait, rows):
+        self.local.request = dict.fromkeys(REQUEST_TIMINGS + REQUEST_COUNTS, 0)
+        self.local.request.update(queue_wait_s=queue_wait, rows=rows)
+
+    def add(self, key, amount):
+        # Adds to the request being timed on this thread; does nothing outside one (e.g. Batch API merges)
+        request = getattr(self.local, "request", None)
+        if request is not None:
+            request[key] += amount
+
+    def finish_request(self):
+        request, self.local.request = self.local.request, None
+        return request
+
+    def absorb(self, request):
+        # Adds a request timed on another thread (e.g. one part of a map-reduce row) to this thread's request
+        for key in ("quota_wait_s", "network_s", "parse_s", "calls", "retries", "prompt_tokens", "completion_tokens"):
+            self.add(key, request[key])
+
+    def request(self, request):
+        # Records a finished request (from finish_request, with write_s filled in by the submitting thread)
+        for key in REQUEST_TIMINGS:
+            self.observe(key[:-2] + "_seconds", request[key])
+        with self.lock:
+            self.requests += 1
+            for key, value in request.items():
+                self.totals[key] += value
+            for key in REQUEST_COUNTS:
+                counter = metric_key(key + "_total", {})
+                self.counters[counter] = self.counters.get(counter, 0) + request[key]
+            counter = metric_key("requests_total", {})
+            self.counters[counter] = self.counters.get(counter, 0) + 1
+        self.log("DEBUG", "request", **{key: round(value, 6) if isinstance(value, float) else value
+                                       for key, value in request.items()})
+
+    def bottleneck(self):
+        # 'quota', 'network' or 'local' with a one-line reason
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        totals = self.totals
+        local_share = totals["write_s"] / elapsed
+        if local_share > LOCAL_BOUND_SHARE:
+            return "local", f"the submitting thread spent {local_share:.0%} of the run writing results"
+        if totals["queue_wait_s"] > totals["quota_wait_s"] + totals["network_s"]:
+            return "local", "requests waited longer for a free worker than for the service"
+        if totals["quota_wait_s"] > totals["network_s"]:
+            return "quota", "requests waited longer for quota (rate limits, 429s) than for replies"
+        return "network", "most request time was spent waiting for replies"
+
+    def summary(self):
+        bound, reason = self.bottleneck()
+        with self.lock:
+            timings = {key[:-2]: {"total_s": round(self.totals[key], 3),
+                                  "mean_s": round(self.totals[key] / self.requests, 4) if self.requests else 0.0,
+                                  "p95_s": self.histograms[metric_key(key[:-2] + "_seconds", {})].quantile(0.95)
+                                  if self.requests else 0.0}
+                       for key in REQUEST_TIMINGS}
+            return {"elapsed_s": round(time.monotonic() - self.started, 3), "requests": self.requests,
+                    **{key: self.totals[key] for key in REQUEST_COUNTS}, "timings": timings,
+                    "counters": {name + format_labels(labels): value for (name, labels), value in self.counters.items()},
+                    "bound": bound, "reason": reason}
+
+    def describe(self):
+        summary = self.summary()
+        lines = [f"{summary['requests']} requests ({summary['calls']} calls, {summary['retries']} retries) "
+                 f"for {summary['rows']} rows in {summary['elapsed_s']:.1f}s"]
+        for stage, timing in summary["timings"].items():
+            lines.append(f"  {stage}: {timing['total_s']:.2f}s total, {timing['mean_s'] * 1000:.1f} ms mean, "
+                         f"p95 <= {timing['p95_s'] * 1000:.0f} ms")
+        lines.append(f"Bound by {summary['bound']}: {summary['reason']}")
+        return "\n".join(lines)
+
+    def prometheus(self, prefix="azure_openai_"):
+        # Counters and histograms in the Prometheus text exposition format
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {prefix}{name} counter")
+                for (other, labels), value in sorted(self.counters.items()):
+                    if other == name:
+                        lines.append(f"{prefix}{name}{format_labels(labels)} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {prefix}{name} histogram")
+                for (other, labels), histogram in sorted(self.histograms.items()):
+                    if other != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{prefix}{name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{prefix}{name}_sum{format_labels(labels)} {histogram.sum:.6f}")
+                    lines.append(f"{prefix}{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(self.prometheus())
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+
+telemetry = Telemetry()
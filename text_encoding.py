@@ -0,0 +1,29 @@
+# Encoding detection for the tab-delimited input files, shared by the batch submitter (submit_engine.py)
+# and the prompt builder (query_formatter.py) so both read a file the same way. Kept free of the
+# submitter's dependencies (openai, the endpoint configuration) so the prompt builder can import it alone.
+
+import codecs
+from functools import partial
+
+ENCODING_SAMPLE_BYTES = 1024 * 1024
+
+
+def detect_encoding(path, whole_file=False):
+    # Decide between utf-8 and Windows-1252 from a sample of the file instead of reading the whole
+    # table once per candidate encoding. A file that is not utf-8 past the sample is still decoded as
+    # utf-8 here, and read_table retries with Windows-1252. whole_file checks every byte instead (a
+    # decode of the raw bytes, not a parse), for readers that cannot go back, such as iter_table_chunks.
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    with open(path, "rb") as file:
+        try:
+            if not whole_file:
+                sample = file.read(ENCODING_SAMPLE_BYTES)
+                # A multi-byte character cut off by the end of the sample is not evidence against utf-8
+                decoder.decode(sample, final=len(sample) < ENCODING_SAMPLE_BYTES)
+                return 'utf-8'
+            for block in iter(partial(file.read, ENCODING_SAMPLE_BYTES), b""):
+                decoder.decode(block)
+            decoder.decode(b"", final=True)
+        except UnicodeDecodeError:
+            return 'Windows-1252'
+    return 'utf-8'
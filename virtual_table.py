@@ -0,0 +1,116 @@
+# Virtualized DataFrame view for Tk.
+# A plain ttk.Treeview needs one item per row, so showing (and re-showing) a 20k-row table costs
+# 20k inserts every time. VirtualTable only creates items for the rows that fit in the window and
+# re-fills them from the DataFrame as the user scrolls. Rows changed during a run are marked dirty
+# and repainted together on a timer, so the cost of keeping the view current does not grow with
+# the size of the table.
+
+import tkinter as tk
+from contextlib import nullcontext
+from tkinter import ttk
+
+
+class VirtualTable:
+    def __init__(self, parent, visible_rows=25, refresh_ms=250, lock=None):
+        # lock, if given, is held while reading the DataFrame (another thread may be writing it)
+        self.lock = lock or nullcontext()
+        self.visible_rows = visible_rows
+        self.refresh_ms = refresh_ms
+        self.df = None
+        self.offset = 0  # position in df of the first row shown
+        self.dirty = set()  # df index labels changed since the last repaint
+        self.refresh_scheduled = False
+
+        self.frame = tk.Frame(parent)
+        self.tree = ttk.Treeview(self.frame, show='headings', height=visible_rows)
+        self.scrollbar = ttk.Scrollbar(self.frame, orient="vertical", command=self.yview)
+        self.scrollbar.pack(side='right', fill='y')
+        self.tree.pack(side='left', fill=tk.BOTH, expand=True)
+
+        # Scrolling moves the window over the DataFrame rather than the Treeview's own items
+        self.tree.bind("<MouseWheel>", lambda event: self.scroll(-1 if event.delta > 0 else 1, "units"))
+        self.tree.bind("<Button-4>", lambda event: self.scroll(-1, "units"))
+        self.tree.bind("<Button-5>", lambda event: self.scroll(1, "units"))
+
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+
+    def set_dataframe(self, df):
+        # Show a new (or reshaped) DataFrame from the top
+        self.df = df
+        self.offset = 0
+        self.dirty.clear()
+        columns = list(df.columns)
+        children = self.tree.get_children()
+        if children:
+            self.tree.delete(*children)
+        self.tree["columns"] = columns
+        for col in columns:
+            self.tree.heading(col, text=col)
+            self.tree.column(col, anchor="center")
+        with self.lock:
+            for position in range(min(self.visible_rows, len(df))):
+                self.tree.insert("", "end", iid=str(position), values=self._row_values(position))
+        self._update_scrollbar()
+
+    def mark_row_changed(self, index):
+        # Called for every row written during a run; the repaint itself is batched on a timer
+        self.dirty.add(index)
+        if not self.refresh_scheduled:
+            self.refresh_scheduled = True
+            self.tree.after(self.refresh_ms, self.refresh)
+
+    def refresh(self):
+        # Repaint the visible rows that changed since the last refresh
+        self.refresh_scheduled = False
+        if self.df is None:
+            return
+        if self.dirty:
+            with self.lock:
+                visible = self.df.index[self.offset:self.offset + self.visible_rows]
+                for slot, index in enumerate(visible):
+                    if index in self.dirty:
+                        self.tree.item(str(slot), values=self._row_values(self.offset + slot))
+            self.dirty.clear()
+        self._update_scrollbar()
+
+    def redraw(self):
+        # Repaint every visible row, e.g. after many rows changed without being marked
+        if self.df is None:
+            return
+        with self.lock:
+            for slot in range(min(self.visible_rows, len(self.df))):
+                self.tree.item(str(slot), values=self._row_values(self.offset + slot))
+        self._update_scrollbar()
+
+    def scroll(self, amount, what):
+        step = self.visible_rows if what == "pages" else 1
+        self._move_to(self.offset + int(amount) * step)
+
+    def yview(self, *args):
+        # Scrollbar protocol: ('moveto', fraction) or ('scroll', amount, 'units'|'pages')
+        if self.df is None:
+            return
+        if args[0] == "moveto":
+            self._move_to(int(float(args[1]) * len(self.df)))
+        elif args[0] == "scroll":
+            self.scroll(args[1], args[2])
+
+    def _move_to(self, offset):
+        if self.df is None:
+            return
+        offset = max(0, min(offset, len(self.df) - self.visible_rows))
+        if offset == self.offset:
+            return
+        self.offset = offset
+        self.redraw()  # re-use the existing items: only their values change as the window moves
+
+    def _row_values(self, position):
+        return list(self.df.iloc[position])
+
+    def _update_scrollbar(self):
+        total = len(self.df) if self.df is not None else 0
+        if total <= self.visible_rows:
+            self.scrollbar.set(0, 1)
+        else:
+            self.scrollbar.set(self.offset / total, (self.offset + self.visible_rows) / total)